@@ -0,0 +1,163 @@
+"""
+AnchorSearch locates the amplicon in reads whose constant regions are not at their expected positions, e.g. reads with
+extra bases before the barcode or with a short insertion or deletion in a constant region.
+
+The fixed layout of a read is
+
+    | barcode | constant_1 | sample index | constant_2 |
+    0         30           95             105          129
+
+and a read that does not match it is normally counted as a bad constant read. Instead of aligning every such read to
+the whole amplicon, both constant regions are used as anchors:
+
+1.Every k-mer (seed_length bases) of a constant region is stored in a dictionary with its offset in the region. Each
+k-mer of the read found in the dictionary votes for a start of the constant region in the read, and the start with the
+most votes wins. Seeds of constant_2 are only searched after constant_1.
+
+2.The barcode is the 30 bases before constant_1 and the sample index the 10 bases before constant_2.
+
+3.The constant regions must still pass our thresholds (<= 5 differences in constant_1 and <= 2 in constant_2). When the
+distance between the anchors shows an indel in constant_1 (at most max_indel bases), constant_1 is compared as a prefix
+aligned to each start within max_indel bases of the start seen from constant_2 and a suffix aligned to constant_2,
+split at the best position, and the length of the indel is added to its differences. Bases of constant_1 deleted from
+the read are left out of both parts. Starts are tried whether or not their seeds voted for them, because an indel in the
+first bases of constant_1 leaves the true start without any vote.
+
+The search is only run for reads that fail the fixed-offset check, so reads with the expected layout cost nothing
+more.
+"""
+import Constants
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+seed_length = 8
+min_votes = 2
+max_indel = 3
+barcode_length = 30
+sample_index_length = 10
+
+
+def seed_table(constant):
+    """
+    This function maps every k-mer of a constant region to its offset in the region. k-mers occurring more than once are
+    left out because they cannot tell where the region starts.
+
+    :param constant: a constant region (str object)
+    :return: a dictionary that maps k-mers (str objects) to offsets (int objects)
+    """
+    offsets = {}
+    for offset in range(len(constant) - seed_length + 1):
+        offsets.setdefault(constant[offset:offset + seed_length], []).append(offset)
+    return {kmer: kmer_offsets[0] for kmer, kmer_offsets in offsets.items() if len(kmer_offsets) == 1}
+
+
+constant_1_seeds = seed_table(Constants.constant_1)
+constant_2_seeds = seed_table(Constants.constant_2)
+
+
+def anchor_votes(read_sequence, seeds, start=0):
+    """
+    This function lets every k-mer of a read found in seeds vote for a start of the constant region in the read.
+
+    :param read_sequence: a read sequence (str object)
+    :param seeds: a dictionary returned by seed_table
+    :param start: position of the read where the search starts
+    :return: a dictionary that maps starts of the constant region (int objects) to their number of votes
+    """
+    votes = {}
+    for position in range(start, len(read_sequence) - seed_length + 1):
+        offset = seeds.get(read_sequence[position:position + seed_length])
+        if offset is not None:
+            votes[position - offset] = votes.get(position - offset, 0) + 1
+    return votes
+
+
+def find_anchor(votes):
+    """
+    This function chooses the start of a constant region with the most votes.
+
+    :param votes: a dictionary returned by anchor_votes
+    :return: the start with the most votes (the earliest one if there is a tie), or None if no start has min_votes votes
+    """
+    if not votes:
+        return None
+    anchor = min(votes, key=lambda candidate: (-votes[candidate], candidate))
+    return anchor if votes[anchor] >= min_votes else None
+
+
+def mismatches(constant, read_sequence, start):
+    """
+    This function compares a constant region with a read at a given start; bases beyond the read count as differences.
+
+    :param constant: a constant region (str object)
+    :param read_sequence: a read sequence (str object)
+    :param start: position of the read compared with the first base of the constant region
+    :return: a list of 0/1 differences, one per base of the constant region
+    """
+    return [int(start + offset < 0 or start + offset >= len(read_sequence) or read_sequence[start + offset] != base)
+            for offset, base in enumerate(constant)]
+
+
+def split_distance(constant, read_sequence, start, end_start):
+    """
+    This function counts the differences between a constant region and a read, allowing one indel in the region.
+
+    :param constant: a constant region (str object)
+    :param read_sequence: a read sequence (str object)
+    :param start: start of the region in the read given by its own anchor
+    :param end_start: start of the region in the read given by the anchor after it
+    :return: # of differences (int object), including the length of the indel
+    """
+    prefix = mismatches(constant, read_sequence, start)
+    if end_start == start:
+        return sum(prefix)
+    suffix = mismatches(constant, read_sequence, end_start)
+    # with a deletion (end_start < start), the start - end_start bases after the split are not in the read
+    skipped = max(start - end_start, 0)
+    suffix_differences = [0] * (len(constant) + 1)
+    for position in range(len(constant) - 1, -1, -1):
+        suffix_differences[position] = suffix_differences[position + 1] + suffix[position]
+    # differences if the indel is just before each split: prefix before it, suffix after the skipped bases
+    best = suffix_differences[skipped]
+    prefix_differences = 0
+    for split in range(1, len(constant) - skipped + 1):
+        prefix_differences += prefix[split - 1]
+        best = min(best, prefix_differences + suffix_differences[split + skipped])
+    return best + abs(end_start - start)
+
+
+def locate(read_sequence, constant_1_threshold=5, constant_2_threshold=2):
+    """
+    This function locates the barcode and the sample index of a read through its constant regions.
+
+    :param read_sequence: a whole read sequence (str object)
+    :param constant_1_threshold: maximum number of differences in the first constant region
+    :param constant_2_threshold: maximum number of differences in the second constant region
+    :return: a tuple (barcode, sample index sequence), or None if the constant regions are not found or differ too much
+    """
+    constant_1_votes = anchor_votes(read_sequence, constant_1_seeds)
+    constant_1_anchor = find_anchor(constant_1_votes)
+    if constant_1_anchor is None:
+        return None
+    constant_2_start = find_anchor(anchor_votes(read_sequence, constant_2_seeds,
+                                                constant_1_anchor + len(Constants.constant_1) - max_indel))
+    if constant_2_start is None:
+        return None
+
+    # constant_1 start seen from constant_2; with an indel in constant_1 the start of its first part differs from it and
+    # may have no votes at all (an indel in its first bases), so every start within max_indel bases that leaves room
+    # for a barcode is tried
+    end_start = constant_2_start - sample_index_length - len(Constants.constant_1)
+    starts = range(max(end_start - max_indel, barcode_length), end_start + max_indel + 1)
+    if not starts:
+        return None
+    distance, constant_1_start = min((split_distance(Constants.constant_1, read_sequence, start, end_start), start)
+                                     for start in starts)
+    if distance > constant_1_threshold or \
+            sum(mismatches(Constants.constant_2, read_sequence, constant_2_start)) > constant_2_threshold:
+        return None
+    return (read_sequence[constant_1_start - barcode_length:constant_1_start],
+            read_sequence[constant_2_start - sample_index_length:constant_2_start])
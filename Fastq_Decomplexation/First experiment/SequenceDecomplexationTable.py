@@ -3,13 +3,20 @@ SequenceDecomplexationTable.py combines multiple contingency tables produced by
 SequenceDecomplexationOptimized.py into one big contingency table, so it will be easier for the downstream analyses.
 
 This software also collapses barcodes that are similar enough together to reduce the dimensionality of the data
+
+Tables are merged by TableMerge.py: barcodes already in the merged table are found with a hash join and the other ones
+are only compared with barcodes sharing a block with them. Barcodes that are not similar to any merged barcode are added
+as new rows.
+
+Raw read counts can be either pickles (_raw_read_correct.pickle) or NumPy files (_raw_read_correct.npz); both are read
+as a table with one row per barcode and one column per sample index by CountMatrix.read_table.
 """
 
-import pickle
-import pandas as pd
 import datetime
 import os
-from SequenceDecomplexationOptimized import Functions
+from CountMatrix import read_table
+from TableMerge import TableMerger
+import TableIO
 
 __author__ = 'Tee Udomlumleart'
 __maintainer__ = 'Tee Udomlumleart'
@@ -17,45 +24,46 @@ __email__ = ['teeu@mit.edu', 'salilg@mit.edu']
 __status__ = 'Production'
 
 # arbitrary define this table as a reference table
-first_table = pd.DataFrame(pickle.load(open('group_1.fastq_raw_read_correct.pickle', 'rb')))[:-1].transpose()
+first_filename = 'group_1.fastq_raw_read_correct.pickle'
+if not os.path.exists(first_filename):
+    first_filename = 'group_1.fastq_raw_read_correct.npz'
+filenames = [first_filename]
 
 cwd = os.getcwd()  # get all files in the current working directory
 for filename in os.listdir(cwd):
-    # only choose files that end with _correct.pickle (produced by SequenceDecomplexationOptimized.py)
-    if filename.endswith('_correct.pickle'):
+    # only choose files that end with _correct.pickle or _correct.npz (produced by SequenceDecomplexationOptimized.py)
+    if filename.endswith('_correct.pickle') or filename.endswith('_correct.npz'):
         # ignore the first file since it is already assigned as a reference table
-        if filename == 'group_1.fastq_raw_read_correct.pickle':
+        if filename == first_filename:
             continue
-        print('analyzing ' + filename + ' at ' + str(datetime.datetime.now()))
-
-        other_table = pd.DataFrame(pickle.load(open(filename, 'rb')))[:-1].transpose()
-        i = 0
-
-        # iterate through barcodes from another table
-        for other_barcode, other_row in other_table.iterrows():
-            i += 1
-            added = False
-            # then iterate through barcodes from the reference table
-            for reference_barcode, reference_row in first_table.iterrows():
-                # and check if the errors between those two barcodes <= 5
-                if Functions.hamming_distance(other_barcode, reference_barcode) <= 5:
-                    # if they are similar enough, assign them together
-                    first_table.loc[reference_barcode] += other_row
-                    added = True
-                    break  # then move on to other barcodes from non-reference table
-
-            # if this barcode from the non-reference table is unique, just add that entry to the reference table
-            if not added:
-                first_table.append(other_table.loc[other_barcode])
-
-filename = ''  # add filename here
-
-print('dumping pickle')
-with open(filename + '_finished_table.pickle', 'wb') as handle:
-    pickle.dump(first_table, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-print('saving csv file')
-first_table.to_excel(filename + '_finished_table.xlsx')
+        filenames.append(filename)
+
+output_filename = ''  # add filename here
+table_format = 'pickle'  # 'pickle', 'parquet' or 'arrow' (see TableIO.py)
+timepoints = {}  # sample group: timepoint embedded in Parquet/Arrow files, e.g. {1: 'd0', 2: 'd6'}
+packed = False  # compare barcodes as 2-bit packed codes (see PackedBarcode.py), faster with many barcodes
+excel_export = False  # an Excel file can also be produced later with python3 TableIO.py <table> --excel
+
+tables = [read_table(filename) for filename in filenames]
+
+# the count matrix is allocated for all barcodes of all tables at once, so it never grows during the merge
+table_merger = TableMerger(tables[0].columns, capacity=sum(len(table) for table in tables), packed=packed)
+for filename, table in zip(filenames, tables):
+    print('analyzing ' + filename + ' at ' + str(datetime.datetime.now()))
+    # barcodes of another table are collapsed into the first merged barcode whose errors <= 5; unique barcodes are
+    # added as new rows
+    is_reference = filename == first_filename
+    exact_barcodes, similar_barcodes, new_barcodes = table_merger.add_table(table, reference=is_reference)
+    print(str(exact_barcodes) + ' identical, ' + str(similar_barcodes) + ' similar and ' + str(new_barcodes) +
+          ' new barcodes')
+first_table = table_merger.to_dataframe()
+
+print('dumping ' + table_format)
+table_filename = TableIO.save_finished_table(first_table, output_filename, table_format, timepoints)
+
+if excel_export:
+    print('saving excel file')
+    TableIO.export_excel(table_filename)
 
 
 
@@ -1,9 +1,12 @@
 """
 SequenceSplit.py splits a FASTQ file into multiple ones that contain 20,000,000 reads each. This split helps with
 the downstream parallelization of decomplexation process
+
+Records are read and written as raw bytes by FastqReader by default. Set fastq_parser to 'biopython' to split the file
+with Bio.SeqIO instead. gzip-compressed files (.fastq.gz) are decompressed on the fly.
 """
 
-from Bio import SeqIO
+import FastqReader
 
 __author__ = 'Tee Udomlumleart'
 __maintainer__ = 'Tee Udomlumleart'
@@ -38,10 +41,24 @@ def batch_iterator(iterator, batch_size):
             yield batch
 
 fastq_filename = ''  # add fastq filename here
+fastq_parser = 'native'  # 'native' or 'biopython'
+
+if fastq_parser == 'native':
+    with FastqReader.open_fastq(fastq_filename) as fastq_handle:
+        record_iter = FastqReader.iterate_fastq(fastq_handle)
+        for i, batch in enumerate(batch_iterator(record_iter, 20000000)):
+            filename = "group_%i.fastq" % (i + 1)  # the output filename is group_i.fastq
+            with open(filename, "wb") as handle:
+                for title, sequence, quality in batch:
+                    handle.write(b'@' + title + b'\n' + sequence + b'\n+\n' + quality + b'\n')
+            print("Wrote %i records to %s" % (len(batch), filename))
+else:
+    import io
+    from Bio import SeqIO
 
-record_iter = SeqIO.parse(fastq_filename,"fastq")
-for i, batch in enumerate(batch_iterator(record_iter, 20000000)):
-    filename = "group_%i.fastq" % (i + 1)  # the output filename is group_i.fastq 
-    with open(filename, "w") as handle:
-        count = SeqIO.write(batch, handle, "fastq")
-    print("Wrote %i records to %s" % (count, filename))
+    record_iter = SeqIO.parse(io.TextIOWrapper(FastqReader.open_fastq(fastq_filename)),"fastq")
+    for i, batch in enumerate(batch_iterator(record_iter, 20000000)):
+        filename = "group_%i.fastq" % (i + 1)  # the output filename is group_i.fastq
+        with open(filename, "w") as handle:
+            count = SeqIO.write(batch, handle, "fastq")
+        print("Wrote %i records to %s" % (count, filename))
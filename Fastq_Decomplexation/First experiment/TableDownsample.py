@@ -0,0 +1,189 @@
+"""
+TableDownsample produces read-depth downsampled tables (as in our Downsampling Experiment, e.g.
+20200501_finished_table_1_AnalyzedReady.pickle for 1% of the reads) straight from one finished table, instead of
+subsampling the FASTQ file and decomplexing it again for every depth.
+
+Every read of the table is kept with probability p (binomial thinning): each count n becomes a binomial draw with n
+trials, drawn for the whole count matrix at once with NumPy. With method='hypergeometric', exactly round(p * total)
+reads are drawn without replacement from all reads of the table (multivariate hypergeometric thinning), like taking a
+fixed number of reads out of the file.
+
+Thinning a finished table assumes that reads are collapsed into the same barcodes at every depth; barcodes that would
+only be split or merged differently at a lower depth are not modelled.
+
+Draws are reproducible: the random generator of every percentage is seeded from the seed and the percentage itself, so a
+table does not change when other percentages are added. Percentages are thinned in parallel, one worker process per
+table, and every table is written by its worker. Barcodes left without reads are removed from a table, as in the tables
+of the Downsampling Experiment.
+
+Example:
+
+    python3 TableDownsample.py 20200501_finished_table_100_AnalyzedReady.pickle -o 20200501 --seed 0
+"""
+import argparse
+import datetime
+import multiprocessing
+import numpy as np
+import pandas as pd
+import TableIO
+from CountMatrix import read_table
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+method_choices = ['binomial', 'hypergeometric']
+# percentages of the Downsampling Experiment
+default_percentages = ['0.0001', '0.001', '0.01', '0.1', '1', '10', '25', '50', '75', '90', '100']
+# arrays shared by the tasks of one process (see set_table)
+shared_table = {}
+
+
+def percentage_rng(seed, percentage):
+    """
+    This function creates the random generator of one percentage.
+
+    :param seed: seed of the run (int object)
+    :param percentage: a percentage of reads (str object, e.g. '0.01')
+    :return: a numpy.random.Generator object that only depends on seed and on the value of percentage
+    """
+    # the value in millionths of a percent, so '1' and '1.0' give the same draws
+    return np.random.default_rng([seed, int(round(float(percentage) * 10 ** 6))])
+
+
+def thin_counts(counts, fraction, rng, method='binomial'):
+    """
+    This function downsamples a count matrix.
+
+    :param counts: an int64 matrix of read counts
+    :param fraction: fraction of reads that are kept (between 0 and 1)
+    :param rng: a numpy.random.Generator object
+    :param method: 'binomial' to keep every read with probability fraction or 'hypergeometric' to keep exactly
+    round(fraction * total) reads
+    :return: an int64 matrix with the same shape as counts
+    """
+    assert (0 <= fraction <= 1), "Fraction must be between 0 and 1: " + str(fraction)
+    assert (method in method_choices), "Unknown thinning method: " + str(method)
+    if method == 'binomial':
+        return rng.binomial(counts, fraction).astype(np.int64)
+    flat_counts = counts.ravel()
+    read_number = int(round(fraction * int(flat_counts.sum())))
+    # 'marginals' draws cell by cell, so memory does not grow with the number of reads
+    return rng.multivariate_hypergeometric(flat_counts, read_number, method='marginals').reshape(counts.shape)
+
+
+def downsample_table(table, percentage, seed=0, method='binomial', keep_empty=False):
+    """
+    This function downsamples a finished table to a percentage of its reads.
+
+    :param table: a DataFrame with one row per barcode and one column per sample index
+    :param percentage: a percentage of reads (str object, e.g. '0.01')
+    :param seed: seed of the run (see percentage_rng)
+    :param method: 'binomial' or 'hypergeometric' (see thin_counts)
+    :param keep_empty: keep barcodes left without reads
+    :return: a DataFrame of int64 counts
+    """
+    counts = thin_counts(table.to_numpy(dtype=np.int64), float(percentage) / 100, percentage_rng(seed, percentage),
+                         method)
+    downsampled_table = pd.DataFrame(counts, index=table.index, columns=table.columns)
+    if not keep_empty:
+        downsampled_table = downsampled_table[counts.sum(axis=1) > 0]
+    return downsampled_table
+
+
+def set_table(table, seed, method, keep_empty, timepoints):
+    """
+    This function keeps the table and settings for the tasks of a process (initializer of the pool).
+    """
+    shared_table.update(table=table, seed=seed, method=method, keep_empty=keep_empty, timepoints=timepoints)
+
+
+def downsample_task(task):
+    """
+    This function downsamples the shared table to one percentage and saves it. It runs in a worker process.
+
+    :param task: a tuple (percentage, filename)
+    :return: a tuple (percentage, filename, # of barcodes, # of reads)
+    """
+    percentage, filename = task
+    downsampled_table = downsample_table(shared_table['table'], percentage, shared_table['seed'],
+                                         shared_table['method'], shared_table['keep_empty'])
+    TableIO.save_table(downsampled_table, filename, shared_table['timepoints'])
+    return percentage, filename, len(downsampled_table), int(downsampled_table.to_numpy().sum())
+
+
+def table_filename(output_prefix, percentage, suffix='_AnalyzedReady', table_format='pickle'):
+    """
+    This function names the table of a percentage like the tables of the Downsampling Experiment.
+
+    :return: output_prefix + '_finished_table_' + percentage + suffix with the extension of table_format
+    """
+    return str(output_prefix) + '_finished_table_' + percentage + suffix + TableIO.table_extensions[table_format]
+
+
+def downsample_file(filename, output_prefix, percentages=None, seed=0, method='binomial', processes=None,
+                    table_format='pickle', suffix='_AnalyzedReady', keep_empty=False):
+    """
+    This function downsamples a finished table to several percentages of its reads in a pool of processes and saves
+    one table per percentage.
+
+    :param filename: a finished table (.pickle, .parquet or .arrow) or raw read counts (.npz or raw read pickle)
+    :param output_prefix: prefix of the downsampled tables
+    :param percentages: a list of percentages (str objects, default: default_percentages)
+    :param seed: seed of the run (see percentage_rng)
+    :param method: 'binomial' or 'hypergeometric' (see thin_counts)
+    :param processes: number of worker processes (default: one per percentage, at most the number of CPUs)
+    :param table_format: 'pickle', 'parquet' or 'arrow'
+    :param suffix: text added to the file names after the percentage
+    :param keep_empty: keep barcodes left without reads
+    :return: a list of tuples (percentage, filename, # of barcodes, # of reads) in the order of percentages
+    """
+    percentages = percentages or default_percentages
+    table = read_table(filename)
+    # timepoints embedded in a Parquet or Arrow file are kept
+    timepoints = TableIO.metadata_timepoints(filename)
+    tasks = [(percentage, table_filename(output_prefix, percentage, suffix, table_format))
+             for percentage in percentages]
+    processes = min(processes or multiprocessing.cpu_count(), len(tasks))
+    arguments = (table, seed, method, keep_empty, timepoints)
+    if processes == 1:
+        set_table(*arguments)
+        return [downsample_task(task) for task in tasks]
+    with multiprocessing.Pool(processes, initializer=set_table, initargs=arguments) as pool:
+        return pool.map(downsample_task, tasks)
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Downsample a finished table to percentages of its reads.')
+    argument_parser.add_argument('file', help='finished table (.pickle, .parquet or .arrow) or raw read counts')
+    argument_parser.add_argument('-o', '--output', help='prefix of the downsampled tables (default: today as YYYYMMDD)')
+    argument_parser.add_argument('--percentages', nargs='+', default=default_percentages,
+                                 help='percentages of reads to keep (default: ' + ' '.join(default_percentages) + ')')
+    argument_parser.add_argument('--seed', type=int, default=0, help='seed of the random draws (default: 0)')
+    argument_parser.add_argument('--method', choices=method_choices, default='binomial',
+                                 help='keep every read with the probability of the percentage (default) or draw '
+                                      'exactly that percentage of reads without replacement')
+    argument_parser.add_argument('--processes', type=int,
+                                 help='number of worker processes (default: one per percentage, at most the number of '
+                                      'CPUs)')
+    argument_parser.add_argument('--table-format', choices=TableIO.table_formats, default='pickle',
+                                 help='format of the downsampled tables (default: pickle)')
+    argument_parser.add_argument('--suffix', default='_AnalyzedReady',
+                                 help='text added to the file names after the percentage (default: _AnalyzedReady)')
+    argument_parser.add_argument('--keep-empty', action='store_true',
+                                 help='keep barcodes that are left without reads')
+    arguments = argument_parser.parse_args()
+    for percentage in arguments.percentages:
+        try:
+            valid = 0 <= float(percentage) <= 100
+        except ValueError:
+            valid = False
+        if not valid:
+            argument_parser.error('percentages must be numbers between 0 and 100: ' + percentage)
+
+    output_prefix = arguments.output or datetime.date.today().strftime('%Y%m%d')
+    results = downsample_file(arguments.file, output_prefix, arguments.percentages, arguments.seed, arguments.method,
+                              arguments.processes, arguments.table_format, arguments.suffix, arguments.keep_empty)
+    for percentage, filename, barcode_number, read_number in results:
+        print(filename + ': ' + str(barcode_number) + ' barcodes, ' + str(read_number) + ' reads')
@@ -0,0 +1,220 @@
+"""
+TableIO saves and loads finished tables (one row per barcode, one column per sample index) as Parquet or Arrow IPC files
+in addition to pickles.
+
+Pickled DataFrames can only be read back with a compatible version of pandas, and to_excel takes a long time on tables
+with hundreds of thousands of barcodes. Parquet and Arrow IPC files are columnar, compressed and readable by any Arrow
+implementation. Barcodes are stored in a 'Barcodes' column and counts in one int64 column per sample index.
+
+The meaning of each column is embedded in the file, both as metadata of each column and as a JSON list in the metadata
+of the table (key 'sample_columns'):
+
+    sequence   : sample index sequence (the column name)
+    sample     : name of the sample index in Constants.sample_index_dict, e.g. sample_index_5
+    group      : samples are sorted in groups of 4 consecutive sample indexes (1 for sample_index_1-4, ...)
+    state      : position in the group; 'all' cells followed by states 's1', 's2' and 's3'
+    timepoint  : timepoint of the group if it is given (e.g. --timepoints d0=1,d6=2), otherwise null
+
+Excel files are no longer written by default; they can be produced later from any saved table:
+
+    python3 TableIO.py 191012_finished_table.parquet --excel
+
+pyarrow is only needed for Parquet and Arrow IPC files.
+"""
+import argparse
+import json
+import os
+import pickle
+import Constants
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+table_formats = ['pickle', 'parquet', 'arrow']
+table_extensions = {'pickle': '.pickle', 'parquet': '.parquet', 'arrow': '.arrow'}
+state_names = ['all', 's1', 's2', 's3']
+metadata_key = b'sample_columns'
+
+
+def parse_timepoints(text):
+    """
+    This function parses a timepoint mapping given on the command line.
+
+    :param text: comma-separated timepoint=group pairs, e.g. 'd0=1,d6=2,d9=5,d12=6,d18=9,d24=10'
+    :return: a dictionary that maps sample groups (int objects) to timepoints (str objects)
+    """
+    timepoints = {}
+    if text:
+        for pair in text.split(','):
+            timepoint, group = pair.split('=')
+            timepoints[int(group)] = timepoint.strip()
+    return timepoints
+
+
+def column_metadata(columns, timepoints=None):
+    """
+    This function describes the sample index columns of a finished table.
+
+    :param columns: sample index sequences in the order of the table columns
+    :param timepoints: a dictionary that maps sample groups to timepoints (see parse_timepoints)
+    :return: a list of dictionaries (sequence, sample, group, state, timepoint), one per column
+    """
+    timepoints = timepoints or {}
+    sample_names = {sequence: sample for sample, sequence in Constants.all_sample_index_dict.items()}
+    sample_names.update({sequence: sample for sample, sequence in Constants.sample_index_dict.items()})
+    metadata = []
+    for position, sequence in enumerate(columns):
+        group = position // len(state_names) + 1
+        metadata.append({'sequence': str(sequence), 'sample': sample_names.get(sequence), 'group': group,
+                         'state': state_names[position % len(state_names)], 'timepoint': timepoints.get(group)})
+    return metadata
+
+
+def to_arrow(table, timepoints=None):
+    """
+    This function converts a finished table into an Arrow table with embedded column metadata.
+
+    :param table: a DataFrame with one row per barcode and one column per sample index
+    :param timepoints: a dictionary that maps sample groups to timepoints
+    :return: a pyarrow Table
+    """
+    import pyarrow as pa
+
+    metadata = column_metadata(table.columns, timepoints)
+    fields = [pa.field('Barcodes', pa.string())]
+    arrays = [pa.array([str(barcode) for barcode in table.index], type=pa.string())]
+    for column, column_info in zip(table.columns, metadata):
+        field_metadata = {key: '' if value is None else str(value) for key, value in column_info.items()}
+        fields.append(pa.field(str(column), pa.int64(), metadata=field_metadata))
+        arrays.append(pa.array(table[column].to_numpy(dtype='int64'), type=pa.int64()))
+    schema = pa.schema(fields, metadata={metadata_key: json.dumps(metadata).encode()})
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def save_table(table, filename, timepoints=None):
+    """
+    This function saves a finished table; the format is chosen by the extension of filename.
+
+    :param table: a DataFrame with one row per barcode and one column per sample index
+    :param filename: a .pickle, .parquet or .arrow file
+    :param timepoints: a dictionary that maps sample groups to timepoints (Parquet and Arrow IPC only)
+    """
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        pq.write_table(to_arrow(table, timepoints), filename)
+    elif filename.endswith('.arrow'):
+        import pyarrow as pa
+        arrow_table = to_arrow(table, timepoints)
+        with pa.OSFile(filename, 'wb') as sink, pa.ipc.new_file(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+    else:
+        with open(filename, 'wb') as handle:
+            pickle.dump(table, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def save_finished_table(table, output_prefix, table_format='pickle', timepoints=None):
+    """
+    This function saves a finished table as output_prefix + '_finished_table' with the extension of table_format.
+
+    :param table: a DataFrame with one row per barcode and one column per sample index
+    :param output_prefix: prefix of the file name
+    :param table_format: 'pickle', 'parquet' or 'arrow'
+    :param timepoints: a dictionary that maps sample groups to timepoints
+    :return: the name of the saved file
+    """
+    filename = str(output_prefix) + '_finished_table' + table_extensions[table_format]
+    save_table(table, filename, timepoints)
+    return filename
+
+
+def read_arrow(filename):
+    """
+    This function reads a Parquet or Arrow IPC file as a pyarrow Table.
+
+    :param filename: a .parquet or .arrow file
+    :return: a pyarrow Table
+    """
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.read_table(filename)
+    import pyarrow as pa
+    with pa.memory_map(filename, 'r') as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def read_table(filename):
+    """
+    This function reads a finished table saved by save_table.
+
+    :param filename: a .pickle, .parquet or .arrow file
+    :return: a DataFrame with one row per barcode and one column per sample index
+    """
+    if filename.endswith('.parquet') or filename.endswith('.arrow'):
+        table = read_arrow(filename).to_pandas()
+        table = table.set_index('Barcodes')
+        table.index.name = None
+        return table
+    with open(filename, 'rb') as handle:
+        return pickle.load(handle)
+
+
+def read_metadata(filename):
+    """
+    This function reads the column metadata embedded in a Parquet or Arrow IPC file.
+
+    :param filename: a .parquet or .arrow file
+    :return: a list of dictionaries (sequence, sample, group, state, timepoint), one per sample index column
+    """
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        schema = pq.read_schema(filename)
+    else:
+        schema = read_arrow(filename).schema
+    return json.loads(schema.metadata[metadata_key])
+
+
+def metadata_timepoints(filename):
+    """
+    This function reads the timepoints of sample groups embedded in a Parquet or Arrow IPC file.
+
+    :param filename: a .pickle, .parquet or .arrow file
+    :return: a dictionary that maps sample groups to timepoints (empty for a pickle)
+    """
+    if not (filename.endswith('.parquet') or filename.endswith('.arrow')):
+        return {}
+    return {column['group']: column['timepoint'] for column in read_metadata(filename) if column['timepoint']}
+
+
+def export_excel(filename, excel_filename=None):
+    """
+    This function converts a saved finished table into an Excel file.
+
+    :param filename: a .pickle, .parquet or .arrow file
+    :param excel_filename: the name of the Excel file (default: filename with the extension .xlsx)
+    :return: the name of the Excel file
+    """
+    if excel_filename is None:
+        excel_filename = os.path.splitext(filename)[0] + '.xlsx'
+    read_table(filename).to_excel(excel_filename)
+    return excel_filename
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Convert a finished table into another format.')
+    argument_parser.add_argument('file', help='finished table (.pickle, .parquet or .arrow)')
+    argument_parser.add_argument('--to', choices=table_formats, help='save the table in this format')
+    argument_parser.add_argument('--timepoints',
+                                 help='timepoints of sample groups, e.g. d0=1,d6=2,d9=5,d12=6,d18=9,d24=10')
+    argument_parser.add_argument('--excel', action='store_true', help='save the table as an Excel file')
+    arguments = argument_parser.parse_args()
+
+    if arguments.to:
+        output_filename = os.path.splitext(arguments.file)[0] + table_extensions[arguments.to]
+        print('saving ' + output_filename)
+        # timepoints already embedded in the file are kept unless new ones are given
+        timepoints = parse_timepoints(arguments.timepoints) or metadata_timepoints(arguments.file)
+        save_table(read_table(arguments.file), output_filename, timepoints)
+    if arguments.excel:
+        print('saving ' + export_excel(arguments.file))
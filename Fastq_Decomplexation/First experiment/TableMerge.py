@@ -0,0 +1,150 @@
+"""
+TableMerge merges tables of raw read counts (one row per barcode, one column per sample index), e.g. the tables of all
+parts of a fastq file decomplexed by SequenceDecomplexationOptimized.py.
+
+Tables are merged in order into one CountMatrix (see CountMatrix.py). Each barcode of a table is collapsed into the
+earliest merged barcode within 5 Hamming distances, or added as a new barcode if there is none – the same rule that
+collapses reads within one table:
+
+1.Barcodes that are already merged are found with a hash join (pandas Index.get_indexer) and their counts are added with
+one array operation. As in AllBarcode.assign_barcode, a barcode that is already merged is assigned to itself, which is
+only the earliest merged barcode within 5 Hamming distances if no earlier merged barcode is within 5 Hamming distances
+of it. Barcodes added from the reference table are kept as they are, so that is checked when they are added; the
+barcodes that have such an earlier barcode are left to step 2.
+
+2.The remaining barcodes are looked up one by one in a pigeonhole block index (see BarcodeIndex.py), so they are only
+compared with merged barcodes sharing at least one block with them.
+
+When all tables are given at once, the count matrix is allocated for the total number of barcodes of all tables, so it
+never has to grow during the merge.
+
+Finished tables of several NGS runs of the same experiment (e.g. a top-up run that improves read counts of some samples)
+are merged in the same way by merge_runs, after barcodes with too few reads in the additional runs are removed.
+"""
+import numpy as np
+import pandas as pd
+from BarcodeIndex import BarcodeIndex
+from CountMatrix import CountMatrix, read_table
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+
+class TableMerger:
+    """
+    TableMerger object contains the CountMatrix of merged barcodes, a BarcodeIndex of the same barcodes in the same
+    order and the rows of merged barcodes that have an earlier merged barcode within the threshold.
+    """
+    def __init__(self, sample_indexes, capacity=1024, max_distance=5, packed=False):
+        self.counts = CountMatrix(sample_indexes, capacity)
+        self.index = BarcodeIndex(max_distance=max_distance, packed=packed)
+        # only reference barcodes can have one, since other barcodes are only added if there is no similar barcode
+        self.shadowed_rows = set()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add_table(self, table, reference=False):
+        """
+        This function merges a table into the merged barcodes.
+
+        :param table: a DataFrame with one row per barcode and one column per sample index
+        :param reference: add barcodes that are not merged yet as new barcodes without looking for similar barcodes
+        (used for the reference table, whose barcodes are kept as they are)
+        :return: a tuple (# of barcodes found by the hash join, # of barcodes collapsed into a similar barcode,
+        # of new barcodes)
+        """
+        table_counts = table.reindex(columns=self.counts.sample_indexes, fill_value=0).to_numpy(dtype=np.int64)
+        table_barcodes = list(table.index)
+
+        # 1.hash join of exact barcodes, unless an earlier merged barcode is within the threshold
+        merged_rows = pd.Index(self.counts.barcodes, dtype=object).get_indexer(table_barcodes)
+        exact = merged_rows >= 0
+        if self.shadowed_rows:
+            exact &= ~np.isin(merged_rows, list(self.shadowed_rows))
+        np.add.at(self.counts.count_array, merged_rows[exact], table_counts[exact])
+
+        # 2.indexed search of the remaining barcodes, in the order of the table
+        similar_barcodes = 0
+        new_barcodes = 0
+        for table_row in np.flatnonzero(~exact).tolist():
+            barcode = table_barcodes[table_row]
+            parsed_barcode = self.index.find(barcode)
+            if reference and barcode not in self.counts:
+                # reference barcodes are kept as they are; a similar earlier barcode is only remembered
+                if parsed_barcode is not None:
+                    self.shadowed_rows.add(len(self.counts))
+                parsed_barcode = None
+            if parsed_barcode is None:
+                self.index.add(barcode)
+                merged_row = self.counts.add_barcode(barcode)
+                new_barcodes += 1
+            else:
+                merged_row = self.counts.rows[parsed_barcode]
+                similar_barcodes += 1
+            self.counts.count_array[merged_row] += table_counts[table_row]
+        return int(np.count_nonzero(exact)), similar_barcodes, new_barcodes
+
+    def to_dataframe(self):
+        """
+        This function returns the merged barcodes as a table with one row per barcode and one column per sample index.
+
+        :return: a DataFrame
+        """
+        return self.counts.to_dataframe()
+
+
+def merge_tables(tables, max_distance=5, packed=False):
+    """
+    This function merges tables in order (k-way merge). The first table is the reference table.
+
+    :param tables: a list of DataFrames with one row per barcode and one column per sample index
+    :param max_distance: maximum number of differences between collapsed barcodes
+    :param packed: compare barcodes as 2-bit packed codes (see PackedBarcode.py)
+    :return: a merged DataFrame whose columns are the columns of the first table
+    """
+    capacity = sum(len(table) for table in tables)
+    table_merger = TableMerger(tables[0].columns, capacity, max_distance, packed)
+    for table_number, table in enumerate(tables):
+        table_merger.add_table(table, reference=(table_number == 0))
+    return table_merger.to_dataframe()
+
+
+def merge_files(filenames, max_distance=5, packed=False):
+    """
+    This function reads raw read counts with CountMatrix.read_table and merges them in order.
+
+    :param filenames: a list of .pickle or .npz files; the first one is the reference table
+    :param max_distance: maximum number of differences between collapsed barcodes
+    :param packed: compare barcodes as 2-bit packed codes (see PackedBarcode.py)
+    :return: a merged DataFrame
+    """
+    return merge_tables([read_table(filename) for filename in filenames], max_distance, packed)
+
+
+def filter_low_count(table, min_reads=10):
+    """
+    This function removes barcodes with fewer than min_reads reads in total.
+
+    :param table: a DataFrame with one row per barcode and one column per sample index
+    :param min_reads: minimum number of reads of a barcode summed over all sample indexes
+    :return: a DataFrame with the remaining barcodes
+    """
+    return table[table.sum(axis=1) >= min_reads]
+
+
+def merge_runs(tables, min_reads=10, max_distance=5, packed=False):
+    """
+    This function merges finished tables of several NGS runs of the same experiment. The first table is the reference
+    table; barcodes with fewer than min_reads reads are removed from the other tables before they are merged.
+
+    :param tables: a list of DataFrames with one row per barcode and one column per sample index
+    :param min_reads: minimum number of reads of a barcode of an additional run
+    :param max_distance: maximum number of differences between collapsed barcodes
+    :param packed: compare barcodes as 2-bit packed codes (see PackedBarcode.py)
+    :return: a merged DataFrame
+    """
+    additional_tables = [filter_low_count(table, min_reads) for table in tables[1:]]
+    return merge_tables([tables[0]] + additional_tables, max_distance, packed)
@@ -0,0 +1,219 @@
+"""
+Telemetry records how fast a decomplexation runs while it runs, so that it can be seen where the throughput drops, e.g.
+when the number of collapsed barcodes grows.
+
+At regular intervals (every batch, or every read_interval reads without --batch-size), one JSON object is appended to a
+JSON lines file:
+
+    {"event": "progress", "shard": 0, "elapsed": 12.5, "reads": 2000000, "reads_per_second": 160342.1,
+     "stage_seconds": {"read": 4.1, "quality_control": 1.2, "collapse": 0.9}, "read_counts": {...},
+     "clusters": 35012, "peak_rss_mb": 812.4}
+
+    elapsed          : seconds since the shard started
+    reads_per_second : reads of this interval divided by the length of the interval
+    stage_seconds    : time spent in each stage during this interval; time not spent in a measured stage is counted as
+                       'read' (parsing and decompression)
+    read_counts      : counts of analyzed reads and of rejected reads by reason so far (see Functions.collapse_fastq)
+    clusters         : number of collapsed barcodes (exact barcodes with --collapse abundance or graph) so far; null
+                       while reads are collapsed by sample shards (see SampleShards.py)
+    peak_rss_mb      : peak resident memory of the process so far
+
+Shards of SequenceDecomplexationParallel.py append to the same file, each line being written at once. A run
+resumed from a checkpoint (see Checkpoint.py) appends to the file of the interrupted run and continues its elapsed time.
+When the run is finished, all lines are merged into one run report (see run_report).
+"""
+import datetime
+import json
+import os
+import sys
+import time
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+
+def peak_rss_mb(children=False):
+    """
+    This function measures the peak resident memory of the current process.
+
+    :param children: measure the largest child process that has ended (e.g. worker processes) instead
+    :return: peak resident memory in MB (float object), or None where the resource module is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kilobytes elsewhere
+    return peak_rss / (1 << 20) if sys.platform == 'darwin' else peak_rss / (1 << 10)
+
+
+class Telemetry:
+    """
+    Telemetry object measures the stages of one shard (or of a whole run in one process) and appends its records to a
+    JSON lines file.
+    """
+    def __init__(self, filename, shard=0, read_interval=1000000):
+        """
+        :param filename: the name of the JSON lines file
+        :param shard: number of the shard that is measured
+        :param read_interval: number of reads between two records when reads are not checked in batches
+        """
+        self.filename = filename
+        self.shard = shard
+        self.read_interval = read_interval
+        self.started = time.perf_counter()
+        self.interval_started = self.started
+        self.interval_reads = 0
+        self.stage_seconds = {}
+
+    def resume(self, reads):
+        """
+        This function continues the records of an interrupted run of this shard that is resumed from a checkpoint, so
+        that elapsed times go on from the last record of that run and the first interval only counts reads analyzed
+        after the checkpoint.
+
+        :param reads: number of reads analyzed before the checkpoint
+        """
+        if os.path.exists(self.filename):
+            elapsed = [entry['elapsed'] for entry in read_records(self.filename) if entry['shard'] == self.shard]
+            self.started -= max(elapsed, default=0.0)
+        self.interval_reads = reads
+
+    def add_time(self, stage, seconds):
+        """
+        This function adds time spent in a stage during the current interval.
+
+        :param stage: name of the stage, e.g. 'quality_control' or 'collapse'
+        :param seconds: time spent (float object)
+        """
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+
+    def interval_elapsed(self):
+        """
+        This function measures the time since the current interval started.
+
+        :return: seconds (float object)
+        """
+        return time.perf_counter() - self.interval_started
+
+    def record(self, read_counts, clusters, event='progress'):
+        """
+        This function appends a record of the current interval to the JSON lines file and starts a new interval.
+
+        :param read_counts: a dictionary of read counts so far
+        :param clusters: number of collapsed (or exact) barcodes so far, or None if they are not known
+        :param event: kind of record, e.g. 'progress' or 'finish_collapse'
+        """
+        now = time.perf_counter()
+        interval = now - self.interval_started
+        reads = read_counts.get('all_reads', 0)
+        stage_seconds = dict(self.stage_seconds)
+        stage_seconds['read'] = stage_seconds.get('read', 0.0) + max(interval - sum(self.stage_seconds.values()), 0.0)
+        entry = {'event': event, 'time': str(datetime.datetime.now()), 'shard': self.shard,
+                 'elapsed': round(now - self.started, 3), 'reads': reads,
+                 'reads_per_second': round((reads - self.interval_reads) / interval, 1) if interval > 0 else None,
+                 'stage_seconds': {stage: round(seconds, 3) for stage, seconds in stage_seconds.items()},
+                 'read_counts': dict(read_counts), 'clusters': clusters, 'peak_rss_mb': peak_rss_mb()}
+        write_record(self.filename, entry)
+        self.interval_started = now
+        self.interval_reads = reads
+        self.stage_seconds = {}
+
+
+def clusters(all_barcode_list):
+    """
+    This function counts the barcodes held by an AllBarcode object.
+
+    :param all_barcode_list: an AllBarcode object
+    :return: # of collapsed barcodes plus # of exact barcodes that are not clustered yet
+    """
+    return len(all_barcode_list.counts) + len(all_barcode_list.exact_counts)
+
+
+def write_record(filename, entry):
+    """
+    This function appends one JSON object as one line, written at once so that lines of several processes do not mix.
+
+    :param filename: the name of the JSON lines file
+    :param entry: a dictionary that can be serialized as JSON
+    """
+    with open(filename, 'a') as handle:
+        handle.write(json.dumps(entry) + '\n')
+
+
+def read_records(filename):
+    """
+    This function reads all records of a JSON lines file.
+
+    :param filename: the name of the JSON lines file
+    :return: a list of dictionaries
+    """
+    with open(filename) as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+
+def run_report(records):
+    """
+    This function merges the records of all shards of a run into one report.
+
+    :param records: a list of dictionaries returned by read_records
+    :return: a dictionary with the totals of the run, the totals of every shard and the throughput of every interval
+    ordered by the number of clusters, which shows how the throughput changes as the barcode set grows
+    """
+    shards = {}
+    for entry in records:
+        shard = shards.setdefault(entry['shard'], {'shard': entry['shard'], 'stage_seconds': {}})
+        for stage, seconds in entry['stage_seconds'].items():
+            shard['stage_seconds'][stage] = round(shard['stage_seconds'].get(stage, 0.0) + seconds, 3)
+        shard['elapsed'] = max(shard.get('elapsed', 0.0), entry['elapsed'])
+        if entry['event'] == 'progress':
+            # read counts are totals so far, so the last progress record of a shard holds the totals of the shard
+            shard['read_counts'] = entry['read_counts']
+            shard['clusters'] = entry['clusters']
+        if entry['peak_rss_mb'] is not None:
+            shard['peak_rss_mb'] = max(shard.get('peak_rss_mb', 0.0), entry['peak_rss_mb'])
+    shard_reports = [shards[shard] for shard in sorted(shards, key=str)]
+
+    read_counts = {}
+    stage_seconds = {}
+    for shard in shard_reports:
+        for key, value in shard.get('read_counts', {}).items():
+            read_counts[key] = read_counts.get(key, 0) + value
+        for stage, seconds in shard['stage_seconds'].items():
+            stage_seconds[stage] = round(stage_seconds.get(stage, 0.0) + seconds, 3)
+    elapsed = max([shard['elapsed'] for shard in shard_reports], default=0.0)
+    peak_rss = [shard['peak_rss_mb'] for shard in shard_reports if 'peak_rss_mb' in shard]
+    throughput = sorted(([entry['clusters'], entry['reads_per_second'], entry['shard']] for entry in records
+                         if entry['event'] == 'progress' and entry['reads_per_second'] is not None and
+                         entry['clusters'] is not None),
+                        key=lambda row: row[0])
+    return {'shards': len([shard for shard in shard_reports if 'read_counts' in shard]), 'elapsed': elapsed,
+            'reads_per_second': round(read_counts.get('all_reads', 0) / elapsed, 1) if elapsed else None,
+            'read_counts': read_counts, 'stage_seconds': stage_seconds,
+            'peak_rss_mb': max(peak_rss) if peak_rss else None, 'shard_reports': shard_reports,
+            'throughput_by_clusters': throughput}
+
+
+def write_run_report(filename, report_filename):
+    """
+    This function merges the records of a JSON lines file into a run report saved as a JSON file.
+
+    :param filename: the name of the JSON lines file
+    :param report_filename: the name of the report
+    :return: the report (dictionary)
+    """
+    report = run_report(read_records(filename))
+    with open(report_filename, 'w') as handle:
+        json.dump(report, handle, indent=2)
+    return report
+
+
+def remove(filename):
+    """
+    This function removes the JSON lines file of an earlier run, so that a new run starts with an empty file.
+    """
+    if os.path.exists(filename):
+        os.remove(filename)
@@ -0,0 +1,227 @@
+"""
+BarcodeGraph clusters exact barcodes as the connected components of their neighbour graph, in which two barcodes are
+joined if they are within 5 Hamming distances. With millions of exact barcodes from deep runs, this spreads the work of
+the barcode collapse over several processes instead of comparing barcodes one by one in a single process.
+
+1.Candidate pairs are found with the pigeonhole principle of BarcodeIndex.py: two barcodes within 5 Hamming distances
+share at least one of their six 5-bp blocks. For every block, barcodes are grouped by their block sequence (block key),
+and only barcodes of the same group are compared.
+
+2.Groups are independent of each other, so they are divided into tasks of about pairs_per_task comparisons and handed
+over to a pool of processes. Within a group, all pairs are compared at once with the XOR/popcount kernel of
+PackedBarcode.py. A pair sharing several blocks is only kept by the first block it shares, so every edge is found once.
+
+3.The edges are merged with a union-find (disjoint set) structure into components. Every component becomes one barcode,
+named after its most abundant exact barcode (ties broken alphabetically), with the counts of all its exact barcodes.
+
+    exact barcodes --> block keys --> [tasks by block key] --> edges --> union-find --> components
+
+Unlike collapse='greedy' and collapse='abundance', a component can chain barcodes that are more than 5 Hamming distances
+apart through barcodes between them (single linkage). The result does not depend on the order of reads, on how the file
+is divided or on the number of processes.
+"""
+import multiprocessing
+import numpy as np
+import PackedBarcode
+from BarcodeIndex import BarcodeIndex
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+pairs_per_task = 1 << 22
+# number of distances computed at once, which bounds the size of the distance matrices of large groups
+compare_cells = 1 << 22
+# arrays shared by the tasks of one process (see set_arrays)
+shared_arrays = {}
+
+
+class UnionFind:
+    """
+    UnionFind object keeps a parent array in which every element points towards the root of its set.
+    """
+    def __init__(self, size):
+        self.parents = list(range(size))
+        self.sizes = [1] * size
+
+    def find(self, element):
+        """
+        This function finds the root of the set of an element, halving the path to it on the way.
+
+        :param element: an element (int object)
+        :return: the root (int object)
+        """
+        parents = self.parents
+        while parents[element] != element:
+            parents[element] = parents[parents[element]]
+            element = parents[element]
+        return element
+
+    def union(self, element_1, element_2):
+        """
+        This function merges the sets of two elements, hanging the smaller set under the larger one.
+        """
+        root_1 = self.find(element_1)
+        root_2 = self.find(element_2)
+        if root_1 == root_2:
+            return
+        if self.sizes[root_1] < self.sizes[root_2]:
+            root_1, root_2 = root_2, root_1
+        self.parents[root_2] = root_1
+        self.sizes[root_1] += self.sizes[root_2]
+
+    def roots(self):
+        """
+        This function finds the root of every element.
+
+        :return: an int64 array
+        """
+        return np.array([self.find(element) for element in range(len(self.parents))], dtype=np.int64)
+
+
+def block_keys(barcodes, block_slices):
+    """
+    This function numbers the block sequences of every block.
+
+    :param barcodes: a list of barcodes (str objects)
+    :param block_slices: a list of slices of the blocks (see BarcodeIndex)
+    :return: an int64 matrix with shape (len(barcodes), len(block_slices)); equal numbers in a column are equal block
+    sequences
+    """
+    keys = np.zeros((len(barcodes), len(block_slices)), dtype=np.int64)
+    for block, block_slice in enumerate(block_slices):
+        key_numbers = {}
+        keys[:, block] = [key_numbers.setdefault(barcode[block_slice], len(key_numbers)) for barcode in barcodes]
+    return keys
+
+
+def candidate_tasks(keys):
+    """
+    This function groups barcodes by block key and divides the groups into tasks.
+
+    :param keys: a matrix returned by block_keys
+    :return: a list of tasks; a task is a tuple (block, list of arrays of barcode ids of the same block key)
+    """
+    tasks = []
+    for block in range(keys.shape[1]):
+        order = np.argsort(keys[:, block], kind='stable')
+        group_starts = np.flatnonzero(np.diff(keys[order, block], prepend=-1))
+        group_sizes = np.diff(group_starts, append=len(order))
+        groups = []
+        pairs = 0
+        for group_start, group_size in zip(group_starts.tolist(), group_sizes.tolist()):
+            if group_size < 2:
+                continue
+            groups.append(order[group_start:group_start + group_size])
+            pairs += group_size * (group_size - 1) // 2
+            if pairs >= pairs_per_task:
+                tasks.append((block, groups))
+                groups = []
+                pairs = 0
+        if groups:
+            tasks.append((block, groups))
+    return tasks
+
+
+def set_arrays(codes, n_masks, keys, max_distance):
+    """
+    This function keeps the packed barcodes and block keys for the tasks of a process (initializer of the pool).
+    """
+    shared_arrays.update(codes=codes, n_masks=n_masks, keys=keys, max_distance=max_distance)
+
+
+def neighbour_edges(task):
+    """
+    This function compares all barcodes of the same block key with each other. It runs in a worker process.
+
+    :param task: a tuple (block, list of arrays of barcode ids) returned by candidate_tasks
+    :return: a tuple (ids of first barcodes, ids of second barcodes) of pairs within max_distance Hamming distances
+    that do not share any earlier block
+    """
+    block, groups = task
+    codes = shared_arrays['codes']
+    n_masks = shared_arrays['n_masks']
+    keys = shared_arrays['keys']
+    max_distance = shared_arrays['max_distance']
+    firsts = []
+    seconds = []
+    for group in groups:
+        compare_rows = max(compare_cells // len(group), 1)
+        for start in range(0, len(group) - 1, compare_rows):
+            rows = group[start:start + compare_rows]
+            rest = group[start + 1:]
+            distances = PackedBarcode.pairwise_hamming_distance(codes[rows], n_masks[rows], codes[rest], n_masks[rest])
+            # only pairs (i, j) with j after i in the group
+            later = np.arange(len(rest))[None, :] >= np.arange(len(rows))[:, None]
+            row_positions, rest_positions = np.nonzero((distances <= max_distance) & later)
+            first = rows[row_positions]
+            second = rest[rest_positions]
+            if block:
+                first_shared = (keys[first, :block] == keys[second, :block]).any(axis=1)
+                first = first[~first_shared]
+                second = second[~first_shared]
+            firsts.append(first)
+            seconds.append(second)
+    if not firsts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def neighbour_graph(barcodes, processes=None, max_distance=5):
+    """
+    This function finds all pairs of barcodes within max_distance Hamming distances.
+
+    :param barcodes: a list of distinct barcodes (str objects) of equal length
+    :param processes: number of worker processes (default: number of CPUs; 1 to compare in this process)
+    :param max_distance: maximum number of differences
+    :return: a tuple (ids of first barcodes, ids of second barcodes) of all edges
+    """
+    if not barcodes:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    block_slices = BarcodeIndex(len(barcodes[0]), max_distance).block_slices
+    codes, n_masks = PackedBarcode.encode(barcodes)
+    keys = block_keys(barcodes, block_slices)
+    tasks = candidate_tasks(keys)
+    arrays = (codes, n_masks, keys, max_distance)
+    processes = processes or multiprocessing.cpu_count()
+    if processes == 1 or len(tasks) < 2:
+        set_arrays(*arrays)
+        edges = [neighbour_edges(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(processes, initializer=set_arrays, initargs=arrays) as pool:
+            edges = pool.map(neighbour_edges, tasks)
+    if not edges:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate([first for first, second in edges]), np.concatenate([second for first, second in edges])
+
+
+def cluster(barcodes, abundance, processes=None, max_distance=5):
+    """
+    This function clusters barcodes into the connected components of their neighbour graph.
+
+    :param barcodes: a list of distinct barcodes (str objects) of equal length
+    :param abundance: number of reads of every barcode
+    :param processes: number of worker processes that compare barcodes
+    :param max_distance: maximum number of differences between neighbours
+    :return: a tuple (representative barcodes of components in descending abundance of components, int64 array of the
+    component of every barcode)
+    """
+    first, second = neighbour_graph(barcodes, processes, max_distance)
+    union_find = UnionFind(len(barcodes))
+    for barcode_1, barcode_2 in zip(first.tolist(), second.tolist()):
+        union_find.union(barcode_1, barcode_2)
+    roots, components = np.unique(union_find.roots(), return_inverse=True)
+    abundance = np.asarray(abundance, dtype=np.int64)
+    component_abundance = np.bincount(components, weights=abundance, minlength=len(roots)).astype(np.int64)
+
+    # the representative of a component is its most abundant barcode, ties broken alphabetically
+    representatives = [None] * len(roots)
+    for barcode_id in sorted(range(len(barcodes)), key=lambda row: (-abundance[row], barcodes[row])):
+        if representatives[components[barcode_id]] is None:
+            representatives[components[barcode_id]] = barcodes[barcode_id]
+    order = sorted(range(len(roots)), key=lambda component: (-component_abundance[component],
+                                                             representatives[component]))
+    new_numbers = np.empty(len(roots), dtype=np.int64)
+    new_numbers[order] = np.arange(len(roots))
+    return [representatives[component] for component in order], new_numbers[components]
@@ -0,0 +1,217 @@
+"""
+Benchmark runs the decomplexation engines on a FASTQ file with a known ground truth (see SyntheticFastq.py) and reports
+for every engine
+
+    reads_per_second  : reads of the file divided by the time to collapse them
+    peak_rss_mb       : peak resident memory of the engine (of its largest worker process in peak_worker_rss_mb)
+    barcodes          : number of collapsed barcodes
+    found_barcodes    : true barcodes (with expected reads) that a collapsed barcode is within 5 Hamming distances of
+    split_barcodes    : collapsed barcodes near a true barcode that already has a larger collapsed barcode
+    unmatched_barcodes: collapsed barcodes not within 5 Hamming distances of any true barcode
+    read_accuracy     : expected good reads that are counted in the largest collapsed barcode of their true barcode
+                        and in their sample index
+    read_summary      : whether the read summary is the expected one
+    same_as_first     : whether barcodes and counts are identical to the ones of the first engine, which catches
+                        engines that should give the same result but do not
+
+Every engine runs in a new process, so that its memory is measured on its own. The 'scan' engine compares every read
+with all collapsed barcodes one by one, as the original AllBarcode.add_read did, and is only meant for small files; it
+shows how much faster and whether as accurate the other engines are.
+
+Example:
+
+    python3 SyntheticFastq.py synthetic.fastq --reads 1000000 --barcodes 5000
+    python3 Benchmark.py synthetic.fastq --engines native batch packed parallel
+    python3 Benchmark.py small_synthetic.fastq --engines scan native
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import time
+import numpy as np
+import Pipeline
+import Telemetry
+from BarcodeIndex import BarcodeIndex
+from CountMatrix import CountMatrix
+from SequenceDecomplexationOptimized import AllBarcode, Functions
+from SampleShards import SampleShards
+from SequenceDecomplexationParallel import decomplex_parallel
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+# options of Functions.collapse_fastq for every engine; 'qc_workers' runs Pipeline.py (with collapse workers by sample
+# index if 'sample_shards' is given, see SampleShards.py, or with ScanBarcode if 'scan' is given) and 'processes' runs
+# SequenceDecomplexationParallel.py
+engines = {'scan': {'batch_size': 100000, 'qc_workers': 1, 'scan': True},
+           'native': {},
+           'biopython': {'fastq_parser': 'biopython'},
+           'batch': {'batch_size': 100000},
+           'packed': {'packed': True},
+           'abundance': {'collapse': 'abundance'},
+           'graph': {'collapse': 'graph'},
+           'pipeline': {'batch_size': 100000, 'qc_workers': 2},
+           'sample_shards': {'batch_size': 100000, 'qc_workers': 2, 'sample_shards': 'timepoint'},
+           'parallel': {'processes': 2},
+           'mmap': {'fastq_parser': 'mmap'},
+           'mmap_batch': {'fastq_parser': 'mmap', 'batch_size': 100000},
+           'mmap_parallel': {'fastq_parser': 'mmap', 'processes': 2}}
+default_engines = ['native', 'batch', 'packed', 'abundance', 'graph', 'pipeline', 'sample_shards', 'parallel', 'mmap',
+                   'mmap_batch', 'mmap_parallel']
+
+
+class ScanBarcode(AllBarcode):
+    """
+    ScanBarcode object collapses reads like AllBarcode (without a whitelist), but finds the earliest barcode within 5
+    Hamming distances by comparing a new barcode with every collapsed barcode, as the original add_read did.
+    """
+    def assign_barcode(self, new_barcode):
+        """
+        This function finds the barcode in self.counts that a new barcode is collapsed into, adding the new barcode to
+        self.counts if there is none.
+
+        :param new_barcode: a barcode (str object)
+        :return: row of the barcode in self.counts (int object)
+        """
+        for row, parsed_barcode in enumerate(self.counts.barcodes):
+            if Functions.hamming_distance(parsed_barcode, new_barcode) <= 5:
+                return row
+        return self.counts.add_barcode(new_barcode)
+
+
+def run_engine(filename, engine, workers=None):
+    """
+    This function collapses all reads of a FASTQ file with one engine.
+
+    :param filename: the name of a FASTQ file
+    :param workers: number of QC worker processes of the 'scan', 'pipeline' and 'sample_shards' engines and of worker
+    :param workers: number of QC worker processes of the 'pipeline' and 'sample_shards' engines and of worker
+    processes of the 'parallel' engines (default: their options)
+    :return: a tuple (CountMatrix object of collapsed barcodes, read counts, seconds)
+    """
+    options = dict(engines[engine])
+    started = time.perf_counter()
+    if 'processes' in options:
+        processes = options.pop('processes')
+        all_barcode_list, read_counts = decomplex_parallel(filename, workers or processes, **options)
+    elif 'qc_workers' in options:
+        all_barcode_list = ScanBarcode() if options.get('scan') else AllBarcode()
+        sample_shards = SampleShards(options['sample_shards']) if 'sample_shards' in options else None
+        read_counts = Pipeline.collapse_fastq(filename, all_barcode_list, options['batch_size'],
+                                              workers or options['qc_workers'], sample_shards=sample_shards)[0]
+        all_barcode_list.finish_collapse()
+    else:
+        all_barcode_list, read_counts = Functions.collapse_fastq(filename, **options)
+        all_barcode_list.finish_collapse()
+    return all_barcode_list.counts, read_counts, time.perf_counter() - started
+
+
+def measure_engine(filename, engine, workers, connection):
+    """
+    This function runs in a new process for every engine and sends the results of run_engine with the peak memory of
+    the process and of its worker processes through a pipe.
+    """
+    counts, read_counts, elapsed = run_engine(filename, engine, workers)
+    connection.send((counts, read_counts, elapsed, Telemetry.peak_rss_mb(), Telemetry.peak_rss_mb(children=True)))
+    connection.close()
+
+
+def accuracy(counts, truth):
+    """
+    This function compares collapsed barcodes with the true barcodes. Every collapsed barcode is matched to the nearest
+    true barcode within 5 Hamming distances; the largest collapsed barcode matched to a true barcode stands for it.
+
+    :param counts: a CountMatrix object of collapsed barcodes
+    :param truth: a CountMatrix object of the expected good reads of every true barcode (see SyntheticFastq.py)
+    :return: a dictionary (found_barcodes, split_barcodes, unmatched_barcodes, read_accuracy)
+    """
+    truth_index = BarcodeIndex()
+    for barcode in truth.barcodes:
+        truth_index.add(barcode)
+    truth_counts = truth.counts[:, [truth.columns[sample_index] for sample_index in counts.sample_indexes]]
+
+    representatives = {}
+    unmatched_barcodes = 0
+    for row, barcode in enumerate(counts.barcodes):
+        true_id = truth_index.nearest(barcode)
+        if true_id is None:
+            unmatched_barcodes += 1
+        elif true_id not in representatives or counts.counts[row].sum() > counts.counts[representatives[true_id]].sum():
+            representatives[true_id] = row
+    true_ids = np.array(list(representatives), dtype=np.intp)
+    rows = np.array(list(representatives.values()), dtype=np.intp)
+    correct_reads = np.minimum(counts.counts[rows], truth_counts[true_ids]).sum() if len(rows) else 0
+    return {'found_barcodes': int((truth_counts[true_ids].sum(axis=1) > 0).sum()),
+            'split_barcodes': len(counts) - unmatched_barcodes - len(representatives),
+            'unmatched_barcodes': unmatched_barcodes,
+            'read_accuracy': round(float(correct_reads / max(truth_counts.sum(), 1)), 6)}
+
+
+def benchmark(filename, engine_names, truth_prefix=None, workers=None):
+    """
+    This function runs engines one after another on a FASTQ file and compares their results with the ground truth.
+
+    :param filename: the name of a FASTQ file written by SyntheticFastq.py
+    :param engine_names: a list of keys of engines
+    :param truth_prefix: prefix of the ground truth files (default: the FASTQ filename)
+    :param workers: number of worker processes of the 'pipeline' and 'parallel' engines
+    :return: a list of dictionaries, one per engine
+    """
+    truth_prefix = truth_prefix or filename
+    truth = CountMatrix.load_npz(truth_prefix + '_truth.npz')
+    with open(truth_prefix + '_truth.json') as handle:
+        expected_read_counts = json.load(handle)['read_counts']
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    first_counts = None
+    for engine in engine_names:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=measure_engine, args=(filename, engine, workers, sender))
+        process.start()
+        counts, read_counts, elapsed, peak_rss, peak_worker_rss = receiver.recv()
+        process.join()
+        if first_counts is None:
+            first_counts = counts
+        result = {'engine': engine, 'seconds': round(elapsed, 3),
+                  'reads_per_second': round(read_counts['all_reads'] / elapsed, 1),
+                  'peak_rss_mb': round(peak_rss, 1) if peak_rss is not None else None,
+                  'peak_worker_rss_mb': round(peak_worker_rss, 1) if peak_worker_rss else None,
+                  'barcodes': len(counts)}
+        result.update(accuracy(counts, truth))
+        result['read_summary'] = all(read_counts[key] == value for key, value in expected_read_counts.items())
+        result['same_as_first'] = counts.barcodes == first_counts.barcodes and \
+            np.array_equal(counts.counts, first_counts.counts)
+        results.append(result)
+        print(engine + ': ' + ', '.join(key + ' ' + str(value) for key, value in result.items() if key != 'engine'))
+    return results
+
+
+def write_results(filename, results):
+    """
+    This function saves the results of benchmark as a csv file with one row per engine.
+    """
+    with open(filename, mode='w') as csv_file:
+        csv_writer = csv.DictWriter(csv_file, fieldnames=list(results[0]))
+        csv_writer.writeheader()
+        csv_writer.writerows(results)
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Benchmark decomplexation engines on a synthetic FASTQ file.')
+    argument_parser.add_argument('file', help='name of a FASTQ file written by SyntheticFastq.py')
+    argument_parser.add_argument('--truth', help='prefix of the ground truth files (default: the FASTQ filename)')
+    argument_parser.add_argument('--engines', nargs='+', choices=list(engines), default=default_engines,
+                                 help='engines to run, the first one being the reference of same_as_first (default: '
+                                      + ' '.join(default_engines) + ')')
+    argument_parser.add_argument('--workers', type=int,
+                                 help='number of worker processes of the pipeline and parallel engines (default: 2)')
+    argument_parser.add_argument('-o', '--output',
+                                 help='prefix of the csv file of results (default: the FASTQ filename)')
+    arguments = argument_parser.parse_args()
+
+    results = benchmark(arguments.file, arguments.engines, arguments.truth, arguments.workers)
+    write_results(str(arguments.output or arguments.file) + '_benchmark.csv', results)
@@ -287,6 +287,55 @@ all_sample_index_dict = {
     reverse_complement())
 }
 
+
+def build_sample_index_lookup(index_dict, max_distance=1):
+    """
+    This function maps every sequence within max_distance Hamming distance of a sample index to that sample index.
+
+    Sequences that are within max_distance of more than one sample index are ambiguous, so they are left out of the
+    lookup table and returned separately.
+
+    :param index_dict: a dictionary that maps sample names to sample indexes
+    :param max_distance: maximum number of mismatches (0 or 1)
+    :return: a tuple (lookup table {sequence: sample index}, set of ambiguous sequences)
+    """
+    lookup = {}
+    ambiguous = set()
+    for sample_index in index_dict.values():
+        neighbours = {sample_index}
+        if max_distance >= 1:
+            # reads may also contain N, which counts as a mismatch
+            neighbours.update(sample_index[:position] + base + sample_index[position + 1:]
+                              for position in range(len(sample_index)) for base in 'ACGTN')
+        for neighbour in neighbours:
+            if lookup.get(neighbour, sample_index) != sample_index:
+                ambiguous.add(neighbour)
+            lookup[neighbour] = sample_index
+    for neighbour in ambiguous:
+        del lookup[neighbour]
+    return lookup, ambiguous
+
+
+# Every 10-mer within 1 Hamming distance of a sample index, so a read can be demultiplexed with one dictionary lookup
+sample_index_lookup, ambiguous_sample_index_set = build_sample_index_lookup(sample_index_dict)
+
+
+def scan_sample_index(sequence, max_distance=1):
+    """
+    This function assigns a sequence that is not in sample_index_lookup by comparing it with every sample index. Only
+    sequences with other characters than ACGTN (e.g. '.') can be within max_distance of a sample index without being in
+    the lookup table; the other ones are not compared again.
+
+    :param sequence: the sample index region of a read (str object)
+    :param max_distance: maximum number of mismatches
+    :return: the sample index, or None if no sample index or more than one is within max_distance
+    """
+    if sequence in ambiguous_sample_index_set or set(sequence) <= set('ACGTN'):
+        return None
+    matches = [sample_index for sample_index in sample_index_dict.values() if len(sample_index) == len(sequence) and
+               sum(base_1 != base_2 for base_1, base_2 in zip(sample_index, sequence)) <= max_distance]
+    return matches[0] if len(matches) == 1 else None
+
 print()
 
 
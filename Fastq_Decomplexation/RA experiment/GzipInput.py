@@ -0,0 +1,247 @@
+"""
+GzipInput reads gzip- and BGZF-compressed FASTQ files directly, so that files downloaded from SRA do not have to be
+decompressed on disk first.
+
+Decompression runs in a separate thread that puts decompressed chunks into a bounded queue; the parser takes them out of
+the queue on the other side. zlib releases the GIL while it decompresses, so the parser and the decompression really run
+at the same time, and the bounded queue keeps memory usage constant when the parser is slower.
+
+BGZF (the blocked gzip format produced by bgzip) is a series of independent gzip members of at most 64 KB, each of them
+storing its own compressed size in a header field. The blocks of a BGZF file can therefore be listed without
+decompressing them, and several processes can start decompressing at different blocks. A part that starts at a block
+boundary skips the incomplete record at its start, and the part before it reads past its last block to finish its last
+record, so every record is read exactly once.
+"""
+import collections
+import gzip
+import io
+import itertools
+import queue
+import threading
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+gzip_magic = b'\x1f\x8b'
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    ThreadedReader object reads another binary file object in a background thread and hands the data over through a
+    bounded queue of chunks.
+    """
+    def __init__(self, raw, chunk_size=1 << 20, buffered_chunks=16):
+        self.queue = queue.Queue(maxsize=buffered_chunks)
+        self.stop_event = threading.Event()
+        self.chunk = memoryview(b'')
+        self.finished = False
+        self.thread = threading.Thread(target=self.produce, args=(raw, chunk_size), daemon=True)
+        self.thread.start()
+
+    def produce(self, raw, chunk_size):
+        """
+        This function runs in the background thread and puts chunks of raw into the queue; an empty chunk marks the end
+        of the file and an exception is handed over to be raised by the reading side.
+        """
+        try:
+            while not self.stop_event.is_set():
+                chunk = raw.read(chunk_size)
+                self.put(chunk)
+                if not chunk:
+                    break
+        except Exception as error:
+            self.put(error)
+        finally:
+            raw.close()
+
+    def put(self, item):
+        """
+        This function waits for free space in the queue unless the reading side has been closed.
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.chunk:
+            if self.finished:
+                return 0
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self.finished = True
+                return 0
+            self.chunk = memoryview(item)
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+    def close(self):
+        self.stop_event.set()
+        super().close()
+
+
+def compression(filename):
+    """
+    This function detects how a file is compressed.
+
+    :param filename: the name of a file
+    :return: 'bgzf', 'gzip' or None for an uncompressed file
+    """
+    with open(filename, 'rb') as handle:
+        if handle.read(2) != gzip_magic:
+            return None
+        handle.seek(0)
+        return 'bgzf' if bgzf_block_size(handle) else 'gzip'
+
+
+def open_gzip(filename, threaded=True):
+    """
+    This function opens a gzip-compressed file (BGZF included) for reading decompressed bytes.
+
+    :param filename: the name of a gzip-compressed file or a binary file object, e.g. standard input
+    :param threaded: decompress in a background thread
+    :return: a binary file object
+    """
+    if threaded:
+        return io.BufferedReader(ThreadedReader(gzip.open(filename, 'rb')), buffer_size=1 << 20)
+    return gzip.open(filename, 'rb')
+
+
+def bgzf_block_size(handle):
+    """
+    This function reads the header of a BGZF block at the current position of a file.
+
+    :param handle: a binary file object
+    :return: total size of the compressed block in bytes, or None if there is no BGZF block at this position
+    """
+    header = handle.read(12)
+    if len(header) < 12 or header[:2] != gzip_magic or not header[3] & 4:
+        return None
+    extra_length = int.from_bytes(header[10:12], 'little')
+    extra = handle.read(extra_length)
+    position = 0
+    while position + 4 <= len(extra):
+        subfield_length = int.from_bytes(extra[position + 2:position + 4], 'little')
+        if extra[position:position + 2] == b'BC' and subfield_length == 2:
+            return int.from_bytes(extra[position + 4:position + 6], 'little') + 1
+        position += 4 + subfield_length
+    return None
+
+
+def bgzf_blocks(filename):
+    """
+    This function lists the blocks of a BGZF file by jumping from one block header to the next.
+
+    :param filename: the name of a BGZF file
+    :return: a list of tuples (compressed offset, decompressed size) of all blocks
+    """
+    blocks = []
+    with open(filename, 'rb') as handle:
+        offset = 0
+        while True:
+            handle.seek(offset)
+            block_size = bgzf_block_size(handle)
+            if block_size is None:
+                handle.seek(offset)
+                if handle.read(1):
+                    raise ValueError(filename + ' is not a valid BGZF file (offset ' + str(offset) + ')')
+                return blocks
+            # the last 4 bytes of a block store its decompressed size
+            handle.seek(offset + block_size - 4)
+            blocks.append((offset, int.from_bytes(handle.read(4), 'little')))
+            offset += block_size
+
+
+def split_bgzf(filename, shard_number):
+    """
+    This function divides a BGZF file into parts that start at block boundaries.
+
+    :param filename: the name of a BGZF file
+    :param shard_number: number of parts
+    :return: a list of tuples (start, end) in decompressed byte offsets
+    """
+    block_starts = list(itertools.accumulate([size for offset, size in bgzf_blocks(filename)], initial=0))
+    total_size = block_starts[-1]
+    boundaries = [0]
+    block = 0
+    for shard in range(1, shard_number):
+        target = total_size * shard // shard_number
+        while block_starts[block] < target:
+            block += 1
+        if block_starts[block] > boundaries[-1]:
+            boundaries.append(block_starts[block])
+    if total_size > boundaries[-1]:
+        boundaries.append(total_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_record_lines(lines, position=0, end=None, align=False):
+    """
+    This function passes on the lines of FASTQ records whose first line starts before end.
+
+    :param lines: an iterator of lines (bytes objects)
+    :param position: offset of the first line
+    :param end: offset at which no more records are started (None to read all records)
+    :param align: skip lines until the first record start ('@' line whose second next line starts with '+')
+    :return: a generator of lines
+    """
+    lookahead = collections.deque(itertools.islice(lines, 3))
+    if align:
+        while lookahead and not (len(lookahead) == 3 and lookahead[0][:1] == b'@' and lookahead[2][:1] == b'+'):
+            position += len(lookahead.popleft())
+            lookahead.extend(itertools.islice(lines, 3 - len(lookahead)))
+    while end is None or position < end:
+        lookahead.extend(itertools.islice(lines, 4 - len(lookahead)))
+        if not lookahead:
+            return
+        for _ in range(len(lookahead)):
+            line = lookahead.popleft()
+            position += len(line)
+            yield line
+
+
+def read_bgzf_lines(filename, start=0, end=None, threaded=True):
+    """
+    This function iterates over lines of the FASTQ records that start between two decompressed offsets of a BGZF file.
+
+    :param filename: the name of a BGZF file
+    :param start: a block boundary returned by split_bgzf
+    :param end: a block boundary returned by split_bgzf (None to read until the end of the file)
+    :param threaded: decompress in a background thread
+    :return: a generator of lines (bytes objects)
+    """
+    # decompression starts at the block that contains the byte before start, so that the reader can tell whether start
+    # is at a line start or in the middle of a line
+    compressed_offset = 0
+    skip = 0
+    if start:
+        block_start = 0
+        for offset, size in bgzf_blocks(filename):
+            if block_start + size >= start:
+                compressed_offset = offset
+                skip = start - 1 - block_start
+                break
+            block_start += size
+
+    with open(filename, 'rb') as raw_handle:
+        raw_handle.seek(compressed_offset)
+        decompressed = gzip.GzipFile(fileobj=raw_handle)
+        handle = io.BufferedReader(ThreadedReader(decompressed)) if threaded else decompressed
+        with handle:
+            position = 0
+            if start:
+                handle.read(skip)
+                position = len(handle.readline()) - 1
+            lines = iter(handle)
+            yield from read_record_lines(lines, position, None if end is None else end - start, align=bool(start))
@@ -0,0 +1,104 @@
+"""
+Tests of Checkpoint.py and of resuming runs with telemetry. Run with: python3 -m pytest test_Checkpoint.py
+"""
+import numpy as np
+import pytest
+import SyntheticFastq
+import Telemetry
+from Checkpoint import Checkpoint
+from SequenceDecomplexationOptimized import AllBarcode, Functions
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+read_number = 20000
+
+
+@pytest.fixture(scope='module')
+def fastq_lines(tmp_path_factory):
+    """
+    This function writes a synthetic FASTQ file and returns its lines.
+    """
+    filename = str(tmp_path_factory.mktemp('fastq') / 'synthetic.fastq')
+    SyntheticFastq.generate(filename, read_number, barcode_number=200)
+    with open(filename, 'rb') as handle:
+        return handle.readlines()
+
+
+def interrupted_run(tmp_path, fastq_lines, batch_size, telemetry=False):
+    """
+    This function runs a decomplexation that is interrupted after half of the reads and resumed from its checkpoint
+    (every 3000 reads). The interruption is simulated by writing only half of the reads before the first run.
+
+    :return: a tuple (AllBarcode object, read counts) of the resumed run and the number of telemetry records of the
+    interrupted run
+    """
+    filename = str(tmp_path / 'reads.fastq')
+    settings = {'file': filename, 'batch_size': batch_size}
+    telemetry_filename = str(tmp_path / 'telemetry.jsonl')
+    with open(filename, 'wb') as handle:
+        handle.writelines(fastq_lines[:len(fastq_lines) // 2])
+    interrupted_records = 0
+    for run in range(2):
+        if run:
+            with open(filename, 'ab') as handle:
+                handle.writelines(fastq_lines[len(fastq_lines) // 2:])
+            interrupted_records = len(Telemetry.read_records(telemetry_filename)) if telemetry else 0
+        checkpoint = Checkpoint(str(tmp_path / 'checkpoint.log'), settings, read_interval=3000)
+        result = Functions.collapse_fastq(filename, batch_size=batch_size, checkpoint=checkpoint,
+                                          telemetry=Telemetry.Telemetry(telemetry_filename, read_interval=1000)
+                                          if telemetry else None)
+    return result, interrupted_records
+
+
+@pytest.mark.parametrize('batch_size', [None, 1000])
+def test_resumed_run_is_the_same_as_a_full_run(tmp_path, fastq_lines, batch_size):
+    filename = str(tmp_path / 'full.fastq')
+    with open(filename, 'wb') as handle:
+        handle.writelines(fastq_lines)
+    expected_barcodes, expected_read_counts = Functions.collapse_fastq(filename, batch_size=batch_size)
+    (all_barcode_list, read_counts), interrupted_records = interrupted_run(tmp_path, fastq_lines, batch_size)
+    assert read_counts == expected_read_counts
+    assert all_barcode_list.counts.barcodes == expected_barcodes.counts.barcodes
+    assert np.array_equal(all_barcode_list.counts.counts, expected_barcodes.counts.counts)
+
+
+def test_partly_written_entry_is_ignored(tmp_path, fastq_lines):
+    filename = str(tmp_path / 'reads.fastq')
+    with open(filename, 'wb') as handle:
+        handle.writelines(fastq_lines)
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.log'), {'file': filename}, read_interval=3000)
+    Functions.collapse_fastq(filename, checkpoint=checkpoint)
+    with open(checkpoint.filename, 'ab') as handle:
+        handle.write(b'\x80\x05partly written')
+    restored = Checkpoint(checkpoint.filename, {'file': filename}).restore(AllBarcode())
+    assert restored is not None and restored[0]['all_reads'] == read_number - read_number % 3000
+
+
+def test_checkpoint_with_other_settings_is_refused(tmp_path, fastq_lines):
+    filename = str(tmp_path / 'reads.fastq')
+    with open(filename, 'wb') as handle:
+        handle.writelines(fastq_lines)
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.log'), {'file': filename, 'packed': False}, read_interval=3000)
+    Functions.collapse_fastq(filename, checkpoint=checkpoint)
+    with pytest.raises(ValueError):
+        Checkpoint(checkpoint.filename, {'file': filename, 'packed': True}).restore(AllBarcode())
+
+
+def test_resumed_telemetry_continues_the_interrupted_run(tmp_path, fastq_lines):
+    resumed = interrupted_run(tmp_path, fastq_lines, None, telemetry=True)[1]
+    records = Telemetry.read_records(str(tmp_path / 'telemetry.jsonl'))
+    # records of the interrupted run are kept and elapsed times go on from its last record
+    assert 0 < resumed < len(records)
+    assert records[resumed - 1]['reads'] == read_number // 2
+    elapsed = [entry['elapsed'] for entry in records]
+    assert elapsed == sorted(elapsed)
+    # the first interval of the resumed run only counts the reads after the checkpoint at 9000 reads
+    interval = elapsed[resumed] - elapsed[resumed - 1]
+    assert records[resumed]['reads'] == 10000
+    assert records[resumed]['reads_per_second'] == pytest.approx(1000 / interval, rel=0.05)
+    report = Telemetry.run_report(records)
+    assert report['read_counts']['all_reads'] == read_number
+    assert report['elapsed'] == elapsed[-1]
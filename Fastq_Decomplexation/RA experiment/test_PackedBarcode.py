@@ -0,0 +1,86 @@
+"""
+Tests of PackedBarcode.py against comparisons of barcode strings. Run with: python3 -m pytest test_PackedBarcode.py
+"""
+import numpy as np
+import pytest
+import PackedBarcode
+from SequenceDecomplexationOptimized import Functions
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+
+def random_barcodes(barcode_number, barcode_length=30, seed=0):
+    """
+    This function draws random barcodes from a few templates with random bases (N included) replaced, so that both
+    close and distant pairs of barcodes occur. Barcodes drawn with different seeds share the same templates.
+    """
+    template_rng = np.random.default_rng(barcode_length)
+    templates = [template_rng.choice(list('ACGT'), barcode_length) for _ in range(5)]
+    rng = np.random.default_rng(seed)
+    barcodes = []
+    for _ in range(barcode_number):
+        bases = templates[rng.integers(len(templates))].copy()
+        positions = rng.choice(barcode_length, int(rng.integers(barcode_length // 3)), replace=False)
+        bases[positions] = rng.choice(list('ACGTN'), len(positions))
+        barcodes.append(''.join(bases))
+    return barcodes
+
+
+@pytest.mark.parametrize('barcode_length', [5, 30, 32])
+def test_decode_restores_encoded_barcodes(barcode_length):
+    barcodes = random_barcodes(200, barcode_length) + ['N' * barcode_length, 'T' * barcode_length]
+    codes, n_masks = PackedBarcode.encode(barcodes)
+    assert codes.dtype == np.uint64 and n_masks.dtype == np.uint64
+    assert PackedBarcode.decode(codes, n_masks, barcode_length) == barcodes
+
+
+def test_encode_matrix_is_the_same_as_encode_list():
+    barcodes = random_barcodes(50)
+    barcode_matrix = np.frombuffer(''.join(barcodes).encode('ascii'), dtype=np.uint8).reshape(-1, 30)
+    for packed, packed_from_matrix in zip(PackedBarcode.encode(barcodes), PackedBarcode.encode(barcode_matrix)):
+        assert np.array_equal(packed, packed_from_matrix)
+
+
+def test_other_characters_are_encoded_as_n():
+    codes, n_masks = PackedBarcode.encode(['ACGT.', 'ACGTN'])
+    assert codes[0] == codes[1] and n_masks[0] == n_masks[1]
+
+
+def test_hamming_distance_is_the_same_as_string_comparison():
+    barcodes = random_barcodes(300)
+    codes, n_masks = PackedBarcode.encode(barcodes)
+    distances = PackedBarcode.pairwise_hamming_distance(codes, n_masks, codes, n_masks)
+    expected = [[Functions.hamming_distance(barcode_1, barcode_2) for barcode_2 in barcodes] for barcode_1 in barcodes]
+    assert np.array_equal(distances, np.array(expected))
+    # one-vs-many comparison broadcasts the same way
+    assert np.array_equal(PackedBarcode.hamming_distance(codes[7], n_masks[7], codes, n_masks), distances[7])
+
+
+def test_popcount_counts_set_bits():
+    values = np.random.default_rng(0).integers(0, 2 ** 63, 1000, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    values = np.concatenate([values, np.array([0, 2 ** 64 - 1], dtype=np.uint64)])
+    assert [int(count) for count in PackedBarcode.popcount(values)] == [bin(int(value)).count('1') for value in values]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1024])
+def test_first_match_finds_the_first_barcode_within_distance(chunk_size):
+    barcodes_1 = random_barcodes(200, seed=1)
+    barcodes_2 = random_barcodes(100, seed=2)
+    matches = PackedBarcode.first_match(*PackedBarcode.encode(barcodes_1), *PackedBarcode.encode(barcodes_2),
+                                        max_distance=5, chunk_size=chunk_size)
+    expected = []
+    for barcode_1 in barcodes_1:
+        positions = [position for position, barcode_2 in enumerate(barcodes_2)
+                     if Functions.hamming_distance(barcode_1, barcode_2) <= 5]
+        expected.append(positions[0] if positions else -1)
+    assert matches.tolist() == expected
+    assert 0 < (matches >= 0).sum() < len(barcodes_1)
+
+
+def test_first_match_without_barcodes():
+    codes, n_masks = PackedBarcode.encode(random_barcodes(10))
+    empty_codes, empty_n_masks = PackedBarcode.encode([])
+    assert PackedBarcode.first_match(codes, n_masks, empty_codes, empty_n_masks).tolist() == [-1] * 10
@@ -0,0 +1,145 @@
+"""
+BarcodeIndex keeps collapsed barcodes in a pigeonhole block index so that a new barcode only has to be compared with
+barcodes that can possibly be within our Hamming distance threshold.
+
+If two barcodes differ in at most d positions, then splitting both of them into d + 1 blocks at the same positions
+guarantees that at least one pair of blocks is identical. For our 30-bp barcodes and the <= 5 mismatch rule, a barcode
+is split into six 5-bp blocks and every block is used as a key of a dictionary. Only barcodes sharing at least one block
+with a new barcode are compared with it.
+
+Example:
+
+    Barcode:  AGTGA NTGTG TCTGA CAGTC AGTGA CTGAC
+    Block:      0     1     2     3     4     5
+
+Barcodes are numbered in the order they are added, so the index can return the earliest added barcode within the
+threshold – exactly the barcode that a linear scan over an insertion-ordered dictionary would find first.
+
+A fixed set of known barcodes (a whitelist) can also be indexed once, and a read is then assigned to the nearest
+indexed barcode instead of the earliest one (see nearest).
+
+With packed=True, barcodes are also stored as 2-bit codes (see PackedBarcode.py) and candidates are compared with the
+XOR/popcount kernel instead of character by character.
+"""
+from operator import ne
+import numpy as np
+import PackedBarcode
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+
+class BarcodeIndex:
+    """
+    BarcodeIndex object contains a list of barcodes in the order they are added and one dictionary per block that maps
+    a block sequence to the ids of barcodes carrying that block.
+    """
+    def __init__(self, barcode_length=30, max_distance=5, packed=False):
+        self.barcode_length = barcode_length
+        self.max_distance = max_distance
+        self.barcodes = []
+        self.packed = packed
+        if packed:
+            # packed codes are kept in arrays whose capacity doubles when they are full
+            self.codes = np.zeros(1024, dtype=np.uint64)
+            self.n_masks = np.zeros(1024, dtype=np.uint64)
+
+        # split barcode positions into (max_distance + 1) blocks with nearly equal lengths
+        block_number = max_distance + 1
+        boundaries = [barcode_length * block // block_number for block in range(block_number + 1)]
+        self.block_slices = [slice(start, end) for start, end in zip(boundaries[:-1], boundaries[1:])]
+        self.block_tables = [{} for _ in range(block_number)]
+
+    def __len__(self):
+        return len(self.barcodes)
+
+    def add(self, barcode):
+        """
+        This function adds a barcode to the index without checking whether a similar barcode already exists.
+
+        :param barcode: a barcode sequence (str object)
+        :return: id of the added barcode (int object)
+        """
+        assert (len(barcode) == self.barcode_length), "Barcode must have length " + str(self.barcode_length) + "!"
+        barcode_id = len(self.barcodes)
+        self.barcodes.append(barcode)
+        if self.packed:
+            if barcode_id == len(self.codes):
+                self.codes = np.concatenate([self.codes, np.zeros_like(self.codes)])
+                self.n_masks = np.concatenate([self.n_masks, np.zeros_like(self.n_masks)])
+            codes, n_masks = PackedBarcode.encode([barcode])
+            self.codes[barcode_id] = codes[0]
+            self.n_masks[barcode_id] = n_masks[0]
+        for block_slice, block_table in zip(self.block_slices, self.block_tables):
+            block_table.setdefault(barcode[block_slice], []).append(barcode_id)
+        return barcode_id
+
+    def candidates(self, barcode):
+        """
+        This function finds ids of all indexed barcodes that share at least one block with a given barcode.
+
+        :param barcode: a barcode sequence (str object)
+        :return: a sorted list of barcode ids
+        """
+        candidate_set = set()
+        for block_slice, block_table in zip(self.block_slices, self.block_tables):
+            bucket = block_table.get(barcode[block_slice])
+            if bucket:
+                candidate_set.update(bucket)
+        return sorted(candidate_set)
+
+    def find(self, barcode):
+        """
+        This function finds the earliest added barcode that is within the Hamming distance threshold of a given barcode.
+
+        :param barcode: a barcode sequence (str object)
+        :return: the matched barcode (str object) or None if there is no barcode within the threshold
+        """
+        assert (len(barcode) == self.barcode_length), "Barcode must have length " + str(self.barcode_length) + "!"
+        barcodes = self.barcodes
+        max_distance = self.max_distance
+        if self.packed:
+            candidate_ids = np.array(self.candidates(barcode), dtype=np.intp)
+            codes, n_masks = PackedBarcode.encode([barcode])
+            within_distance = PackedBarcode.hamming_distance(codes[0], n_masks[0], self.codes[candidate_ids],
+                                                             self.n_masks[candidate_ids]) <= max_distance
+            if within_distance.any():
+                return barcodes[candidate_ids[within_distance.argmax()]]
+            return None
+        for barcode_id in self.candidates(barcode):
+            if sum(map(ne, barcodes[barcode_id], barcode)) <= max_distance:
+                return barcodes[barcode_id]
+        return None
+
+    def nearest(self, barcode):
+        """
+        This function finds the indexed barcode with the fewest differences from a given barcode within the Hamming
+        distance threshold; ties are broken in favour of the earliest added barcode.
+
+        :param barcode: a barcode sequence (str object)
+        :return: id of the nearest barcode (int object) or None if there is no barcode within the threshold
+        """
+        assert (len(barcode) == self.barcode_length), "Barcode must have length " + str(self.barcode_length) + "!"
+        candidate_ids = self.candidates(barcode)
+        if not candidate_ids:
+            return None
+        if self.packed:
+            candidate_ids = np.array(candidate_ids, dtype=np.intp)
+            codes, n_masks = PackedBarcode.encode([barcode])
+            distances = PackedBarcode.hamming_distance(codes[0], n_masks[0], self.codes[candidate_ids],
+                                                       self.n_masks[candidate_ids])
+            closest = int(distances.argmin())
+            return int(candidate_ids[closest]) if distances[closest] <= self.max_distance else None
+        barcodes = self.barcodes
+        nearest_id = None
+        nearest_distance = self.max_distance + 1
+        for barcode_id in candidate_ids:
+            distance = sum(map(ne, barcodes[barcode_id], barcode))
+            if distance < nearest_distance:
+                nearest_id = barcode_id
+                nearest_distance = distance
+                if distance == 0:
+                    break
+        return nearest_id
@@ -0,0 +1,248 @@
+"""
+ClusterMembership records which barcodes of the reads (members) were collapsed into which collapsed barcode
+(representative), so that the collapse can be audited afterwards without decomplexing the FASTQ file again.
+
+Membership is kept as three parallel arrays with one element per (representative, member) pair:
+
+    representative : row of the collapsed barcode in the raw read table (-1 for reads left out with a whitelist)
+    member         : member barcode packed into a uint64 code and a uint64 N mask (see PackedBarcode.py)
+    reads          : number of reads of the member counted in the representative
+
+With collapse='greedy', the collapse appends one entry per added read (or per unique read of a block). Appends only go
+to Python lists; every buffer_size entries, the buffered barcodes are packed at once with NumPy and copied into the
+arrays, whose capacity is doubled when they are full. Before they grow, repeated pairs are merged (compact), so memory
+grows with the number of distinct pairs rather than with the number of reads. With collapse='abundance' or 'graph',
+the whole membership is known when exact barcodes are clustered and is added with one array operation.
+
+The membership is saved as a columnar side file next to the raw read files:
+
+    output_membership.npz     : the arrays above plus 'representative_barcodes' (collapsed barcodes in the order of
+                                rows)
+    output_membership.parquet : the same columns; collapsed barcodes are embedded in the metadata of the table
+
+pyarrow is only needed for Parquet files.
+"""
+import json
+import numpy as np
+import pandas as pd
+import PackedBarcode
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+membership_formats = ['npz', 'parquet']
+membership_extensions = {'npz': '.npz', 'parquet': '.parquet'}
+metadata_key = b'representative_barcodes'
+
+
+class MembershipLog:
+    """
+    MembershipLog object contains growable parallel arrays of (representative, packed member barcode, reads) and a
+    buffer of entries that are not packed yet.
+    """
+    def __init__(self, barcode_length=30, capacity=1 << 16, buffer_size=1 << 16):
+        self.barcode_length = barcode_length
+        self.buffer_size = buffer_size
+        self.representatives = np.zeros(capacity, dtype=np.int64)
+        self.codes = np.zeros(capacity, dtype=np.uint64)
+        self.n_masks = np.zeros(capacity, dtype=np.uint64)
+        self.reads = np.zeros(capacity, dtype=np.int64)
+        self.size = 0
+        self.buffer_representatives = []
+        self.buffer_barcodes = []
+        self.buffer_reads = []
+
+    def __len__(self):
+        return self.size + len(self.buffer_barcodes)
+
+    def __getstate__(self):
+        # only used entries are pickled, e.g. when a MembershipLog is sent from a worker process
+        self.compact()
+        state = self.__dict__.copy()
+        for name in ['representatives', 'codes', 'n_masks', 'reads']:
+            state[name] = state[name][:self.size].copy()
+        return state
+
+    def append(self, representative, barcode, reads):
+        """
+        This function records reads of a member barcode collapsed into a representative.
+
+        :param representative: row of the representative (-1 if the reads are left out)
+        :param barcode: the member barcode (str object)
+        :param reads: number of reads
+        """
+        self.buffer_representatives.append(representative)
+        self.buffer_barcodes.append(barcode)
+        self.buffer_reads.append(reads)
+        if len(self.buffer_barcodes) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        This function packs the buffered entries and copies them into the arrays.
+        """
+        if not self.buffer_barcodes:
+            return
+        codes, n_masks = PackedBarcode.encode(self.buffer_barcodes)
+        representatives = np.array(self.buffer_representatives, dtype=np.int64)
+        reads = np.array(self.buffer_reads, dtype=np.int64)
+        self.buffer_representatives = []
+        self.buffer_barcodes = []
+        self.buffer_reads = []
+        self.extend(representatives, codes, n_masks, reads)
+
+    def extend(self, representatives, codes, n_masks, reads):
+        """
+        This function adds packed entries to the arrays, merging repeated pairs or growing the arrays if they are full.
+
+        :param representatives: an int64 array of rows of representatives
+        :param codes: a uint64 array of codes of member barcodes
+        :param n_masks: a uint64 array of N masks of member barcodes
+        :param reads: an int64 array of numbers of reads
+        """
+        if self.size + len(codes) > len(self.codes):
+            self.compact_arrays()
+            # arrays that are still more than half full after merging repeated pairs are doubled
+            if 2 * (self.size + len(codes)) > len(self.codes):
+                self.resize(max(2 * len(self.codes), self.size + len(codes)))
+        end = self.size + len(codes)
+        self.representatives[self.size:end] = representatives
+        self.codes[self.size:end] = codes
+        self.n_masks[self.size:end] = n_masks
+        self.reads[self.size:end] = reads
+        self.size = end
+
+    def extend_barcodes(self, representatives, barcodes, reads):
+        """
+        This function adds entries of member barcodes given as str objects (see extend).
+        """
+        codes, n_masks = PackedBarcode.encode(list(barcodes))
+        self.extend(np.asarray(representatives, dtype=np.int64), codes, n_masks, np.asarray(reads, dtype=np.int64))
+
+    def resize(self, capacity):
+        """
+        This function copies the arrays into arrays with a new capacity.
+        """
+        for name in ['representatives', 'codes', 'n_masks', 'reads']:
+            array = getattr(self, name)
+            resized = np.zeros(capacity, dtype=array.dtype)
+            resized[:self.size] = array[:self.size]
+            setattr(self, name, resized)
+
+    def compact_arrays(self):
+        """
+        This function merges repeated (representative, member) pairs of the arrays and sorts entries by representative
+        and member.
+        """
+        if not self.size:
+            return
+        representatives = self.representatives[:self.size]
+        codes = self.codes[:self.size]
+        n_masks = self.n_masks[:self.size]
+        order = np.lexsort((n_masks, codes, representatives))
+        representatives = representatives[order]
+        codes = codes[order]
+        n_masks = n_masks[order]
+        reads = self.reads[:self.size][order]
+        first = np.ones(self.size, dtype=bool)
+        first[1:] = (representatives[1:] != representatives[:-1]) | (codes[1:] != codes[:-1]) | \
+            (n_masks[1:] != n_masks[:-1])
+        starts = np.flatnonzero(first)
+        self.size = len(starts)
+        self.representatives[:self.size] = representatives[starts]
+        self.codes[:self.size] = codes[starts]
+        self.n_masks[:self.size] = n_masks[starts]
+        self.reads[:self.size] = np.add.reduceat(reads, starts)
+
+    def compact(self):
+        """
+        This function packs the buffer and merges repeated pairs, so that every pair has one entry.
+        """
+        self.flush()
+        self.compact_arrays()
+
+    def merge(self, membership, rows):
+        """
+        This function adds the entries of another MembershipLog whose representatives have been collapsed into this
+        collapse, e.g. from another part of the same fastq file.
+
+        :param membership: a MembershipLog object
+        :param rows: an array that maps rows of the representatives of membership to rows of this collapse (-1 for
+        representatives left out)
+        """
+        membership.compact()
+        representatives = membership.representatives[:membership.size]
+        rows = np.asarray(rows, dtype=np.int64)
+        self.extend(np.where(representatives >= 0, rows[np.maximum(representatives, 0)], -1),
+                    membership.codes[:membership.size], membership.n_masks[:membership.size],
+                    membership.reads[:membership.size])
+
+    def arrays(self):
+        """
+        This function returns the membership with one entry per pair.
+
+        :return: a dictionary of arrays (representative, member_code, member_n_mask, reads)
+        """
+        self.compact()
+        return {'representative': self.representatives[:self.size], 'member_code': self.codes[:self.size],
+                'member_n_mask': self.n_masks[:self.size], 'reads': self.reads[:self.size]}
+
+    def save(self, filename, representatives):
+        """
+        This function saves the membership as a columnar file; the format is chosen by the extension of filename.
+
+        :param filename: a .npz or .parquet file
+        :param representatives: collapsed barcodes (str objects) in the order of their rows
+        """
+        arrays = self.arrays()
+        if filename.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            metadata = {metadata_key: json.dumps(list(representatives)).encode(),
+                        b'barcode_length': str(self.barcode_length).encode()}
+            pq.write_table(pa.table(arrays).replace_schema_metadata(metadata), filename)
+        else:
+            with open(filename, 'wb') as handle:
+                np.savez_compressed(handle, representative_barcodes=np.array(representatives, dtype=str),
+                                    barcode_length=self.barcode_length, **arrays)
+
+
+def save_membership(membership, output_prefix, representatives, membership_format='npz'):
+    """
+    This function saves a membership as output_prefix + '_membership' with the extension of membership_format.
+
+    :return: the name of the saved file
+    """
+    filename = str(output_prefix) + '_membership' + membership_extensions[membership_format]
+    membership.save(filename, representatives)
+    return filename
+
+
+def read_membership(filename):
+    """
+    This function reads a membership saved by MembershipLog.save with unpacked barcodes, e.g. to see which barcodes
+    were collapsed into a collapsed barcode.
+
+    :param filename: a .npz or .parquet file
+    :return: a DataFrame with one row per (representative, member) pair and the columns representative (row),
+    representative_barcode (None for reads left out), member_barcode and reads
+    """
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(filename)
+        representatives = json.loads(table.schema.metadata[metadata_key])
+        barcode_length = int(table.schema.metadata[b'barcode_length'])
+        arrays = {name: table.column(name).to_numpy() for name in table.column_names}
+    else:
+        with np.load(filename, allow_pickle=False) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        representatives = arrays.pop('representative_barcodes').tolist()
+        barcode_length = int(arrays.pop('barcode_length'))
+    representative_barcodes = np.array(representatives + [None], dtype=object)
+    return pd.DataFrame({'representative': arrays['representative'],
+                         'representative_barcode': representative_barcodes[arrays['representative']],
+                         'member_barcode': PackedBarcode.decode(arrays['member_code'], arrays['member_n_mask'],
+                                                                barcode_length),
+                         'reads': arrays['reads']})
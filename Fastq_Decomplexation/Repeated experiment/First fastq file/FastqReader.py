@@ -0,0 +1,303 @@
+"""
+FastqReader reads FASTQ files without building Biopython SeqRecord objects.
+
+Bio.SeqIO creates a SeqRecord, a Seq and a list of Phred scores for every read, although the decomplexation only needs
+the first 129 bases and the Phred scores of the barcode region. This module iterates over the four lines of each record
+and returns them as raw bytes. Phred scores are decoded directly from the quality bytes by subtracting the ASCII offset.
+
+Biopython is still available as a fallback (parser='biopython') to validate results of the native parser.
+
+A file can also be divided into byte ranges that start at record boundaries, so that several processes can read
+different parts of the same file without splitting it into smaller files first.
+
+gzip-compressed files (.fastq.gz) are decompressed on the fly by GzipInput. A BGZF file (compressed with bgzip) is
+divided into ranges of decompressed offsets at block boundaries, so it can be read by several processes as well; a plain
+gzip file cannot be divided and is read as one range.
+
+Reads can also be streamed from standard input ('-') or a named pipe, e.g. from fasterq-dump or a decompressor, without
+writing the FASTQ file to disk. A stream is read once from the start, so it cannot be divided.
+
+A LineCounter keeps track of the offset of the next record, so that a run can be resumed from there (see Checkpoint.py).
+
+Uncompressed files can also be read through a memory map (parser='mmap', see MappedFastq.py), which hands sequences and
+quality strings over as memoryview slices of the mapping instead of bytes objects.
+"""
+import io
+import os
+import stat
+import sys
+import GzipInput
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+# Sanger/Illumina 1.8+ quality scores are encoded as ASCII characters starting from '!' (33)
+phred_offset = 33
+
+parser_choices = ['native', 'biopython', 'mmap']
+
+
+class LineCounter:
+    """
+    LineCounter object passes on lines of a FASTQ file and adds up their lengths, so that the offset of the next record
+    is known whenever a whole record has been read.
+    """
+    def __init__(self, lines, position=0):
+        self.lines = lines
+        self.position = position
+
+    def __iter__(self):
+        for line in self.lines:
+            self.position += len(line)
+            yield line
+
+
+def iterate_fastq(handle):
+    """
+    This function iterates over records of a FASTQ file opened in binary mode.
+
+    :param handle: a binary file object
+    :return: a generator of tuples (title, sequence, quality); all of them are bytes objects without line endings
+    """
+    lines = iter(handle)
+    for title in lines:
+        # ignore blank lines at the end of a file
+        if not title.strip():
+            continue
+        sequence = next(lines, b'').rstrip()
+        separator = next(lines, b'')
+        quality = next(lines, b'').rstrip()
+        if title[:1] != b'@' or separator[:1] != b'+' or len(sequence) != len(quality):
+            raise ValueError('Invalid FASTQ record: ' + title.rstrip().decode(errors='replace'))
+        yield title[1:].rstrip(), sequence, quality
+
+
+def iterate_records(lines):
+    """
+    This function groups lines of a FASTQ file into records without parsing them. Blank lines between records are
+    skipped as in iterate_fastq, so that they do not shift the lines of the following records.
+
+    :param lines: an iterator of lines (bytes objects), e.g. from open_lines
+    :return: a generator of records (bytes objects of four lines with their line endings)
+    """
+    for title in lines:
+        if not title.strip():
+            continue
+        yield b''.join((title, next(lines, b''), next(lines, b''), next(lines, b'')))
+
+
+def read_lines(handle, start=0, end=None):
+    """
+    This function iterates over lines of a binary file object between two byte offsets.
+
+    :param handle: a binary file object
+    :param start: byte offset of the first line
+    :param end: byte offset at which reading stops (None to read until the end of the file); it must be a line start
+    :return: a generator of lines (bytes objects)
+    """
+    if start:
+        handle.seek(start)
+    if end is None:
+        yield from handle
+        return
+    position = start
+    for line in handle:
+        if position >= end:
+            return
+        position += len(line)
+        yield line
+
+
+def find_record_start(handle, offset):
+    """
+    This function finds the first FASTQ record that starts at or after a byte offset.
+
+    A record start is a line starting with '@' whose second next line starts with '+'. A quality line may also start
+    with '@', but then its second next line is a sequence, so this rule cannot be fooled.
+
+    :param handle: a binary file object
+    :param offset: byte offset to start searching from
+    :return: byte offset of the record start (or the file size if there is no record after offset)
+    """
+    handle.seek(offset)
+    if offset:
+        # the offset may be in the middle of a line, so skip to the next line start (or the end of this line)
+        handle.seek(offset - 1)
+        handle.readline()
+    while True:
+        position = handle.tell()
+        first_line = handle.readline()
+        if not first_line:
+            return position
+        handle.readline()
+        third_line = handle.readline()
+        if first_line[:1] == b'@' and third_line[:1] == b'+':
+            return position
+        handle.seek(position)
+        handle.readline()
+
+
+def is_stream(filename):
+    """
+    This function checks whether a FASTQ file is standard input or a named pipe, which can only be read once.
+
+    :param filename: the name of a FASTQ file ('-' for standard input)
+    :return: True for standard input or a named pipe
+    """
+    return filename == '-' or stat.S_ISFIFO(os.stat(filename).st_mode)
+
+
+def open_fastq(filename):
+    """
+    This function opens a FASTQ file in binary mode and decompresses it on the fly if it is gzip-compressed.
+
+    :param filename: the name of a FASTQ file (uncompressed, gzip or BGZF), '-' for standard input or a named pipe
+    :return: a binary file object
+    """
+    if is_stream(filename):
+        # a stream cannot be opened twice, so compression is detected by peeking at its first bytes
+        handle = sys.stdin.buffer if filename == '-' else open(filename, 'rb')
+        if handle.peek(2)[:2] == GzipInput.gzip_magic:
+            return GzipInput.open_gzip(handle)
+        return handle
+    if GzipInput.compression(filename):
+        return GzipInput.open_gzip(filename)
+    return open(filename, 'rb')
+
+
+def open_lines(filename, start=0, end=None):
+    """
+    This function iterates over lines of the FASTQ records in a range returned by split_file.
+
+    :param filename: the name of a FASTQ file (uncompressed, gzip or BGZF), '-' for standard input or a named pipe
+    :param start: offset of the first record to read
+    :param end: offset of the record after the last record to read (None to read until the end of the file)
+    :return: a generator of lines (bytes objects)
+    """
+    if is_stream(filename):
+        if start or end is not None:
+            raise ValueError('A part of a stream cannot be read: ' + filename)
+        with open_fastq(filename) as handle:
+            yield from handle
+        return
+    file_compression = GzipInput.compression(filename)
+    if file_compression == 'bgzf':
+        yield from GzipInput.read_bgzf_lines(filename, start, end)
+        return
+    if file_compression == 'gzip' and end is not None:
+        raise ValueError('A part of a gzip file can only be read if it is compressed with bgzip: ' + filename)
+    if file_compression == 'gzip' and start:
+        # the rest of a gzip file (e.g. to resume a run) is found by decompressing it up to start
+        with GzipInput.open_gzip(filename, threaded=False) as handle:
+            yield from read_lines(handle, start)
+        return
+    with open_fastq(filename) as handle:
+        yield from read_lines(handle, start, end)
+
+
+def split_file(filename, shard_number):
+    """
+    This function divides a FASTQ file into byte ranges that start at record boundaries without parsing the whole file.
+
+    A BGZF file is divided at block boundaries in decompressed offsets instead (records are aligned while reading), and
+    a plain gzip file or a stream is returned as a single range.
+
+    :param filename: the name of a FASTQ file
+    :param shard_number: number of ranges
+    :return: a list of tuples (start, end); ranges that would be empty are left out
+    """
+    if is_stream(filename):
+        return [(0, None)]
+    file_compression = GzipInput.compression(filename)
+    if file_compression == 'bgzf':
+        return GzipInput.split_bgzf(filename, shard_number)
+    if file_compression == 'gzip':
+        return [(0, None)]
+    file_size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, 'rb') as handle:
+        for shard in range(1, shard_number):
+            boundary = find_record_start(handle, file_size * shard // shard_number)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    if file_size > boundaries[-1]:
+        boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def phred_sum(quality, start=0, end=30):
+    """
+    This function decodes Phred scores of a slice of a quality string and sums them up.
+
+    :param quality: a quality string of a read (bytes object)
+    :param start: first position of the slice
+    :param end: position after the last position of the slice
+    :return: sum of Phred scores (int object)
+    """
+    quality_slice = quality[start:end]
+    return sum(quality_slice) - phred_offset * len(quality_slice)
+
+
+def iterate_blocks(filename, block_size, start=0, end=None, lines=None, parser='native'):
+    """
+    This function reads a FASTQ file in blocks of reads.
+
+    :param filename: the name of a FASTQ file (uncompressed, gzip or BGZF), '-' for standard input or a named pipe
+    :param block_size: maximum number of reads in each block
+    :param start: byte offset of the first record to read
+    :param end: byte offset of the record after the last record to read (None to read until the end of the file)
+    :param lines: lines to read instead of the lines of open_lines(filename, start, end), e.g. a LineCounter
+    :param parser: 'mmap' to map an uncompressed file (see MappedFastq.py); any other parser uses iterate_fastq
+    :return: a generator of tuples (list of sequences, list of quality strings); all of them are bytes objects (or
+    memoryview objects with parser='mmap')
+    """
+    if parser == 'mmap':
+        import MappedFastq
+        yield from MappedFastq.iterate_blocks(filename, block_size, start, end)
+        return
+    sequences = []
+    qualities = []
+    for title, sequence, quality in iterate_fastq(lines or open_lines(filename, start, end)):
+        sequences.append(sequence)
+        qualities.append(quality)
+        if len(sequences) == block_size:
+            yield sequences, qualities
+            sequences = []
+            qualities = []
+    if sequences:
+        yield sequences, qualities
+
+
+def iterate_reads(filename, parser='native', read_length=129, barcode_length=30, start=0, end=None, lines=None):
+    """
+    This function reads a FASTQ file and returns what the decomplexation needs from every read.
+
+    :param filename: the name of a FASTQ file (uncompressed, gzip or BGZF), '-' for standard input or a named pipe
+    :param parser: 'native' to use iterate_fastq, 'biopython' to use Bio.SeqIO or 'mmap' to map an uncompressed file
+    (see MappedFastq.py)
+    :param read_length: number of bases at the start of a read that are returned
+    :param barcode_length: number of bases at the start of a read whose Phred scores are summed
+    :param start: byte offset of the first record to read (native and mmap parsers only)
+    :param end: byte offset of the record after the last record to read (native and mmap parsers only)
+    :param lines: lines to read instead of the lines of open_lines(filename, start, end), e.g. a LineCounter (native
+    parser only)
+    :return: a generator of tuples (first read_length bases (str object), sum of Phred scores of the barcode region)
+    """
+    if parser == 'native':
+        for title, sequence, quality in iterate_fastq(lines or open_lines(filename, start, end)):
+            yield sequence[:read_length].decode('ascii'), phred_sum(quality, 0, barcode_length)
+    elif parser == 'mmap':
+        import MappedFastq
+        yield from MappedFastq.iterate_reads(filename, read_length, barcode_length, start, end)
+    elif start or end is not None:
+        raise ValueError('Only the native parser can read a part of a FASTQ file')
+    elif parser == 'biopython':
+        from Bio import SeqIO
+        with io.TextIOWrapper(open_fastq(filename)) as handle:
+            for seq_record in SeqIO.parse(handle, 'fastq'):
+                yield str(seq_record.seq[:read_length]), \
+                    sum(seq_record.letter_annotations['phred_quality'][:barcode_length])
+    else:
+        raise ValueError('Unknown FASTQ parser: ' + str(parser))
@@ -0,0 +1,318 @@
+"""
+MappedFastq reads uncompressed FASTQ files through a memory map instead of reading them line by line.
+
+The file is mapped into memory once and viewed as a NumPy uint8 array without copying it. Record boundaries are found by
+searching a whole chunk of the mapping for newlines at once (np.flatnonzero), and every fourth newline ends a record:
+
+    @title\\n sequence\\n +\\n quality\\n @title\\n ...
+           0          1   2          3        4        <- newline number in the chunk
+
+Blank lines between records are left out before newlines are grouped, as FastqReader.iterate_fastq skips them.
+
+With --batch-size, a block of reads is handed over to the quality control as two RecordSlices objects (sequences and
+quality strings) that only hold the offsets of the lines in the mapping. The quality control gathers the bases it needs
+into its matrices with NumPy straight from the mapping (see BatchQualityControl.to_matrix), so no Python object is
+created per line; a single line is only sliced out of the mapping as a zero-copy memoryview when it is asked for, e.g.
+by the anchor search. Without --batch-size, the Phred sums of the barcode regions of a whole chunk are computed at once
+as well.
+
+A mapping can be divided into ranges that start at record boundaries (see split), and every worker process maps the
+file itself and only reads its own range; the operating system shares the pages between them.
+
+Compressed files and streams cannot be mapped; use the native parser for them. Pages of the mapping that have been
+read count towards the resident memory of a process, but they belong to the page cache and are given back whenever
+memory is needed.
+"""
+import mmap
+import os
+import numpy as np
+import FastqReader
+import GzipInput
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+# bytes of the mapping searched for newlines at once
+chunk_size = 1 << 24
+# rows of a block gathered into a matrix at once, which bounds the size of the temporary arrays of RecordSlices.matrix
+gather_rows = 8192
+newline = ord('\n')
+
+
+class RecordSlices:
+    """
+    RecordSlices object is a read-only list of the lines (sequences or quality strings) of a block of records, stored as
+    offsets in a mapping.
+    """
+    def __init__(self, buffer, array, starts, ends):
+        """
+        :param buffer: a memoryview of the mapping
+        :param array: a NumPy uint8 view of the mapping
+        :param starts: offsets of the first bytes of the lines (int64 array)
+        :param ends: offsets after the last bytes of the lines (int64 array)
+        """
+        self.buffer = buffer
+        self.array = array
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, item):
+        """
+        This function slices one line out of the mapping.
+
+        :param item: number of the line
+        :return: a memoryview object
+        """
+        return self.buffer[int(self.starts[item]):int(self.ends[item])]
+
+    def __iter__(self):
+        for item in range(len(self)):
+            yield self[item]
+
+    def matrix(self, width, fill=0):
+        """
+        This function gathers the first bytes of every line into a uint8 matrix (see BatchQualityControl.to_matrix).
+
+        :param width: number of columns; longer lines are truncated and shorter ones are padded with fill
+        :param fill: value used to pad shorter lines
+        :return: a NumPy uint8 matrix with shape (len(self), width)
+        """
+        matrix = np.empty((len(self), width), dtype=np.uint8)
+        columns = np.arange(width)
+        last = len(self.array) - 1
+        for row in range(0, len(self), gather_rows):
+            starts = self.starts[row:row + gather_rows]
+            ends = self.ends[row:row + gather_rows]
+            positions = starts[:, None] + columns
+            if (ends - starts >= width).all():
+                matrix[row:row + gather_rows] = self.array[positions]
+            else:
+                inside = positions < ends[:, None]
+                matrix[row:row + gather_rows] = np.where(inside, self.array[np.minimum(positions, last)], fill)
+        return matrix
+
+
+class MappedFastq:
+    """
+    MappedFastq object holds a read-only memory map of an uncompressed FASTQ file, a memoryview and a NumPy view of it.
+    """
+    def __init__(self, filename):
+        """
+        :param filename: the name of an uncompressed FASTQ file
+        """
+        if FastqReader.is_stream(filename) or GzipInput.compression(filename):
+            raise ValueError('Only an uncompressed FASTQ file can be memory-mapped: ' + filename)
+        self.filename = filename
+        with open(filename, 'rb') as handle:
+            # an empty file cannot be mapped
+            self.mapping = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) if \
+                os.path.getsize(filename) else None
+        self.size = len(self.mapping) if self.mapping is not None else 0
+        self.buffer = memoryview(self.mapping) if self.mapping is not None else memoryview(b'')
+        self.array = np.frombuffer(self.buffer, dtype=np.uint8)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def close(self):
+        """
+        This function closes the mapping. If memoryviews or arrays handed out before are still used, e.g. the last block
+        of iterate_blocks, the file is unmapped once they are not used any more instead.
+        """
+        self.array = None
+        self.buffer = None
+        if self.mapping is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                pass
+        self.mapping = None
+
+    def split(self, shard_number):
+        """
+        This function divides the mapping into ranges that start at record boundaries (see FastqReader.split_file).
+
+        :param shard_number: number of ranges
+        :return: a list of tuples (start, end); ranges that would be empty are left out
+        """
+        if not self.size:
+            return []
+        boundaries = [0]
+        for shard in range(1, shard_number):
+            boundary = FastqReader.find_record_start(self.mapping, self.size * shard // shard_number)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+        if self.size > boundaries[-1]:
+            boundaries.append(self.size)
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def record_offsets(self, start=0, end=None):
+        """
+        This function finds the records in a range of the mapping, one chunk at a time.
+
+        :param start: offset of the first record
+        :param end: offset of the record after the last record (None to read until the end of the file)
+        :return: a generator of tuples (sequence starts, sequence ends, quality starts, quality ends), each of them an
+        int64 array with one element per record of the chunk; ends exclude line endings
+        """
+        end = self.size if end is None else end
+        position = start
+        search_size = chunk_size
+        while position < end:
+            search_end = min(position + search_size, end)
+            newlines = np.flatnonzero(self.array[position:search_end] == newline) + position
+            if search_end == end and (not len(newlines) or newlines[-1] != end - 1):
+                # the last line of a file may have no newline
+                newlines = np.append(newlines, end)
+            line_starts = np.concatenate([[position], newlines[:-1] + 1])
+            blank_lines = np.flatnonzero(self.strip(line_starts, newlines) == line_starts)
+            if len(blank_lines):
+                newlines, line_starts = self.skip_blank_lines(newlines, line_starts, blank_lines)
+            record_number = len(newlines) // 4
+            if not record_number:
+                if search_end < end:
+                    # a record longer than the chunk: search a larger chunk
+                    search_size *= 2
+                    continue
+                if self.array[position:end].tobytes().strip():
+                    raise ValueError('Invalid FASTQ record at offset ' + str(position) + ' of ' + self.filename)
+                return
+            line_ends = newlines[:4 * record_number].reshape(record_number, 4)
+            titles = line_starts[:4 * record_number:4]
+            sequence_starts = line_ends[:, 0] + 1
+            quality_starts = line_ends[:, 2] + 1
+            sequence_ends = self.strip(sequence_starts, line_ends[:, 1])
+            quality_ends = self.strip(quality_starts, line_ends[:, 3])
+            valid = (self.array[titles] == ord('@')) & (self.array[line_ends[:, 1] + 1] == ord('+')) & \
+                (sequence_ends - sequence_starts == quality_ends - quality_starts)
+            if not valid.all():
+                raise ValueError('Invalid FASTQ record at offset ' + str(titles[np.argmin(valid)]) + ' of ' +
+                                 self.filename)
+            yield sequence_starts, sequence_ends, quality_starts, quality_ends
+            position = int(line_ends[-1, 3]) + 1
+            search_size = chunk_size
+
+    @staticmethod
+    def skip_blank_lines(newlines, line_starts, blank_lines):
+        """
+        This function leaves out blank lines where a record should start. Blank lines inside a record (an empty sequence
+        and quality string) are kept.
+
+        :param newlines: offsets of the newlines of a chunk
+        :param line_starts: offsets of the first bytes of the lines ending at newlines
+        :param blank_lines: numbers of the blank lines of the chunk, in increasing order
+        :return: a tuple (newlines, line_starts) without the blank lines that are left out
+        """
+        kept = np.ones(len(newlines), dtype=bool)
+        title_line = 0
+        for line in blank_lines.tolist():
+            if (line - title_line) % 4 == 0:
+                kept[line] = False
+                title_line = line + 1
+        return newlines[kept], line_starts[kept]
+
+    def strip(self, starts, ends):
+        """
+        This function leaves a carriage return (Windows line endings) out of lines.
+
+        :param starts: offsets of the first bytes of lines
+        :param ends: offsets of the newlines ending them
+        :return: offsets of the line ends without carriage returns
+        """
+        has_return = (ends > starts) & (self.array[np.maximum(ends - 1, 0)] == ord('\r'))
+        return ends - has_return
+
+    def iterate_blocks(self, block_size, start=0, end=None):
+        """
+        This function reads a range of the mapping in blocks of reads (see FastqReader.iterate_blocks).
+
+        :param block_size: maximum number of reads in each block
+        :param start: offset of the first record
+        :param end: offset of the record after the last record (None to read until the end of the file)
+        :return: a generator of tuples (sequences, quality strings), both of them RecordSlices objects
+        """
+        # offsets of records found in chunks are gathered until they fill a block
+        pending = []
+        pending_reads = 0
+        for offsets in self.record_offsets(start, end):
+            pending.append(offsets)
+            pending_reads += len(offsets[0])
+            if pending_reads < block_size:
+                continue
+            sequence_starts, sequence_ends, quality_starts, quality_ends = \
+                [np.concatenate(arrays) for arrays in zip(*pending)]
+            for block_start in range(0, pending_reads - block_size + 1, block_size):
+                block = slice(block_start, block_start + block_size)
+                yield self.block(sequence_starts[block], sequence_ends[block], quality_starts[block],
+                                 quality_ends[block])
+            rest = slice(pending_reads - pending_reads % block_size, pending_reads)
+            pending = [(sequence_starts[rest], sequence_ends[rest], quality_starts[rest], quality_ends[rest])]
+            pending_reads = pending_reads % block_size
+        if pending_reads:
+            yield self.block(*[np.concatenate(arrays) for arrays in zip(*pending)])
+
+    def block(self, sequence_starts, sequence_ends, quality_starts, quality_ends):
+        """
+        This function wraps the offsets of a block of records.
+
+        :return: a tuple (sequences, quality strings), both of them RecordSlices objects
+        """
+        return (RecordSlices(self.buffer, self.array, sequence_starts, sequence_ends),
+                RecordSlices(self.buffer, self.array, quality_starts, quality_ends))
+
+    def iterate_reads(self, read_length=129, barcode_length=30, start=0, end=None):
+        """
+        This function reads a range of the mapping and returns what the decomplexation needs from every read (see
+        FastqReader.iterate_reads).
+
+        :param read_length: number of bases at the start of a read that are returned (None for the whole read)
+        :param barcode_length: number of bases at the start of a read whose Phred scores are summed
+        :param start: offset of the first record
+        :param end: offset of the record after the last record (None to read until the end of the file)
+        :return: a generator of tuples (first read_length bases (str object), sum of Phred scores of the barcode region)
+        """
+        mapping = self.mapping
+        barcode_positions = np.arange(barcode_length)
+        for sequence_starts, sequence_ends, quality_starts, quality_ends in self.record_offsets(start, end):
+            # Phred sums of the barcode regions of the whole chunk; positions beyond a short quality string count 0
+            positions = quality_starts[:, None] + barcode_positions
+            inside = positions < quality_ends[:, None]
+            barcode_quality = np.where(inside, self.array[np.minimum(positions, self.size - 1)].astype(np.int64) -
+                                       FastqReader.phred_offset, 0).sum(axis=1)
+            if read_length is not None:
+                sequence_ends = np.minimum(sequence_ends, sequence_starts + read_length)
+            for sequence_start, sequence_end, quality in \
+                    zip(sequence_starts.tolist(), sequence_ends.tolist(), barcode_quality.tolist()):
+                yield mapping[sequence_start:sequence_end].decode('ascii'), quality
+
+
+def iterate_blocks(filename, block_size, start=0, end=None):
+    """
+    This function maps a FASTQ file and reads a range of it in blocks of reads (see MappedFastq.iterate_blocks).
+    """
+    with MappedFastq(filename) as mapped_fastq:
+        yield from mapped_fastq.iterate_blocks(block_size, start, end)
+
+
+def iterate_reads(filename, read_length=129, barcode_length=30, start=0, end=None):
+    """
+    This function maps a FASTQ file and reads a range of it read by read (see MappedFastq.iterate_reads).
+    """
+    with MappedFastq(filename) as mapped_fastq:
+        yield from mapped_fastq.iterate_reads(read_length, barcode_length, start, end)
+
+
+def split_file(filename, shard_number):
+    """
+    This function maps a FASTQ file and divides it into ranges that start at record boundaries (see MappedFastq.split).
+    """
+    with MappedFastq(filename) as mapped_fastq:
+        return mapped_fastq.split(shard_number)
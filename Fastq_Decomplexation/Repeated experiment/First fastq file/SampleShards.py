@@ -0,0 +1,207 @@
+"""
+SampleShards spreads the collapse stage of Pipeline.py over several collapse worker processes by sample index, so that
+reads of different samples do not compete in the same barcode index.
+
+1.Sample indexes are divided into groups: one group per sample index ('sample') or one group per timepoint, i.e. the
+len(TableIO.state_names) consecutive sample indexes of the same sample group of the finished table ('timepoint').
+
+2.Every group is owned by one collapse worker process, which keeps one AllBarcode object per group. The collapse owner
+of Pipeline.py only splits the results of every chunk by group and hands them over through bounded queues; workers
+collapse the reads of their groups in the order of the chunks, so the result of a group does not depend on the number
+of workers.
+
+    QC workers --> collapse owner --> [read queue of every worker] --> collapse workers (one AllBarcode per group)
+
+3.When the file is read, the barcodes of all groups are reconciled into one AllBarcode object: with collapse='greedy',
+collapsed barcodes of all groups are added from the most to the least abundant one (ties broken alphabetically) and
+each is collapsed into the earliest barcode within 5 Hamming distances, as parts are merged by
+SequenceDecomplexationParallel.py. With collapse='abundance' or 'graph', groups only count exact barcodes, which are
+summed up and clustered once by AllBarcode.finish_collapse, so the result is the same as without sample shards.
+
+With a whitelist, every group indexes the whitelist, so memory grows with the number of groups.
+
+With membership=True, the membership of every group (see ClusterMembership.py) is carried over to the reconciled
+barcodes.
+"""
+import multiprocessing
+import os
+import time
+import numpy as np
+import Constants
+import TableIO
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+
+def sample_groups(shard_by):
+    """
+    This function divides sample indexes into groups.
+
+    :param shard_by: 'sample' for one group per sample index or 'timepoint' for one group per sample group of the
+    finished table (see TableIO.column_metadata)
+    :return: a dictionary that maps sample index sequences to group numbers (int objects starting from 1)
+    """
+    assert (shard_by in SampleShards.shard_choices), "Unknown sample shards: " + str(shard_by)
+    group_size = 1 if shard_by == 'sample' else len(TableIO.state_names)
+    return {sample_index: position // group_size + 1
+            for position, sample_index in enumerate(Constants.sample_index_dict.values())}
+
+
+def collapse_worker(groups, packed, collapse, whitelist, discover, membership, read_queue, result_queue):
+    """
+    This function collapses the reads of some groups. It runs in a collapse worker process until it takes None from
+    read_queue, and then puts the counts of its groups into result_queue. After an error, the remaining reads are
+    taken from read_queue without being collapsed, so that the collapse owner is never blocked on a full queue, and the
+    error is handed over instead.
+
+    :param groups: group numbers of this worker
+    :param packed: compare barcodes as 2-bit packed codes
+    :param collapse: 'greedy', 'abundance' or 'graph' (see AllBarcode)
+    :param whitelist: a list of known barcodes or None
+    :param discover: with a whitelist, collapse reads that are not near any whitelist barcode into new barcodes
+    :param membership: record which barcodes of the reads are collapsed into which barcode
+    :param read_queue: a multiprocessing queue of dictionaries that map group numbers to dictionaries of (barcode,
+    sample index) tuples and their numbers of reads
+    :param result_queue: a multiprocessing queue shared by all workers
+    """
+    # imported here because SequenceDecomplexationOptimized.py imports Pipeline.py, which uses this module
+    from SequenceDecomplexationOptimized import AllBarcode
+
+    error = None
+    try:
+        group_barcode_lists = {group: AllBarcode(packed, collapse, whitelist, discover, membership)
+                               for group in groups}
+    except Exception as exception:
+        error = exception
+    while True:
+        group_reads = read_queue.get()
+        if group_reads is None:
+            break
+        if error is not None:
+            continue
+        try:
+            for group, read_id_counter in group_reads.items():
+                all_barcode_list = group_barcode_lists[group]
+                for read_id, read_count in read_id_counter.items():
+                    all_barcode_list.add_read(read_id, read_count)
+        except Exception as exception:
+            error = exception
+    if error is not None:
+        result_queue.put(error)
+        return
+    exact = collapse in AllBarcode.exact_collapse_choices
+    result_queue.put({group: (all_barcode_list.exact_counts if exact else all_barcode_list.counts,
+                              all_barcode_list.unassigned_reads, all_barcode_list.membership)
+                      for group, all_barcode_list in group_barcode_lists.items()})
+
+
+class SampleShards:
+    """
+    SampleShards object starts the collapse workers, routes reads to them by sample index and reconciles their
+    barcodes.
+    """
+    shard_choices = ['sample', 'timepoint']
+
+    def __init__(self, shard_by='timepoint', workers=None, packed=False, collapse='greedy', whitelist=None,
+                 discover=False, queue_size=None, membership=False):
+        """
+        :param shard_by: 'sample' or 'timepoint' (see sample_groups)
+        :param workers: number of collapse worker processes (default: one per group, at most the number of CPUs)
+        :param packed: compare barcodes as 2-bit packed codes
+        :param collapse: 'greedy', 'abundance' or 'graph' (see AllBarcode)
+        :param whitelist: a list of known barcodes or None
+        :param discover: with a whitelist, collapse reads that are not near any whitelist barcode into new barcodes
+        :param queue_size: maximum number of chunks waiting in the read queue of every worker (default: 4)
+        :param membership: record which barcodes of the reads are collapsed into which barcode
+        """
+        self.groups = sample_groups(shard_by)
+        group_numbers = sorted(set(self.groups.values()))
+        self.workers = min(workers or os.cpu_count(), len(group_numbers))
+        self.collapse = collapse
+        self.settings = (packed, collapse, whitelist, discover, membership)
+        self.queue_size = queue_size or 4
+        # groups are dealt out to workers in turn, so neighbouring sample indexes are collapsed at the same time
+        self.worker_groups = [group_numbers[worker::self.workers] for worker in range(self.workers)]
+        self.group_workers = {group: worker for worker, groups in enumerate(self.worker_groups) for group in groups}
+        self.read_queues = []
+        self.result_queue = None
+        self.processes = []
+        self.put_wait = 0.0
+
+    def start(self):
+        """
+        This function starts the collapse workers.
+        """
+        self.result_queue = multiprocessing.Queue()
+        self.read_queues = [multiprocessing.Queue(self.queue_size) for worker in range(self.workers)]
+        self.processes = [multiprocessing.Process(target=collapse_worker,
+                                                  args=(groups, *self.settings, read_queue, self.result_queue),
+                                                  daemon=True)
+                          for groups, read_queue in zip(self.worker_groups, self.read_queues)]
+        for process in self.processes:
+            process.start()
+
+    def add_reads(self, read_id_counter):
+        """
+        This function splits the good reads of a chunk by group and hands them over to the workers of the groups.
+
+        :param read_id_counter: a dictionary that maps (barcode, sample index) tuples to their numbers of reads
+        """
+        worker_reads = [{} for worker in range(self.workers)]
+        for read_id, read_count in read_id_counter.items():
+            group = self.groups[read_id[1]]
+            worker_reads[self.group_workers[group]].setdefault(group, {})[read_id] = read_count
+        started = time.perf_counter()
+        for read_queue, group_reads in zip(self.read_queues, worker_reads):
+            if group_reads:
+                read_queue.put(group_reads)
+        self.put_wait += time.perf_counter() - started
+
+    def reconcile(self, all_barcode_list):
+        """
+        This function stops the collapse workers and adds the barcodes of all groups to one AllBarcode object.
+
+        :param all_barcode_list: an empty AllBarcode object with the settings of the workers
+        """
+        for read_queue in self.read_queues:
+            read_queue.put(None)
+        group_results = {}
+        for worker in range(self.workers):
+            result = self.result_queue.get()
+            if isinstance(result, Exception):
+                raise result
+            group_results.update(result)
+        for process in self.processes:
+            process.join()
+
+        barcodes = []
+        group_counts = []
+        group_starts = [0]
+        for group in sorted(group_results):
+            counts, unassigned_reads, membership = group_results[group]
+            barcodes.extend(counts.barcodes)
+            group_counts.append(counts.counts)
+            group_starts.append(len(barcodes))
+            all_barcode_list.unassigned_reads += unassigned_reads
+        counts = np.concatenate(group_counts) if group_counts else np.zeros((0, 0), dtype=np.int32)
+        order = range(len(barcodes))
+        if self.collapse == 'greedy':
+            abundance = counts.sum(axis=1, dtype=np.int64).tolist()
+            order = sorted(order, key=lambda row: (-abundance[row], barcodes[row]))
+        reconciled_rows = [None] * len(barcodes)
+        for row in order:
+            reconciled_rows[row] = all_barcode_list.add_barcode(barcodes[row], counts[row])
+        for group, start, end in zip(sorted(group_results), group_starts[:-1], group_starts[1:]):
+            all_barcode_list.merge_membership(group_results[group][2], reconciled_rows[start:end])
+
+    def stats(self):
+        """
+        This function summarizes the sample shards for the back-pressure statistics of Pipeline.py.
+
+        :return: a dictionary
+        """
+        return {'collapse_workers': self.workers, 'groups': len(self.group_workers),
+                'blocked_on_full_queues': self.put_wait}
@@ -0,0 +1,242 @@
+"""
+SyntheticFastq writes FASTQ files of synthetic amplicon reads whose true barcodes are known, so that the decomplexation
+can be benchmarked and checked without the SRA data (see Benchmark.py).
+
+Every read is built like a real amplicon from Constants.py
+
+    | barcode | constant_1 | sample index | constant_2 | random bases |
+    0         30           95             105          129            read_length
+
+1.True barcodes are random 30-mers that differ from each other in more than 5 positions. Reads are drawn from them with
+a Zipf-like abundance skew: the i-th barcode is drawn with a probability proportional to 1 / i ** skew, so a few
+barcodes have most of the reads as in our lineage tracing experiments.
+
+2.Every base is substituted by another base with probability substitution_rate, mimicking PCR and sequencing errors.
+
+3.Phred scores are drawn around a profile of mean scores along the read (see phred_profiles).
+
+The ground truth is saved next to the FASTQ file:
+
+    file.fastq_truth.npz  : reads of every true barcode in every sample index that should pass our quality control
+                            (same format as a raw read .npz, see CountMatrix.py)
+    file.fastq_truth.json : settings of the generator and the expected read summary
+
+Example:
+
+    python3 SyntheticFastq.py synthetic.fastq --reads 1000000 --barcodes 5000 --skew 1.2 --substitution-rate 0.005
+"""
+import argparse
+import datetime
+import json
+import numpy as np
+import Constants
+from BarcodeIndex import BarcodeIndex
+from CountMatrix import CountMatrix
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+barcode_length = 30
+amplicon_length = 129
+phred_offset = 33
+# a read passes the Phred check if the sum of the Phred scores of its barcode is at least 0.8 * 40 * 30
+min_barcode_quality = 0.8 * 40 * barcode_length
+
+# mean Phred score at the start and at the end of the read (linear in between) and its standard deviation
+phred_profiles = {'high': (38, 38, 2), 'decay': (38, 28, 4), 'low': (32, 26, 6)}
+
+
+def encode(sequence):
+    """
+    This function converts a DNA sequence into base codes (0-3 for A, C, G, T).
+
+    :param sequence: a DNA sequence (str object)
+    :return: a uint8 array
+    """
+    return np.searchsorted(bases, np.frombuffer(sequence.encode(), dtype=np.uint8)).astype(np.uint8)
+
+
+def true_barcodes(barcode_number, rng):
+    """
+    This function draws random barcodes that differ from each other in more than 5 positions, so every read can be
+    traced back to one true barcode.
+
+    :param barcode_number: number of barcodes
+    :param rng: a numpy.random.Generator object
+    :return: a list of barcodes (str objects)
+    """
+    index = BarcodeIndex()
+    while len(index) < barcode_number:
+        for codes in rng.integers(0, 4, size=(barcode_number - len(index), barcode_length), dtype=np.uint8):
+            barcode = bases[codes].tobytes().decode()
+            if index.find(barcode) is None:
+                index.add(barcode)
+    return index.barcodes
+
+
+def abundances(barcode_number, skew):
+    """
+    This function gives the probability of drawing each barcode, proportional to 1 / rank ** skew.
+
+    :param barcode_number: number of barcodes
+    :param skew: 0 for uniform abundances, larger values for more skewed ones
+    :return: a float array that sums up to 1
+    """
+    weights = 1.0 / np.arange(1, barcode_number + 1) ** skew
+    return weights / weights.sum()
+
+
+def phred_means(profile, read_length):
+    """
+    This function gives the mean Phred score of every position of a read.
+
+    :param profile: a key of phred_profiles
+    :param read_length: length of reads
+    :return: a tuple (float array of mean scores, standard deviation)
+    """
+    start, end, deviation = phred_profiles[profile]
+    return np.linspace(start, end, read_length), deviation
+
+
+def generate_batch(read_number, barcode_codes, probabilities, sample_index_codes, substitution_rate, phred_profile,
+                   read_length, rng):
+    """
+    This function generates a batch of reads.
+
+    :return: a tuple (base codes of reads, Phred scores, true barcode ids, true sample index ids, substitution mask),
+    all of them arrays with one row per read
+    """
+    barcode_ids = rng.choice(len(barcode_codes), size=read_number, p=probabilities)
+    sample_ids = rng.integers(0, len(sample_index_codes), size=read_number)
+    constant_1 = np.broadcast_to(encode(Constants.constant_1), (read_number, len(Constants.constant_1)))
+    constant_2 = np.broadcast_to(encode(Constants.constant_2), (read_number, len(Constants.constant_2)))
+    tail = rng.integers(0, 4, size=(read_number, read_length - amplicon_length), dtype=np.uint8)
+    codes = np.concatenate([barcode_codes[barcode_ids], constant_1, sample_index_codes[sample_ids], constant_2, tail],
+                           axis=1)
+
+    # a substituted base is replaced by one of the three other bases
+    substituted = rng.random(codes.shape) < substitution_rate
+    codes = np.where(substituted, (codes + rng.integers(1, 4, size=codes.shape, dtype=np.uint8)) % 4, codes)
+
+    means, deviation = phred_means(phred_profile, read_length)
+    phred = np.clip(np.rint(rng.normal(means, deviation, size=codes.shape)), 2, 41).astype(np.uint8)
+    return codes, phred, barcode_ids, sample_ids, substituted
+
+
+def expected_quality_control(codes, phred, sample_ids, substituted, sample_indexes):
+    """
+    This function tells which reads should pass our quality control, following the thresholds of
+    Functions.collapse_unique_reads.
+
+    :return: a tuple (boolean array of good reads, # of bad barcode reads, # of bad constant reads, # of bad sample
+    index reads)
+    """
+    good_barcode = phred[:, :barcode_length].sum(axis=1, dtype=np.int64) >= min_barcode_quality
+    # substituted bases always differ from the constant regions, so they are their Hamming distances
+    good_constant = (substituted[:, 30:95].sum(axis=1) <= 5) & (substituted[:, 105:129].sum(axis=1) <= 2)
+    read_sample_indexes = [bases[row].tobytes().decode() for row in codes[:, 95:105]]
+    good_sample_index = np.array([Constants.sample_index_lookup.get(sequence) == sample_indexes[sample_id]
+                                  for sequence, sample_id in zip(read_sample_indexes, sample_ids)], dtype=bool)
+    good = good_barcode & good_constant & good_sample_index
+    return (good, int((~good_barcode).sum()), int((good_barcode & ~good_constant).sum()),
+            int((good_barcode & good_constant & ~good_sample_index).sum()))
+
+
+def write_batch(handle, codes, phred, first_read):
+    """
+    This function writes a batch of reads as FASTQ records.
+    """
+    sequences = bases[codes]
+    qualities = phred + phred_offset
+    handle.write(b''.join(b'@synthetic.' + str(first_read + read).encode() + b'\n' + sequence.tobytes() + b'\n+\n' +
+                          quality.tobytes() + b'\n'
+                          for read, (sequence, quality) in enumerate(zip(sequences, qualities))))
+
+
+def generate(filename, read_number, barcode_number=1000, skew=1.0, substitution_rate=0.005, phred_profile='high',
+             sample_number=None, read_length=150, seed=0, batch_size=100000):
+    """
+    This function writes a synthetic FASTQ file and its ground truth.
+
+    :param filename: the name of the FASTQ file
+    :param read_number: number of reads
+    :param barcode_number: number of true barcodes
+    :param skew: abundance skew of barcodes (see abundances)
+    :param substitution_rate: probability that a base is substituted
+    :param phred_profile: a key of phred_profiles
+    :param sample_number: number of sample indexes that reads are spread over (default: all sample indexes)
+    :param read_length: length of reads (at least 129)
+    :param seed: seed of the random generator; the same seed and settings give the same file
+    :param batch_size: number of reads generated at once
+    :return: a tuple (CountMatrix object of the expected good reads of every true barcode, expected read counts)
+    """
+    assert (read_length >= amplicon_length), "Reads must have at least " + str(amplicon_length) + " bases!"
+    assert (phred_profile in phred_profiles), "Unknown Phred profile: " + str(phred_profile)
+    rng = np.random.default_rng(seed)
+    barcodes = true_barcodes(barcode_number, rng)
+    barcode_codes = np.array([encode(barcode) for barcode in barcodes])
+    probabilities = abundances(barcode_number, skew)
+    sample_indexes = list(Constants.sample_index_dict.values())[:sample_number]
+    sample_index_codes = np.array([encode(sample_index) for sample_index in sample_indexes])
+
+    truth = CountMatrix(Constants.sample_index_dict.values(), capacity=barcode_number)
+    for barcode in barcodes:
+        truth.add_barcode(barcode)
+    columns = np.array([truth.columns[sample_index] for sample_index in sample_indexes])
+    read_counts = {'all_reads': 0, 'good_reads': 0, 'bad_barcode_reads': 0, 'bad_constant_reads': 0,
+                   'bad_sample_index_reads': 0}
+
+    with open(filename, 'wb') as handle:
+        for first_read in range(0, read_number, batch_size):
+            codes, phred, barcode_ids, sample_ids, substituted = \
+                generate_batch(min(batch_size, read_number - first_read), barcode_codes, probabilities,
+                               sample_index_codes, substitution_rate, phred_profile, read_length, rng)
+            good, bad_barcode, bad_constant, bad_sample_index = \
+                expected_quality_control(codes, phred, sample_ids, substituted, sample_indexes)
+            np.add.at(truth.count_array, (barcode_ids[good], columns[sample_ids[good]]), 1)
+            read_counts['all_reads'] += len(codes)
+            read_counts['good_reads'] += int(good.sum())
+            read_counts['bad_barcode_reads'] += bad_barcode
+            read_counts['bad_constant_reads'] += bad_constant
+            read_counts['bad_sample_index_reads'] += bad_sample_index
+            write_batch(handle, codes, phred, first_read)
+            print(str(read_counts['all_reads']) + ' reads have been generated at ' + str(datetime.datetime.now()))
+
+    truth.save_npz(filename + '_truth.npz')
+    settings = {'reads': read_number, 'barcodes': barcode_number, 'skew': skew,
+                'substitution_rate': substitution_rate, 'phred_profile': phred_profile,
+                'sample_indexes': len(sample_indexes), 'read_length': read_length, 'seed': seed}
+    with open(filename + '_truth.json', 'w') as handle:
+        json.dump({'settings': settings, 'read_counts': read_counts}, handle, indent=2)
+    return truth, read_counts
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Write a FASTQ file of synthetic amplicon reads and its '
+                                                          'ground truth.')
+    argument_parser.add_argument('file', help='name of the FASTQ file to be written')
+    argument_parser.add_argument('--reads', type=int, default=1000000, help='number of reads (default: 1000000)')
+    argument_parser.add_argument('--barcodes', type=int, default=1000,
+                                 help='number of true barcodes (default: 1000)')
+    argument_parser.add_argument('--skew', type=float, default=1.0,
+                                 help='abundance skew; the i-th barcode is drawn with a probability proportional to '
+                                      '1 / i ** skew (default: 1.0, 0 for uniform abundances)')
+    argument_parser.add_argument('--substitution-rate', type=float, default=0.005,
+                                 help='probability that a base is substituted (default: 0.005)')
+    argument_parser.add_argument('--phred-profile', choices=sorted(phred_profiles), default='high',
+                                 help='mean Phred scores along the read (default: high)')
+    argument_parser.add_argument('--samples', type=int,
+                                 help='number of sample indexes reads are spread over (default: all)')
+    argument_parser.add_argument('--read-length', type=int, default=150, help='length of reads (default: 150)')
+    argument_parser.add_argument('--seed', type=int, default=0, help='seed of the random generator (default: 0)')
+    arguments = argument_parser.parse_args()
+    if arguments.read_length < amplicon_length:
+        argument_parser.error('reads must have at least ' + str(amplicon_length) + ' bases')
+
+    truth, read_counts = generate(arguments.file, arguments.reads, arguments.barcodes, arguments.skew,
+                                  arguments.substitution_rate, arguments.phred_profile, arguments.samples,
+                                  arguments.read_length, arguments.seed)
+    print('expected read summary: ' + str(read_counts))
@@ -0,0 +1,106 @@
+"""
+Tests of BarcodeIndex.py against a linear scan over all barcodes. Run with: python3 -m pytest test_BarcodeIndex.py
+"""
+import numpy as np
+import pytest
+from BarcodeIndex import BarcodeIndex
+from SequenceDecomplexationOptimized import Functions
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+
+def mutate(barcode, mismatch_number, rng):
+    """
+    This function replaces mismatch_number random positions of a barcode with other bases (N included).
+    """
+    bases = list(barcode)
+    for position in rng.choice(len(bases), mismatch_number, replace=False):
+        bases[position] = rng.choice([base for base in 'ACGTN' if base != bases[position]])
+    return ''.join(bases)
+
+
+def random_barcodes(barcode_number, seed=0):
+    """
+    This function draws random barcodes, most of which are mutants of earlier ones with 0 to 8 mismatches.
+    """
+    rng = np.random.default_rng(seed)
+    barcodes = [''.join(rng.choice(list('ACGT'), 30)) for _ in range(20)]
+    while len(barcodes) < barcode_number:
+        barcodes.append(mutate(barcodes[rng.integers(len(barcodes))], int(rng.integers(9)), rng))
+    return barcodes
+
+
+def linear_find(barcodes, barcode):
+    """
+    This function finds the first barcode within 5 Hamming distances as the original linear scan does.
+    """
+    for other_barcode in barcodes:
+        if Functions.hamming_distance(other_barcode, barcode) <= 5:
+            return other_barcode
+    return None
+
+
+def linear_nearest(barcodes, barcode):
+    """
+    This function finds the position of the first barcode with the fewest differences within 5 Hamming distances.
+    """
+    distances = [Functions.hamming_distance(other_barcode, barcode) for other_barcode in barcodes]
+    if not distances or min(distances) > 5:
+        return None
+    return distances.index(min(distances))
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_find_is_the_same_as_a_linear_scan(packed):
+    barcode_index = BarcodeIndex(packed=packed)
+    added = []
+    for barcode in random_barcodes(3000):
+        matched = barcode_index.find(barcode)
+        assert matched == linear_find(added, barcode)
+        if matched is None:
+            barcode_index.add(barcode)
+            added.append(barcode)
+    # mutants with more than 5 mismatches must have produced new barcodes
+    assert 20 < len(barcode_index) < 3000
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_nearest_is_the_same_as_a_linear_scan(packed):
+    whitelist = random_barcodes(300, seed=1)
+    barcode_index = BarcodeIndex(packed=packed)
+    for barcode in whitelist:
+        barcode_index.add(barcode)
+    for barcode in random_barcodes(1000, seed=2):
+        assert barcode_index.nearest(barcode) == linear_nearest(whitelist, barcode)
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_find_returns_the_earliest_barcode(packed):
+    barcode_index = BarcodeIndex(packed=packed)
+    barcode = 'AGTGANTGTGTCTGACAGTCAGTGACTGAC'
+    far_barcode = 'TTTTT' + barcode[5:]
+    close_barcode = barcode[:29] + 'T'
+    barcode_index.add(far_barcode)
+    barcode_index.add(close_barcode)
+    # far_barcode is 4 differences away and was added first, close_barcode is only 1 difference away
+    assert barcode_index.find(barcode) == far_barcode
+    assert barcode_index.nearest(barcode) == 1
+
+
+def test_empty_index_finds_nothing():
+    for packed in [False, True]:
+        barcode_index = BarcodeIndex(packed=packed)
+        assert barcode_index.find('A' * 30) is None
+        assert barcode_index.nearest('A' * 30) is None
+
+
+def test_packed_index_grows():
+    barcode_index = BarcodeIndex(packed=True)
+    barcodes = [''.join(np.random.default_rng(barcode_id).choice(list('ACGT'), 30)) for barcode_id in range(2500)]
+    for barcode in barcodes:
+        barcode_index.add(barcode)
+    assert len(barcode_index.codes) >= 2500
+    assert all(barcode_index.find(barcode) == barcode for barcode in barcodes[::100])
@@ -0,0 +1,81 @@
+"""
+Tests of TableDownsample.py. Run with: python3 -m pytest test_TableDownsample.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import TableDownsample
+import TableIO
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+
+@pytest.fixture
+def table():
+    """
+    This function returns a finished table of random counts with many small counts, so that rows become empty.
+    """
+    rng = np.random.default_rng(0)
+    counts = rng.negative_binomial(1, 0.05, (2000, 6))
+    barcodes = [''.join(barcode) for barcode in rng.choice(list('ACGT'), (2000, 30))]
+    return pd.DataFrame(counts, index=pd.Index(barcodes, dtype=object),
+                        columns=['S' + str(column) for column in range(6)])
+
+
+@pytest.mark.parametrize('method', TableDownsample.method_choices)
+def test_downsampling_is_reproducible(table, method):
+    downsampled_table = TableDownsample.downsample_table(table, '10', seed=3, method=method)
+    pd.testing.assert_frame_equal(downsampled_table, TableDownsample.downsample_table(table, '10', seed=3,
+                                                                                      method=method))
+    # the same value of a percentage gives the same draws, another seed gives other draws
+    pd.testing.assert_frame_equal(downsampled_table, TableDownsample.downsample_table(table, '10.0', seed=3,
+                                                                                      method=method))
+    assert not downsampled_table.equals(TableDownsample.downsample_table(table, '10', seed=4, method=method))
+
+
+@pytest.mark.parametrize('method', TableDownsample.method_choices)
+def test_downsampled_counts_never_exceed_original_counts(table, method):
+    downsampled_table = TableDownsample.downsample_table(table, '25', method=method, keep_empty=True)
+    assert downsampled_table.index.equals(table.index) and downsampled_table.columns.equals(table.columns)
+    assert (downsampled_table.to_numpy() >= 0).all() and (downsampled_table.to_numpy() <= table.to_numpy()).all()
+    total = table.to_numpy().sum()
+    assert downsampled_table.to_numpy().sum() == pytest.approx(0.25 * total, rel=0.05)
+
+
+@pytest.mark.parametrize('percentage', ['0.01', '1', '33.3', '99'])
+def test_hypergeometric_keeps_exact_read_number(table, percentage):
+    downsampled_table = TableDownsample.downsample_table(table, percentage, method='hypergeometric')
+    assert downsampled_table.to_numpy().sum() == round(float(percentage) / 100 * table.to_numpy().sum())
+
+
+@pytest.mark.parametrize('method', TableDownsample.method_choices)
+def test_zero_and_hundred_percent(table, method):
+    assert TableDownsample.downsample_table(table, '0', method=method).empty
+    full_table = TableDownsample.downsample_table(table, '100', method=method)
+    pd.testing.assert_frame_equal(full_table, table[table.sum(axis=1) > 0], check_dtype=False)
+
+
+def test_empty_barcodes_are_removed_unless_kept(table):
+    downsampled_table = TableDownsample.downsample_table(table, '1')
+    kept_table = TableDownsample.downsample_table(table, '1', keep_empty=True)
+    assert (downsampled_table.sum(axis=1) > 0).all()
+    assert len(downsampled_table) < len(kept_table) == len(table)
+    pd.testing.assert_frame_equal(downsampled_table, kept_table[kept_table.sum(axis=1) > 0])
+
+
+def test_downsample_file_in_worker_processes(table, tmp_path):
+    filename = str(tmp_path / 'table.pickle')
+    TableIO.save_table(table, filename)
+    percentages = ['1', '50']
+    results = TableDownsample.downsample_file(filename, tmp_path / 'pool', percentages, seed=5, processes=2)
+    assert [result[0] for result in results] == percentages
+    for percentage, output_filename, barcode_number, read_number in results:
+        # every worker draws the same table as downsample_table in this process
+        expected = TableDownsample.downsample_table(table, percentage, seed=5)
+        downsampled_table = TableIO.read_table(output_filename)
+        assert output_filename == TableDownsample.table_filename(tmp_path / 'pool', percentage)
+        pd.testing.assert_frame_equal(downsampled_table, expected)
+        assert (barcode_number, read_number) == (len(expected), expected.to_numpy().sum())
@@ -0,0 +1,158 @@
+"""
+BatchQualityControl checks the quality of a block of reads at once with NumPy instead of checking reads one by one.
+
+Our reads have a fixed layout, so a block of reads can be stored as a uint8 matrix with one row per read and one column
+per base:
+
+    | barcode | constant_1 | sample index | constant_2 |
+    0         30           95             105          129
+
+The Phred score filter, the Hamming distances to both constant regions and the sample index assignment are then computed
+as array operations on whole columns. Only reads that pass all quality metrics are returned to be collapsed.
+
+Reads shorter than 129 bases are padded with zeros which never match a base, so they fail the constant region check.
+
+With anchor=True, reads failing the constant region check are searched one by one for their constant regions at other
+positions (see AnchorSearch.py).
+"""
+import numpy as np
+import AnchorSearch
+import Constants
+import FastqReader
+import MappedFastq
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+read_length = 129
+barcode_slice = slice(0, 30)
+constant_1_slice = slice(30, 95)
+sample_index_slice = slice(95, 105)
+constant_2_slice = slice(105, 129)
+
+constant_1_array = np.frombuffer(Constants.constant_1.encode('ascii'), dtype=np.uint8)
+constant_2_array = np.frombuffer(Constants.constant_2.encode('ascii'), dtype=np.uint8)
+sample_index_list = list(Constants.sample_index_dict.values())
+
+# Every 10-mer over ACGTN is numbered in base 5, so Constants.sample_index_lookup can be turned into an array that maps
+# this number to the id of the assigned sample index (-1 if there is none). The array has 5 ** 10 entries (~10 MB).
+base_code = np.full(256, 5, dtype=np.int64)
+for code, base in enumerate('ACGTN'):
+    base_code[ord(base)] = code
+sample_index_length = sample_index_slice.stop - sample_index_slice.start
+sample_index_place_values = 5 ** np.arange(sample_index_length - 1, -1, -1, dtype=np.int64)
+sample_index_id_array = None
+
+
+def sample_index_ids(read_sample_indexes):
+    """
+    This function assigns sample indexes of reads by looking them up in Constants.sample_index_lookup, or with
+    Constants.scan_sample_index for the few regions with other characters than ACGTN.
+
+    :param read_sample_indexes: a uint8 matrix with one sample index region per row
+    :return: an array of positions in sample_index_list (-1 if a read cannot be assigned)
+    """
+    global sample_index_id_array
+    if sample_index_id_array is None:
+        sample_index_id_array = np.full(5 ** sample_index_length, -1, dtype=np.int8)
+        index_id_dict = {sample_index: index_id for index_id, sample_index in enumerate(sample_index_list)}
+        for sequence, sample_index in Constants.sample_index_lookup.items():
+            codes = base_code[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)]
+            sample_index_id_array[codes @ sample_index_place_values] = index_id_dict[sample_index]
+
+    codes = base_code[read_sample_indexes]
+    valid = (codes < 5).all(axis=1)
+    index_ids = np.full(len(read_sample_indexes), -1, dtype=np.int64)
+    index_ids[valid] = sample_index_id_array[codes[valid] @ sample_index_place_values]
+    # regions with other characters than ACGTN are not in the array (see Constants.scan_sample_index)
+    for row in np.flatnonzero(~valid).tolist():
+        sample_index = Constants.scan_sample_index(read_sample_indexes[row].tobytes().decode('latin-1'))
+        if sample_index is not None:
+            index_ids[row] = sample_index_list.index(sample_index)
+    return index_ids
+
+
+def to_matrix(byte_strings, width, fill=0):
+    """
+    This function stacks byte strings into a uint8 matrix with a fixed number of columns.
+
+    :param byte_strings: a list of bytes objects, or a MappedFastq.RecordSlices object whose lines are gathered straight
+    from its mapping
+    :param width: number of columns; longer strings are truncated and shorter ones are padded with fill
+    :param fill: value used to pad shorter strings
+    :return: a NumPy uint8 matrix with shape (len(byte_strings), width)
+    """
+    if isinstance(byte_strings, MappedFastq.RecordSlices):
+        return byte_strings.matrix(width, fill)
+    padding = bytes([fill]) * width
+    joined = b''.join([byte_string[:width] if len(byte_string) >= width else (byte_string + padding)[:width]
+                       for byte_string in byte_strings])
+    return np.frombuffer(joined, dtype=np.uint8).reshape(len(byte_strings), width)
+
+
+def quality_control_block(sequences, qualities, anchor=False):
+    """
+    This function applies the quality metrics of Functions.reading_fastq to a block of reads.
+
+    1.the sum of Phred scores of the barcode region must be >= 80% of the maximum (0.8 * 40 * 30)
+    2.the first constant region must have <= 5 Hamming distances and the second one <= 2 Hamming distances
+    3.the sample index must be <= 1 Hamming distance away from one of the sample indexes in Constants
+
+    :param sequences: a list of read sequences (bytes objects) or a MappedFastq.RecordSlices object
+    :param qualities: a list of quality strings (bytes objects) of the same reads or a MappedFastq.RecordSlices object
+    :param anchor: search reads failing the constant region check for their constant regions (see AnchorSearch.py)
+    :return: a tuple (barcodes of good reads, sample indexes of good reads, # of bad barcode reads,
+    # of bad constant reads, # of bad sample index reads, # of good reads found by the anchor search). Barcodes and
+    sample indexes are lists of str objects in the order of the reads.
+    """
+    sequence_matrix = to_matrix(sequences, read_length)
+    quality_matrix = to_matrix(qualities, barcode_slice.stop, FastqReader.phred_offset)
+
+    # Check Phred score
+    barcode_quality = quality_matrix.sum(axis=1, dtype=np.int64) - FastqReader.phred_offset * barcode_slice.stop
+    quality_pass = barcode_quality >= 0.8 * 40 * 30
+
+    # Check the errors in the constant regions
+    constant_1_errors = (sequence_matrix[:, constant_1_slice] != constant_1_array).sum(axis=1)
+    constant_2_errors = (sequence_matrix[:, constant_2_slice] != constant_2_array).sum(axis=1)
+    constant_pass = (constant_1_errors <= 5) & (constant_2_errors <= 2)
+
+    # Errors in the sample index region must be <= 1 in order to be assigned
+    sample_index_id = sample_index_ids(sequence_matrix[:, sample_index_slice])
+    sample_index_pass = sample_index_id >= 0
+
+    bad_barcode_reads = int(np.count_nonzero(~quality_pass))
+    bad_constant_reads = int(np.count_nonzero(quality_pass & ~constant_pass))
+    good_read_mask = quality_pass & constant_pass & sample_index_pass
+    bad_sample_index_reads = int(np.count_nonzero(quality_pass & constant_pass)) - int(np.count_nonzero(good_read_mask))
+
+    good_barcodes = np.ascontiguousarray(sequence_matrix[good_read_mask, barcode_slice]).tobytes().decode('ascii')
+    barcode_length = barcode_slice.stop - barcode_slice.start
+    barcodes = [good_barcodes[start:start + barcode_length] for start in range(0, len(good_barcodes), barcode_length)]
+    read_sample_index_list = [sample_index_list[index_id] for index_id in sample_index_id[good_read_mask].tolist()]
+
+    anchored_reads = 0
+    if anchor:
+        good_reads = list(zip(np.flatnonzero(good_read_mask).tolist(), barcodes, read_sample_index_list))
+        for read_number in np.flatnonzero(quality_pass & ~constant_pass).tolist():
+            located = AnchorSearch.locate(bytes(sequences[read_number]).decode('ascii'))
+            if located is None:
+                continue
+            read_barcode, read_sample_index_sequence = located
+            bad_constant_reads -= 1
+            read_sample_index = Constants.sample_index_lookup.get(read_sample_index_sequence) or \
+                Constants.scan_sample_index(read_sample_index_sequence)
+            if read_sample_index is None:
+                bad_sample_index_reads += 1
+                continue
+            good_reads.append((read_number, read_barcode, read_sample_index))
+            anchored_reads += 1
+        if anchored_reads:
+            good_reads.sort()
+            barcodes = [read_barcode for read_number, read_barcode, read_sample_index in good_reads]
+            read_sample_index_list = [read_sample_index for read_number, read_barcode, read_sample_index in good_reads]
+
+    return barcodes, read_sample_index_list, bad_barcode_reads, bad_constant_reads, bad_sample_index_reads, \
+        anchored_reads
@@ -0,0 +1,201 @@
+"""
+Checkpoint saves the state of a running decomplexation at regular intervals, so that a run that is killed can be resumed
+from its last checkpoint instead of from the start of the fastq file.
+
+The state of a run is the AllBarcode object (barcodes, count matrices and barcode index), the read counters of the read
+summary and the offset of the next read in the fastq file. Dumping all of it every time would cost more and more as the
+run goes on, so the checkpoint file is an append-only log; each entry only holds what changed since the previous one:
+
+    settings | entry 1 | entry 2 | ...
+
+    entry: barcodes added since the previous entry and their counts
+           rows of older barcodes whose counts changed, and the changes
+           barcodes added to the barcode index
+           read counters and the offset of the next read (absolute values)
+
+Entries are pickled one after another and flushed to disk. An entry that was only partly written when the run was
+killed is dropped when the log is read. Every compact_interval entries, the log is rewritten as one entry holding the
+whole state (written to a temporary file that then replaces the log), so it never grows much larger than the state
+itself.
+"""
+import os
+import pickle
+import numpy as np
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+compact_interval = 20
+
+
+def count_changes(count_matrix, saved_counts):
+    """
+    This function compares a CountMatrix with a copy of its counts saved earlier.
+
+    :param count_matrix: a CountMatrix object
+    :param saved_counts: a copy of count_matrix.counts made earlier (barcodes are only appended in between)
+    :return: a dictionary (barcodes added since the copy, their counts, rows of older barcodes whose counts changed,
+    changes of these rows)
+    """
+    counts = count_matrix.counts
+    saved_rows = len(saved_counts)
+    changes = counts[:saved_rows] - saved_counts
+    rows = np.flatnonzero(changes.any(axis=1))
+    return {'barcodes': count_matrix.barcodes[saved_rows:], 'counts': counts[saved_rows:].copy(), 'rows': rows,
+            'changes': changes[rows]}
+
+
+def apply_changes(count_matrix, changes):
+    """
+    This function applies changes returned by count_changes to a CountMatrix.
+
+    :param count_matrix: a CountMatrix object in the state of the saved copy
+    :param changes: a dictionary returned by count_changes
+    """
+    count_matrix.count_array[changes['rows']] += changes['changes']
+    for barcode, counts in zip(changes['barcodes'], changes['counts']):
+        row = count_matrix.add_barcode(barcode)
+        count_matrix.count_array[row] = counts
+
+
+class Checkpoint:
+    """
+    Checkpoint object appends the changes of an AllBarcode object and the read counters of a run to a log file.
+    """
+    def __init__(self, filename, settings, read_interval=1000000):
+        """
+        :param filename: the name of the log file
+        :param settings: a dictionary of the settings of the run (e.g. fastq file, collapse method); a run can only be
+        resumed with the same settings
+        :param read_interval: number of reads between two checkpoints
+        """
+        self.filename = filename
+        self.settings = settings
+        self.read_interval = read_interval
+        self.entries = 0
+        self.initial_rows = None
+        self.saved_counts = None
+        self.saved_exact_counts = None
+        self.saved_index_size = 0
+
+    def exists(self):
+        """
+        This function checks whether there is a log to resume from.
+        """
+        return os.path.exists(self.filename)
+
+    def start(self, all_barcode_list):
+        """
+        This function starts a new log for an AllBarcode object that has not collected any read yet.
+
+        :param all_barcode_list: an AllBarcode object
+        """
+        self.initial_rows = len(all_barcode_list.counts)
+        self.remember(all_barcode_list)
+        with open(self.filename, 'wb') as handle:
+            pickle.dump(self.settings, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            handle.flush()
+            os.fsync(handle.fileno())
+        self.entries = 0
+
+    def remember(self, all_barcode_list):
+        """
+        This function keeps a copy of the counts that the next entry is compared with.
+        """
+        self.saved_counts = all_barcode_list.counts.counts.copy()
+        self.saved_exact_counts = all_barcode_list.exact_counts.counts.copy()
+        self.saved_index_size = len(all_barcode_list.index)
+
+    def entry(self, all_barcode_list, read_counts, position, saved_counts, saved_exact_counts, saved_index_size):
+        """
+        This function collects the changes of an AllBarcode object since the given copies of its counts and the size
+        of its barcode index were saved.
+
+        :return: a dictionary that is appended to the log
+        """
+        return {'counts': count_changes(all_barcode_list.counts, saved_counts),
+                'exact_counts': count_changes(all_barcode_list.exact_counts, saved_exact_counts),
+                'index_barcodes': all_barcode_list.index.barcodes[saved_index_size:],
+                'unassigned_reads': all_barcode_list.unassigned_reads,
+                'sample_index_total_count': dict(all_barcode_list.sample_index_total_count),
+                'read_counts': dict(read_counts), 'position': position}
+
+    def save(self, all_barcode_list, read_counts, position):
+        """
+        This function appends the changes since the previous checkpoint to the log, or rewrites the log as one entry
+        every compact_interval entries.
+
+        :param all_barcode_list: an AllBarcode object that has collected all reads before position
+        :param read_counts: a dictionary of read counters (see Functions.collapse_fastq)
+        :param position: offset of the next read in the fastq file
+        """
+        if self.entries + 1 >= compact_interval:
+            initial_counts = np.zeros((self.initial_rows, len(all_barcode_list.counts.sample_indexes)), dtype=np.int32)
+            entry = self.entry(all_barcode_list, read_counts, position, initial_counts, initial_counts[:0], 0)
+            temporary_filename = self.filename + '.tmp'
+            with open(temporary_filename, 'wb') as handle:
+                pickle.dump(self.settings, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(entry, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                handle.flush()
+                os.fsync(handle.fileno())
+            os.replace(temporary_filename, self.filename)
+            self.entries = 1
+        else:
+            entry = self.entry(all_barcode_list, read_counts, position, self.saved_counts, self.saved_exact_counts,
+                               self.saved_index_size)
+            with open(self.filename, 'ab') as handle:
+                pickle.dump(entry, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                handle.flush()
+                os.fsync(handle.fileno())
+            self.entries += 1
+        self.remember(all_barcode_list)
+
+    def restore(self, all_barcode_list):
+        """
+        This function replays the log into a new AllBarcode object created with the same settings.
+
+        :param all_barcode_list: an AllBarcode object that has not collected any read yet
+        :return: a tuple (read counters, offset of the next read) of the last complete entry, or None if the log has no
+        complete entry
+        """
+        self.initial_rows = len(all_barcode_list.counts)
+        last_entry = None
+        entries = 0
+        with open(self.filename, 'rb') as handle:
+            settings = pickle.load(handle)
+            if settings != self.settings:
+                raise ValueError('The checkpoint ' + self.filename + ' was written with other settings: ' +
+                                 str(settings))
+            complete_size = handle.tell()
+            while True:
+                try:
+                    entry = pickle.load(handle)
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    break
+                apply_changes(all_barcode_list.counts, entry['counts'])
+                apply_changes(all_barcode_list.exact_counts, entry['exact_counts'])
+                for barcode in entry['index_barcodes']:
+                    all_barcode_list.index.add(barcode)
+                last_entry = entry
+                entries += 1
+                complete_size = handle.tell()
+
+        # a partly written entry at the end is cut off, so that new entries follow the last complete one
+        with open(self.filename, 'r+b') as handle:
+            handle.truncate(complete_size)
+        self.entries = entries
+        self.remember(all_barcode_list)
+        if last_entry is None:
+            return None
+        all_barcode_list.unassigned_reads = last_entry['unassigned_reads']
+        all_barcode_list.sample_index_total_count = last_entry['sample_index_total_count']
+        return last_entry['read_counts'], last_entry['position']
+
+    def remove(self):
+        """
+        This function removes the log once the run is finished.
+        """
+        if self.exists():
+            os.remove(self.filename)
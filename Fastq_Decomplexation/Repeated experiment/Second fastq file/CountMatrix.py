@@ -0,0 +1,173 @@
+"""
+CountMatrix stores read counts of barcodes in every sample index in one NumPy array instead of a dictionary per barcode.
+
+Barcodes are kept in a list in the order they are added, and counts in an int32 matrix with one row per barcode and one
+column per sample index:
+
+                 sample index 1   sample index 2   ...   sample index 40
+    barcode 1  |                |                |     |                 |
+    barcode 2  |                |                |     |                 |
+
+The matrix is allocated with spare rows; when it is full, its capacity is doubled, so adding n barcodes only copies the
+matrix O(log n) times. A barcode with 40 counts takes 160 bytes in the matrix instead of a dictionary of 40 int objects.
+
+A CountMatrix can be saved as a compressed .npz file and converted into the table layout used downstream (a DataFrame
+with barcodes as index and sample indexes as columns) or into the {barcode: {sample index: count}} dictionaries of the
+older raw read pickles.
+"""
+import pickle
+import numpy as np
+import pandas as pd
+import TableIO
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+
+class CountMatrix:
+    """
+    CountMatrix object contains a list of barcodes, a dictionary that maps each barcode to its row and an int32 matrix
+    of counts whose capacity grows by doubling.
+    """
+    def __init__(self, sample_indexes, capacity=1024):
+        self.sample_indexes = list(sample_indexes)
+        self.columns = {sample_index: column for column, sample_index in enumerate(self.sample_indexes)}
+        self.barcodes = []
+        self.rows = {}
+        self.count_array = np.zeros((capacity, len(self.sample_indexes)), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.barcodes)
+
+    def __contains__(self, barcode):
+        return barcode in self.rows
+
+    def __getstate__(self):
+        # unused rows are not pickled, e.g. when a CountMatrix is sent from a worker process
+        state = self.__dict__.copy()
+        state['count_array'] = self.counts.copy()
+        return state
+
+    @property
+    def counts(self):
+        """
+        Counts of all barcodes added so far (a view of the used rows of the matrix).
+        """
+        return self.count_array[:len(self.barcodes)]
+
+    def add_barcode(self, barcode):
+        """
+        This function adds a barcode with zero counts, doubling the capacity of the matrix if it is full.
+
+        :param barcode: a barcode (str object) that is not in this CountMatrix yet
+        :return: row of the barcode (int object)
+        """
+        row = len(self.barcodes)
+        if row == len(self.count_array):
+            count_array = np.zeros((max(2 * row, 1024), len(self.sample_indexes)), dtype=np.int32)
+            count_array[:row] = self.count_array
+            self.count_array = count_array
+        self.barcodes.append(barcode)
+        self.rows[barcode] = row
+        return row
+
+    def row(self, barcode):
+        """
+        This function finds the row of a barcode, adding the barcode if it is new.
+
+        :param barcode: a barcode (str object)
+        :return: row of the barcode (int object)
+        """
+        row = self.rows.get(barcode)
+        if row is None:
+            row = self.add_barcode(barcode)
+        return row
+
+    def barcode_counts(self, barcode):
+        """
+        This function returns the counts of a barcode.
+
+        :param barcode: a barcode (str object)
+        :return: a dictionary that maps sample indexes to counts (int objects)
+        """
+        return dict(zip(self.sample_indexes, self.count_array[self.rows[barcode]].tolist()))
+
+    def to_dict(self):
+        """
+        This function converts counts into the {barcode: {sample index: count}} dictionaries of older raw read pickles.
+
+        :return: a dictionary ordered like self.barcodes
+        """
+        return {barcode: dict(zip(self.sample_indexes, row_counts))
+                for barcode, row_counts in zip(self.barcodes, self.counts.tolist())}
+
+    def to_dataframe(self):
+        """
+        This function converts counts into a table with one row per barcode and one column per sample index.
+
+        :return: a DataFrame of int64 counts
+        """
+        return pd.DataFrame(self.counts.astype(np.int64), index=pd.Index(self.barcodes, dtype=object),
+                            columns=self.sample_indexes)
+
+    def save_npz(self, filename):
+        """
+        This function saves barcodes, sample indexes and counts in a compressed .npz file.
+
+        :param filename: the name of the .npz file
+        """
+        with open(filename, 'wb') as handle:
+            np.savez_compressed(handle, barcodes=np.array(self.barcodes, dtype=str),
+                                sample_indexes=np.array(self.sample_indexes, dtype=str), counts=self.counts)
+
+    @classmethod
+    def from_arrays(cls, barcodes, sample_indexes, counts):
+        """
+        This function creates a CountMatrix from a list of barcodes and a matrix of counts.
+
+        :param barcodes: a list of barcodes (str objects) without duplicates
+        :param sample_indexes: a list of sample indexes (str objects)
+        :param counts: an integer matrix with shape (len(barcodes), len(sample_indexes))
+        :return: a CountMatrix object
+        """
+        count_matrix = cls(sample_indexes, capacity=0)
+        count_matrix.barcodes = list(barcodes)
+        count_matrix.rows = {barcode: row for row, barcode in enumerate(count_matrix.barcodes)}
+        count_matrix.count_array = np.array(counts, dtype=np.int32).reshape(len(count_matrix.barcodes),
+                                                                            len(count_matrix.sample_indexes))
+        return count_matrix
+
+    @classmethod
+    def load_npz(cls, filename):
+        """
+        This function loads a CountMatrix saved by save_npz.
+
+        :param filename: the name of the .npz file
+        :return: a CountMatrix object
+        """
+        with np.load(filename, allow_pickle=False) as arrays:
+            return cls.from_arrays(arrays['barcodes'].tolist(), arrays['sample_indexes'].tolist(), arrays['counts'])
+
+
+def read_table(filename):
+    """
+    This function reads raw read counts saved by SequenceDecomplexationOptimized.py, or a finished table, as a table
+    with one row per barcode and one column per sample index.
+
+    :param filename: the name of a .npz file, of a raw read pickle ({barcode: {sample index: count}}; the 'Barcodes'
+    entry added to older pickles by AllBarcode.print_raw_read is left out) or of a finished table (pickled DataFrame,
+    .parquet or .arrow file, see TableIO.py)
+    :return: a DataFrame
+    """
+    if filename.endswith('.npz'):
+        return CountMatrix.load_npz(filename).to_dataframe()
+    if filename.endswith('.parquet') or filename.endswith('.arrow'):
+        return TableIO.read_table(filename)
+    with open(filename, 'rb') as handle:
+        raw_reads = pickle.load(handle)
+    if isinstance(raw_reads, pd.DataFrame):
+        return raw_reads
+    table = pd.DataFrame.from_dict(raw_reads, orient='index')
+    return table.drop(columns='Barcodes', errors='ignore').astype(np.int64)
@@ -0,0 +1,144 @@
+"""
+PackedBarcode stores barcodes as 64-bit integers and computes Hamming distances between them with bit operations.
+
+Each base takes 2 bits (A = 00, C = 01, G = 10, T = 11), so a 30-bp barcode fits into one uint64. Our barcodes also
+contain N, which cannot be written with 2 bits. N is therefore encoded as A, and a second uint64 (N mask) has the lower
+bit of the base set wherever the base is N (any other character is treated as N as well).
+
+To compare two barcodes, their codes are XORed. A base differs if either of its two bits is set, so both bits are
+folded into the lower bit of the base. A base also differs if it is N in only one of the barcodes, which is exactly
+where the two N masks differ:
+
+    difference = ((x | (x >> 1)) & 0b0101...01) | (N mask 1 ^ N mask 2)      where x = code 1 ^ code 2
+
+The Hamming distance is the number of set bits (popcount) of this difference. All functions work on NumPy arrays, so a
+barcode can be compared with many barcodes (or many with many) at once.
+"""
+import numpy as np
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+max_length = 32
+lower_bits = np.uint64(0x5555555555555555)
+
+base_code = np.zeros(256, dtype=np.uint64)
+n_code = np.ones(256, dtype=np.uint64)
+for code, base in enumerate('ACGT'):
+    base_code[ord(base)] = code
+    n_code[ord(base)] = 0
+
+
+def encode(barcodes):
+    """
+    This function packs barcodes into codes and N masks.
+
+    :param barcodes: a list of barcodes (str objects) with equal lengths <= 32 or a uint8 matrix with a barcode per row
+    :return: a tuple (codes, N masks); both are uint64 arrays
+    """
+    if isinstance(barcodes, np.ndarray):
+        barcode_matrix = barcodes
+    elif len(barcodes) == 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint64)
+    else:
+        barcode_length = len(barcodes[0])
+        barcode_matrix = np.frombuffer(''.join(barcodes).encode('ascii'), dtype=np.uint8).reshape(-1, barcode_length)
+    assert (barcode_matrix.shape[1] <= max_length), "Barcodes must not be longer than " + str(max_length) + " bases!"
+
+    shifts = (2 * np.arange(barcode_matrix.shape[1])).astype(np.uint64)
+    # bits of different bases never overlap, so summing them up is the same as combining them with OR
+    codes = (base_code[barcode_matrix] << shifts).sum(axis=1, dtype=np.uint64)
+    n_masks = (n_code[barcode_matrix] << shifts).sum(axis=1, dtype=np.uint64)
+    return codes, n_masks
+
+
+def decode(codes, n_masks, barcode_length=30):
+    """
+    This function unpacks codes and N masks back into barcodes.
+
+    :param codes: a uint64 array of codes
+    :param n_masks: a uint64 array of N masks
+    :param barcode_length: number of bases in each barcode
+    :return: a list of barcodes (str objects)
+    """
+    shifts = (2 * np.arange(barcode_length)).astype(np.uint64)
+    base_matrix = (np.asarray(codes, dtype=np.uint64)[:, None] >> shifts) & np.uint64(3)
+    n_matrix = (np.asarray(n_masks, dtype=np.uint64)[:, None] >> shifts) & np.uint64(1)
+    letter_matrix = np.frombuffer(b'ACGT', dtype=np.uint8)[base_matrix.astype(np.intp)]
+    letter_matrix[n_matrix.astype(bool)] = ord('N')
+    joined = letter_matrix.tobytes().decode('ascii')
+    return [joined[start:start + barcode_length] for start in range(0, len(joined), barcode_length)]
+
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(values):
+        """
+        This function counts set bits of every element of a uint64 array.
+
+        :param values: a uint64 array
+        :return: an array with the number of set bits of each element
+        """
+        return np.bitwise_count(values)
+else:
+    def popcount(values):
+        """
+        This function counts set bits of every element of a uint64 array (SWAR algorithm for NumPy < 2.0).
+
+        :param values: a uint64 array
+        :return: an array with the number of set bits of each element
+        """
+        values = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+        values = (values & np.uint64(0x3333333333333333)) + ((values >> np.uint64(2)) & np.uint64(0x3333333333333333))
+        values = (values + (values >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        return (values * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def hamming_distance(codes_1, n_masks_1, codes_2, n_masks_2):
+    """
+    This function evaluates Hamming distances between packed barcodes. Arrays are broadcast against each other, so
+    one-vs-many and element-wise comparisons are both possible.
+
+    :param codes_1: codes of the first barcodes
+    :param n_masks_1: N masks of the first barcodes
+    :param codes_2: codes of the second barcodes
+    :param n_masks_2: N masks of the second barcodes
+    :return: an array of # of differences
+    """
+    difference = np.bitwise_xor(codes_1, codes_2)
+    difference = ((difference | (difference >> np.uint64(1))) & lower_bits) | np.bitwise_xor(n_masks_1, n_masks_2)
+    return popcount(difference)
+
+
+def pairwise_hamming_distance(codes_1, n_masks_1, codes_2, n_masks_2):
+    """
+    This function evaluates Hamming distances between every barcode of the first group and every barcode of the second.
+
+    :return: a matrix of # of differences with shape (len(codes_1), len(codes_2))
+    """
+    return hamming_distance(np.asarray(codes_1)[:, None], np.asarray(n_masks_1)[:, None],
+                            np.asarray(codes_2)[None, :], np.asarray(n_masks_2)[None, :])
+
+
+def first_match(codes_1, n_masks_1, codes_2, n_masks_2, max_distance=5, chunk_size=1024):
+    """
+    This function finds, for every barcode of the first group, the first barcode of the second group that is within
+    max_distance Hamming distances. Barcodes of the first group are compared in chunks to bound memory usage.
+
+    :param max_distance: maximum number of differences
+    :param chunk_size: number of barcodes of the first group compared at once
+    :return: an array of positions in the second group (-1 if there is no barcode within max_distance)
+    """
+    codes_1 = np.asarray(codes_1)
+    n_masks_1 = np.asarray(n_masks_1)
+    matches = np.full(len(codes_1), -1, dtype=np.int64)
+    if len(codes_2) == 0:
+        return matches
+    for start in range(0, len(codes_1), chunk_size):
+        within_distance = pairwise_hamming_distance(codes_1[start:start + chunk_size],
+                                                    n_masks_1[start:start + chunk_size],
+                                                    codes_2, n_masks_2) <= max_distance
+        found = within_distance.any(axis=1)
+        matches[start:start + chunk_size][found] = within_distance[found].argmax(axis=1)
+    return matches
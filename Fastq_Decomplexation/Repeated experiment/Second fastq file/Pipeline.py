@@ -0,0 +1,255 @@
+"""
+Pipeline decomplexes one large FASTQ file in three stages that run at the same time, so that reading, quality control
+and barcode collapse do not have to wait for each other:
+
+1.Reader - a thread reads the file (decompressing it if needed) and cuts it into chunks of batch_size FASTQ records
+without parsing them.
+
+2.Quality control - a pool of worker processes parses chunks and checks them with NumPy (see BatchQualityControl.py).
+Each worker returns the counts of (barcode, sample index) pairs of good reads in the order they are first seen, together
+with the numbers of bad reads.
+
+3.Collapse - the main process is the only owner of the AllBarcode object. It takes the results in the order of the
+chunks, so barcodes are collapsed exactly as with --batch-size in one process. With sample shards, the collapse owner
+only routes the reads of every chunk to collapse worker processes by sample index and reconciles their barcodes at the
+end (see SampleShards.py).
+
+    reader thread --> [chunk queue] --> QC workers --> [result queue] --> collapse owner
+
+Both queues are bounded, so a slow stage makes the stage before it wait instead of filling up the memory. The time
+every stage spends waiting on a full or an empty queue is reported at the end (back-pressure): a stage that rarely waits
+is the bottleneck, e.g. when the reader is always blocked on a full chunk queue, more QC workers would help, and when
+the collapse owner is always waiting for results, the collapse is not the limiting stage.
+"""
+import concurrent.futures
+import datetime
+import io
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import BatchQualityControl
+import FastqReader
+import Telemetry
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+default_batch_size = 100000
+# QC workers are started by a server process instead of being forked from this process: they are only started once the
+# reader thread is running, and a worker forked while that thread holds the lock of standard input would wait for it
+# forever when it closes standard input at startup
+worker_start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+class BoundedQueue(queue.Queue):
+    """
+    BoundedQueue object is a queue.Queue with a maximum size that records how long producers waited on a full queue and
+    consumers on an empty one.
+    """
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+        self.items = 0
+        self.peak_size = 0
+
+    def put(self, item, block=True, timeout=None):
+        started = time.perf_counter()
+        super().put(item, block, timeout)
+        self.put_wait += time.perf_counter() - started
+        self.items += 1
+        self.peak_size = max(self.peak_size, self.qsize())
+
+    def get(self, block=True, timeout=None):
+        started = time.perf_counter()
+        item = super().get(block, timeout)
+        self.get_wait += time.perf_counter() - started
+        return item
+
+
+def read_chunks(filename, batch_size, chunk_queue):
+    """
+    This function runs in the reader thread and puts chunks of batch_size FASTQ records (bytes objects) into
+    chunk_queue. None marks the end of the file and an exception is handed over to be raised by the consumer.
+
+    :param filename: the name of a FASTQ file (uncompressed, gzip or BGZF), '-' for standard input or a named pipe
+    :param batch_size: number of records per chunk
+    :param chunk_queue: a BoundedQueue object
+    """
+    try:
+        records = FastqReader.iterate_records(FastqReader.open_lines(filename))
+        while True:
+            chunk = b''.join(itertools.islice(records, batch_size))
+            if not chunk:
+                break
+            chunk_queue.put(chunk)
+        chunk_queue.put(None)
+    except Exception as error:
+        chunk_queue.put(error)
+
+
+def quality_control_chunk(chunk, anchor=False):
+    """
+    This function parses a chunk of FASTQ records and checks the quality of its reads. It runs in a worker process.
+
+    :param chunk: FASTQ records (bytes object)
+    :param anchor: search reads failing the constant region check for their constant regions (see AnchorSearch.py)
+    :return: a tuple (dictionary that maps (barcode, sample index) tuples of good reads to their number of reads in the
+    order they are first seen, # of reads, # of bad barcode reads, # of bad constant reads, # of bad sample index reads,
+    # of good reads found by the anchor search)
+    """
+    sequences = []
+    qualities = []
+    for title, sequence, quality in FastqReader.iterate_fastq(io.BytesIO(chunk)):
+        sequences.append(sequence)
+        qualities.append(quality)
+    barcodes, sample_indexes, bad_barcode, bad_constant, bad_sample_index, anchored = \
+        BatchQualityControl.quality_control_block(sequences, qualities, anchor)
+    read_id_counter = {}
+    for read_id in zip(barcodes, sample_indexes):
+        read_id_counter[read_id] = read_id_counter.get(read_id, 0) + 1
+    return read_id_counter, len(sequences), bad_barcode, bad_constant, bad_sample_index, anchored
+
+
+def submit_chunks(executor, chunk_queue, result_queue, anchor=False):
+    """
+    This function runs in the dispatcher thread; it hands chunks over to the QC workers and puts their futures into
+    result_queue in the order of the chunks. Because result_queue is bounded, at most its size chunks are being checked
+    or waiting to be collapsed at any time.
+
+    :param executor: a concurrent.futures executor of QC workers
+    :param chunk_queue: a BoundedQueue object filled by read_chunks
+    :param result_queue: a BoundedQueue object emptied by the collapse owner
+    :param anchor: search reads failing the constant region check for their constant regions
+    """
+    try:
+        while True:
+            chunk = chunk_queue.get()
+            if chunk is None or isinstance(chunk, Exception):
+                result_queue.put(chunk)
+                return
+            result_queue.put(executor.submit(quality_control_chunk, chunk, anchor))
+    except Exception as error:
+        result_queue.put(error)
+
+
+def collapse_fastq(filename, all_barcode_list, batch_size=None, qc_workers=None, queue_size=None, anchor=False,
+                   telemetry=None, sample_shards=None):
+    """
+    This function checks and collapses all reads of a FASTQ file with a reader thread, a pool of QC worker processes
+    and the calling process as the only collapse owner.
+
+    :param filename: the name of a FASTQ file (uncompressed, gzip or BGZF), '-' for standard input or a named pipe
+    :param all_barcode_list: an AllBarcode object that collects reads passing all quality metrics
+    :param batch_size: number of reads per chunk (default: default_batch_size)
+    :param qc_workers: number of QC worker processes (default: number of CPUs)
+    :param queue_size: maximum number of chunks in each queue (default: 2 per QC worker)
+    :param anchor: search reads failing the constant region check for their constant regions (see AnchorSearch.py)
+    :param telemetry: a Telemetry object that a record is appended to after every chunk (see Telemetry.py); the time
+    the collapse owner waits for results is recorded as 'waiting_for_results'
+    :param sample_shards: a SampleShards object that collapses reads in worker processes by sample index (see
+    SampleShards.py); its barcodes are reconciled into all_barcode_list
+    :return: a tuple (read_counts, stage_stats); read_counts is the dictionary returned by Functions.collapse_fastq and
+    stage_stats a dictionary of back-pressure statistics of each stage (see report_stage_stats)
+    """
+    batch_size = batch_size or default_batch_size
+    qc_workers = qc_workers or os.cpu_count()
+    queue_size = queue_size or 2 * qc_workers
+    with concurrent.futures.ProcessPoolExecutor(qc_workers,
+                                                mp_context=multiprocessing.get_context(worker_start_method)) as executor:
+        chunk_queue = BoundedQueue(queue_size)
+        result_queue = BoundedQueue(queue_size)
+        started = time.perf_counter()
+        reader = threading.Thread(target=read_chunks, args=(filename, batch_size, chunk_queue), daemon=True)
+        dispatcher = threading.Thread(target=submit_chunks, args=(executor, chunk_queue, result_queue, anchor),
+                                      daemon=True)
+        if sample_shards is not None:
+            sample_shards.start()
+        reader.start()
+        dispatcher.start()
+
+        read_counts = {'all_reads': 0, 'good_reads': 0, 'bad_barcode_reads': 0, 'bad_constant_reads': 0,
+                       'bad_sample_index_reads': 0}
+        if anchor:
+            read_counts['anchored_reads'] = 0
+        result_wait = 0.0
+        collapse_time = 0.0
+        while True:
+            future = result_queue.get()
+            if future is None:
+                break
+            if isinstance(future, Exception):
+                raise future
+            waiting = time.perf_counter()
+            read_id_counter, all_reads, bad_barcode, bad_constant, bad_sample_index, anchored = future.result()
+            collapsing = time.perf_counter()
+            result_wait += collapsing - waiting
+
+            if sample_shards is not None:
+                sample_shards.add_reads(read_id_counter)
+            else:
+                for read_id, read_count in read_id_counter.items():
+                    all_barcode_list.add_read(read_id, read_count)
+            collapsed = time.perf_counter()
+            collapse_time += collapsed - collapsing
+
+            read_counts['all_reads'] += all_reads
+            read_counts['good_reads'] += sum(read_id_counter.values())
+            read_counts['bad_barcode_reads'] += bad_barcode
+            read_counts['bad_constant_reads'] += bad_constant
+            read_counts['bad_sample_index_reads'] += bad_sample_index
+            if anchor:
+                read_counts['anchored_reads'] += anchored
+            if telemetry is not None:
+                # reading and quality control run in other threads and processes, so the collapse owner can only
+                # tell how long it waited for them
+                telemetry.add_time('collapse', collapsed - collapsing)
+                telemetry.add_time('waiting_for_results', telemetry.interval_elapsed() - (collapsed - collapsing))
+                # barcodes held by collapse workers are only known once they are reconciled
+                telemetry.record(read_counts, None if sample_shards is not None else
+                                 Telemetry.clusters(all_barcode_list))
+            print(str(read_counts['all_reads']) + ' reads have been parsed at ' + str(datetime.datetime.now()))
+        reader.join()
+        dispatcher.join()
+        reconcile_time = 0.0
+        if sample_shards is not None:
+            print('reconciling barcodes of sample shards at ' + str(datetime.datetime.now()))
+            reconciling = time.perf_counter()
+            sample_shards.reconcile(all_barcode_list)
+            reconcile_time = time.perf_counter() - reconciling
+            if telemetry is not None:
+                telemetry.add_time('reconcile', reconcile_time)
+                telemetry.record(read_counts, Telemetry.clusters(all_barcode_list), 'reconcile')
+        elapsed = time.perf_counter() - started
+
+    # the last item of the chunk queue marks the end of the file
+    stage_stats = {
+        'reader': {'chunks': chunk_queue.items - 1, 'blocked_on_full_queue': chunk_queue.put_wait},
+        'quality_control': {'workers': qc_workers, 'waiting_for_chunks': chunk_queue.get_wait,
+                            'blocked_on_full_queue': result_queue.put_wait,
+                            'peak_chunks_queued': chunk_queue.peak_size},
+        'collapse': {'waiting_for_results': result_queue.get_wait + result_wait, 'collapsing': collapse_time,
+                     'peak_results_queued': result_queue.peak_size},
+        'elapsed': elapsed}
+    if sample_shards is not None:
+        stage_stats['collapse'].update(sample_shards.stats())
+        stage_stats['collapse']['reconciling'] = reconcile_time
+    return read_counts, stage_stats
+
+
+def report_stage_stats(stage_stats):
+    """
+    This function prints the back-pressure statistics returned by collapse_fastq.
+
+    :param stage_stats: a dictionary of statistics of each stage
+    """
+    print('\nPipeline stages (' + '%.1f' % stage_stats['elapsed'] + ' s in total)')
+    for stage in ['reader', 'quality_control', 'collapse']:
+        stats = [key.replace('_', ' ') + ' ' + ('%.1f s' % value if isinstance(value, float) else str(value))
+                 for key, value in stage_stats[stage].items()]
+        print(stage.replace('_', ' ') + ': ' + ', '.join(stats))
@@ -8,7 +8,13 @@ their similarities to constant regions based on our assigned Hamming distance th
 
 2.Barcode Collapse - this software combines reads with very few counts, produced by PCR- or NGS-based error, with the ones
 with higher abundance. This software assumes reads with higher number of reads are less likely to be created by errors
-while ones with fewer are.
+while ones with fewer are. By default (collapse='greedy') reads are collapsed in file order into the earliest barcode
+within 5 Hamming distances; with collapse='abundance' exact barcodes are counted first and then clustered from the most
+to the least abundant one, which does not depend on the order of reads (see AllBarcode.finish_collapse); with
+collapse='graph' exact barcodes are clustered as the connected components of their neighbour graph, which is built by
+several processes (see BarcodeGraph.py). When the
+lineages are already known from an earlier finished table (--whitelist), reads are assigned to the nearest known barcode
+within 5 Hamming distances, and the remaining reads are either left out or collapsed into new barcodes (--discover).
 
 3.Count Normalization - this software calculates total number of counts then produces normalized counts for barcodes with
 distinct sample indexes.
@@ -32,9 +38,21 @@ import Constants
 import pickle
 import csv
 import datetime
-import sys
-
-from Bio import SeqIO
+import argparse
+import time
+import FastqReader
+import GzipInput
+import AnchorSearch
+import BatchQualityControl
+import Pipeline
+import Telemetry
+import BarcodeGraph
+import ClusterMembership
+from Checkpoint import Checkpoint
+from SampleShards import SampleShards
+import numpy as np
+from BarcodeIndex import BarcodeIndex
+from CountMatrix import CountMatrix, read_table
 
 __author__ = 'Tee Udomlumleart'
 __maintainer__ = 'Tee Udomlumleart'
@@ -50,74 +68,288 @@ class Reference:
 
 class AllBarcode(Reference):
     """
-    AllBarcode object contains a dictionary that maps a tuple (barcode, sample index) to a corresponding Reads object.
+    AllBarcode object contains a CountMatrix (see CountMatrix.py) with one row of counts per collapsed barcode and one
+    column per sample index.
+
+    With collapse='abundance' or collapse='graph', reads are only counted per exact barcode in self.exact_counts while
+    they are added, and self.counts is filled by finish_collapse.
+
+    With a whitelist of known barcodes, self.counts starts with one row per whitelist barcode (in whitelist order, also
+    for barcodes without reads) and the whitelist is indexed once in self.whitelist_index. Reads within 5 Hamming
+    distances of a whitelist barcode are assigned to the nearest one; other reads are collapsed into new barcodes with
+    discover=True and counted in self.unassigned_reads otherwise.
+
+    With membership=True, self.membership records which barcodes of the reads were collapsed into which barcode of
+    self.counts (see ClusterMembership.py).
     """
-    def __init__(self):
-        self.list = {}
+    collapse_choices = ['greedy', 'abundance', 'graph']
+    # collapse methods that count exact barcodes first and cluster them in finish_collapse
+    exact_collapse_choices = ['abundance', 'graph']
+    raw_read_formats = ['pickle', 'npz']
+
+    def __init__(self, packed=False, collapse='greedy', whitelist=None, discover=False, membership=False):
+        assert (collapse in AllBarcode.collapse_choices), "Unknown collapse method: " + str(collapse)
+        self.collapse = collapse
+        self.counts = CountMatrix(Constants.sample_index_dict.values())
+        self.exact_counts = CountMatrix(Constants.sample_index_dict.values())
+        self.index = BarcodeIndex(packed=packed)
+        self.whitelist_index = None
+        self.discover = discover
+        self.unassigned_reads = 0
+        self.membership = ClusterMembership.MembershipLog() if membership else None
+        if whitelist is not None:
+            # whitelist barcodes take the first rows of self.counts, so their ids in the index are also their rows
+            self.whitelist_index = BarcodeIndex(packed=packed)
+            for barcode in whitelist:
+                if barcode not in self.counts:
+                    self.whitelist_index.add(barcode)
+                    self.counts.add_barcode(barcode)
         self.sample_index_total_count = {sample_index: 0 for sample_index in list(Constants.sample_index_dict.values())}
 
     def __len__(self):
-        return len(self.list)
+        return len(self.counts)
 
     def __getitem__(self, item):
         """
-        This function accepts a tuple (barcode, sample index) and return a Reads object, if such object exist.
+        This function accepts a tuple (barcode, sample index) and return the number of reads of that barcode in that
+        sample index, if such barcode exist.
 
         :param item: a tuple (barcode, sample index)
-        :return: a corresponding Reads object
+        :return: a number of reads (int object)
         """
-        return self.list[item[0]][item[1]]
+        return int(self.counts.count_array[self.counts.rows[item[0]], self.counts.columns[item[1]]])
 
-    def add_read(self, id_tuple):
+    def add_read(self, id_tuple, count=1):
         """
-        This function adds a Reads object to self.list if such object has not been already added.
+        This function adds a barcode to self.counts if such barcode has not been already added.
 
-        Otherwise, this function adds one more count to that read.
+        Otherwise, this function adds one more count to that read. The barcode is assigned to the earliest added barcode
+        within 5 Hamming distances, which is looked up through a pigeonhole block index (see BarcodeIndex.py).
 
-        :param id_tuple: a tuple (barcode, sample index) used to identify Reads object
+        :param id_tuple: a tuple (barcode, sample index) used to identify the read
+        :param count: number of identical reads represented by this tuple
         """
         new_barcode, new_sample_index = id_tuple
-        added_flag = False
-        for parsed_barcode in self.list:
-            if Functions.hamming_distance(parsed_barcode, new_barcode) <= 5:
-                self.list[parsed_barcode][new_sample_index] += 1
-                self.sample_index_total_count[new_sample_index] += 1
-                added_flag = True
-                break
-        if not added_flag:
-            self.list[new_barcode] = {sample_index: 0 for sample_index in list(Constants.sample_index_dict.values())}
-            self.list[new_barcode][new_sample_index] += 1
-            self.sample_index_total_count[new_sample_index] += 1
+        if self.collapse in AllBarcode.exact_collapse_choices:
+            count_matrix = self.exact_counts
+            row = count_matrix.row(new_barcode)
+        else:
+            count_matrix = self.counts
+            row = self.assign_barcode(new_barcode)
+            if self.membership is not None:
+                self.membership.append(-1 if row is None else row, new_barcode, count)
+            if row is None:
+                self.unassigned_reads += count
+                return
+        count_matrix.count_array[row, count_matrix.columns[new_sample_index]] += count
+        self.sample_index_total_count[new_sample_index] += count
+
+    def add_barcode(self, new_barcode, counts):
+        """
+        This function adds all counts of a barcode collapsed by another AllBarcode object, e.g. from another part of
+        the same fastq file.
+
+        :param new_barcode: a barcode (str object)
+        :param counts: an array of counts of this barcode in the order of Constants.sample_index_dict
+        :return: row of the barcode in self.counts (in self.exact_counts with collapse='abundance' or 'graph'), or
+        None if it is left out; used to carry over the membership of the other AllBarcode object (see
+        merge_membership)
+        """
+        if self.collapse in AllBarcode.exact_collapse_choices:
+            count_matrix = self.exact_counts
+            row = count_matrix.row(new_barcode)
+        else:
+            count_matrix = self.counts
+            row = self.assign_barcode(new_barcode)
+            if row is None:
+                self.unassigned_reads += int(counts.sum())
+                return None
+        count_matrix.count_array[row] += counts
+        for sample_index, count in zip(count_matrix.sample_indexes, counts.tolist()):
+            self.sample_index_total_count[sample_index] += count
+        return row
+
+    def merge_membership(self, membership, rows):
+        """
+        This function carries over the membership of another AllBarcode object whose barcodes have been added with
+        add_barcode. With collapse='abundance' or 'graph', the membership is recorded by finish_collapse instead.
+
+        :param membership: the MembershipLog object of the other AllBarcode object (or None)
+        :param rows: rows returned by add_barcode for the barcodes of the other AllBarcode object, in their order
+        """
+        if self.membership is None or membership is None or self.collapse in AllBarcode.exact_collapse_choices:
+            return
+        self.membership.merge(membership, [-1 if row is None else row for row in rows])
+
+    def finish_collapse(self, processes=None):
+        """
+        This function clusters the exact barcodes counted with collapse='abundance' or collapse='graph' into
+        self.counts. Nothing is left to do with collapse='greedy', where reads are collapsed as soon as they are added.
+
+        Exact barcodes are visited from the most to the least abundant one (ties broken alphabetically), and a barcode
+        is collapsed into the most abundant collapsed barcode within 5 Hamming distances if that barcode has at least
+        2 * n - 1 reads, where n is the number of reads of the collapsed barcode (the directional rule of UMI-tools).
+        Otherwise it is added to self.counts as a new barcode. Collapsed barcodes are added to the index in descending
+        abundance, so the earliest barcode found by the index is also the most abundant one.
+
+        Every exact barcode is compared once, however many reads it has, and the result only depends on the exact
+        counts, not on the order of reads. Exact counts of several parts of a fastq file can therefore be summed up
+        with add_barcode in any order before they are clustered.
+
+        With collapse='graph', exact barcodes are clustered into the connected components of their neighbour graph
+        instead (see BarcodeGraph.py); components are added to self.counts in descending abundance.
+
+        With a whitelist, exact barcodes near a whitelist barcode are assigned to it first, and only the other ones are
+        clustered (with discover=True) or left out.
+
+        :param processes: number of processes that build the neighbour graph with collapse='graph' (default: number of
+        CPUs)
+        """
+        if self.collapse == 'graph':
+            self.finish_graph_collapse(processes)
+            return
+        if self.collapse != 'abundance':
+            return
+        exact_barcodes = self.exact_counts.barcodes
+        abundance = self.exact_counts.counts.sum(axis=1, dtype=np.int64).tolist()
+        exact_abundance = dict(zip(exact_barcodes, abundance))
+        parsed_rows = np.zeros(len(exact_barcodes), dtype=np.intp)
+        for exact_row in sorted(range(len(exact_barcodes)), key=lambda row: (-abundance[row], exact_barcodes[row])):
+            barcode = exact_barcodes[exact_row]
+            if self.whitelist_index is not None:
+                whitelist_row = self.whitelist_index.nearest(barcode)
+                if whitelist_row is not None or not self.discover:
+                    parsed_rows[exact_row] = -1 if whitelist_row is None else whitelist_row
+                    continue
+            parsed_barcode = self.index.find(barcode)
+            if parsed_barcode is None or exact_abundance[parsed_barcode] < 2 * abundance[exact_row] - 1:
+                self.index.add(barcode)
+                parsed_barcode = barcode
+            parsed_rows[exact_row] = self.counts.row(parsed_barcode)
+        self.add_exact_counts(parsed_rows)
+
+    def finish_graph_collapse(self, processes=None):
+        """
+        This function clusters the exact barcodes counted with collapse='graph' into self.counts (see finish_collapse).
+
+        :param processes: number of processes that build the neighbour graph
+        """
+        exact_barcodes = self.exact_counts.barcodes
+        parsed_rows = np.zeros(len(exact_barcodes), dtype=np.intp)
+        clustered = np.ones(len(exact_barcodes), dtype=bool)
+        if self.whitelist_index is not None:
+            for exact_row, barcode in enumerate(exact_barcodes):
+                whitelist_row = self.whitelist_index.nearest(barcode)
+                if whitelist_row is not None or not self.discover:
+                    parsed_rows[exact_row] = -1 if whitelist_row is None else whitelist_row
+                    clustered[exact_row] = False
+        clustered_rows = np.flatnonzero(clustered)
+        representatives, components = BarcodeGraph.cluster(
+            [exact_barcodes[exact_row] for exact_row in clustered_rows.tolist()],
+            self.exact_counts.counts[clustered_rows].sum(axis=1, dtype=np.int64), processes)
+        component_rows = np.zeros(len(representatives), dtype=np.intp)
+        for component, barcode in enumerate(representatives):
+            self.index.add(barcode)
+            component_rows[component] = self.counts.row(barcode)
+        parsed_rows[clustered_rows] = component_rows[components]
+        self.add_exact_counts(parsed_rows)
+
+    def add_exact_counts(self, parsed_rows):
+        """
+        This function adds the exact counts to the rows of self.counts they have been clustered into and starts a new
+        empty self.exact_counts.
 
+        :param parsed_rows: row in self.counts of every exact barcode (-1 for exact barcodes left out)
+        """
+        if self.membership is not None:
+            self.membership.extend_barcodes(parsed_rows, self.exact_counts.barcodes,
+                                            self.exact_counts.counts.sum(axis=1, dtype=np.int64))
+        assigned = parsed_rows >= 0
+        np.add.at(self.counts.count_array, parsed_rows[assigned], self.exact_counts.counts[assigned])
+        unassigned_counts = self.exact_counts.counts[~assigned].sum(axis=0, dtype=np.int64).tolist()
+        for sample_index, count in zip(self.counts.sample_indexes, unassigned_counts):
+            self.sample_index_total_count[sample_index] -= count
+        self.unassigned_reads += sum(unassigned_counts)
+        self.exact_counts = CountMatrix(self.counts.sample_indexes)
+
+    def assign_barcode(self, new_barcode):
+        """
+        This function finds the barcode in self.counts that a new barcode is collapsed into, adding the new barcode to
+        self.counts if there is none.
 
-    def print_raw_read(self):
+        :param new_barcode: a barcode (str object)
+        :return: row of the barcode in self.counts (int object), or None if there is a whitelist, no whitelist barcode
+        is within 5 Hamming distances and new barcodes are not discovered
+        """
+        # a barcode that is already in self.counts is always assigned to itself because, when it was added, no earlier
+        # barcode was within 5 Hamming distances from it
+        row = self.counts.rows.get(new_barcode)
+        if row is not None:
+            return row
+
+        # whitelist barcodes are looked up first; their ids in the whitelist index are their rows in self.counts
+        if self.whitelist_index is not None:
+            row = self.whitelist_index.nearest(new_barcode)
+            if row is not None or not self.discover:
+                return row
+
+        # only barcodes sharing at least one block with the new barcode can be within 5 Hamming distances
+        parsed_barcode = self.index.find(new_barcode)
+        if parsed_barcode is None:
+            self.index.add(new_barcode)
+            return self.counts.add_barcode(new_barcode)
+        return self.counts.rows[parsed_barcode]
+
+    def print_raw_read(self, output_prefix):
         """
         This function print read counts and print them via a CSV file.
+
+        :param output_prefix: the CSV file is named output_prefix + '_raw_read_correct.csv'
         """
-        with open(str(file)+'_raw_read_correct'+'.csv', mode='w') as csv_file:
-            fieldnames = ['Barcodes'] + list(Constants.sample_index_dict.values())
-            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-            writer.writeheader()
-            for parsed_barcode in self.list:
-                for sample_index in self.list[parsed_barcode]:
-                    self.list[parsed_barcode][sample_index] = self.list[parsed_barcode][sample_index]
-                self.list[parsed_barcode]['Barcodes'] = parsed_barcode
-                writer.writerow(self.list[parsed_barcode])
+        with open(str(output_prefix)+'_raw_read_correct'+'.csv', mode='w') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['Barcodes'] + self.counts.sample_indexes)
+            for parsed_barcode, barcode_counts in zip(self.counts.barcodes, self.counts.counts.tolist()):
+                writer.writerow([parsed_barcode] + barcode_counts)
 
-    def save_pickle(self):
+    def save_pickle(self, output_prefix):
         """
         This function saves this data structure ({barcodes: {sample index: count}}) in a pickle form that is ready to be
         worked with in the future
+
+        :param output_prefix: the pickle file is named output_prefix + '_raw_read_correct.pickle'
         """
-        with open(str(file)+'_raw_read_correct'+'.pickle', 'wb') as handle:
-            pickle.dump(self.list, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(str(output_prefix)+'_raw_read_correct'+'.pickle', 'wb') as handle:
+            pickle.dump(self.counts.to_dict(), handle, protocol=pickle.HIGHEST_PROTOCOL)
 
+    def save_npz(self, output_prefix):
+        """
+        This function saves barcodes and the count matrix in a compressed .npz file, which is smaller and faster to load
+        than the pickle (see CountMatrix.read_table).
+
+        :param output_prefix: the file is named output_prefix + '_raw_read_correct.npz'
+        """
+        self.counts.save_npz(str(output_prefix)+'_raw_read_correct'+'.npz')
+
+    def save_membership(self, output_prefix, membership_format='npz'):
+        """
+        This function saves which barcodes of the reads were collapsed into every barcode (see ClusterMembership.py).
+
+        :param output_prefix: the file is named output_prefix + '_membership.npz' (or '.parquet')
+        :param membership_format: 'npz' or 'parquet'
+        :return: the name of the saved file
+        """
+        return ClusterMembership.save_membership(self.membership, output_prefix, self.counts.barcodes,
+                                                 membership_format)
 
 
 class Functions:
     """
     Functions object contains miscellaneous functions that are important for analyzing reads from a fastq file.
     """
+    # maximum number of unique read sequences that are counted before they are collapsed into AllBarcode
+    unique_read_limit = 5000000
+
     @staticmethod
     def hamming_distance(sequence_1, sequence_2):
         """
@@ -131,7 +363,269 @@ class Functions:
         return sum(alphabet1 != alphabet2 for alphabet1, alphabet2 in zip(sequence_1, sequence_2))
 
     @staticmethod
-    def reading_fastq():
+    def read_whitelist(filename):
+        """
+        This function reads known barcodes, e.g. the lineages of an earlier finished table, to be used as a whitelist.
+
+        :param filename: a finished table or raw read file (see CountMatrix.read_table) or a .txt file with one barcode
+        per line
+        :return: a list of barcodes (str objects)
+        """
+        if filename.endswith('.txt'):
+            with open(filename) as handle:
+                return [line.strip() for line in handle if line.strip()]
+        return [str(barcode) for barcode in read_table(filename).index]
+
+    @staticmethod
+    def collapse_unique_reads(read_counter, all_barcode_list, anchor=False, telemetry=None):
+        """
+        This function checks constant regions and sample indexes of unique reads and adds the ones passing both checks
+        to all_barcode_list. Each unique read is weighted by the number of times it has been sequenced.
+
+        :param read_counter: a dictionary that maps a read sequence (first 129 bases, or the whole read with
+        anchor=True) to its number of reads
+        :param all_barcode_list: an AllBarcode object that collects reads passing all quality metrics
+        :param anchor: search reads failing the constant region check for their constant regions at other positions
+        (see AnchorSearch.py)
+        :param telemetry: a Telemetry object that gets the time of the checks ('quality_control') and of adding reads
+        to all_barcode_list ('collapse'), or None
+        :return: a tuple (# of good reads, # of bad constant reads, # of bad sample index reads, # of good reads found
+        by the anchor search)
+        """
+        checking = time.perf_counter()
+        sample_index_lookup = Constants.sample_index_lookup
+        # reads passing both checks are added after all checks, in the order of read_counter, so both stages are timed
+        # separately as in the batch path
+        good_read_ids = []
+        good_reads = 0
+        bad_constant_reads = 0
+        bad_sample_index_reads = 0
+        anchored_reads = 0
+
+        for read_sequence, read_count in read_counter.items():
+            # Check the errors in the constant regions
+            # Hamming errors in the first constant region <= 5 and Hamming errors in the second region <= 2
+            if len(read_sequence) < 129 or \
+                    Functions.hamming_distance(Constants.constant_1, read_sequence[30:95]) > 5 or \
+                    Functions.hamming_distance(Constants.constant_2, read_sequence[105:129]) > 2:
+                located = AnchorSearch.locate(read_sequence) if anchor else None
+                if located is None:
+                    bad_constant_reads += read_count
+                    continue
+                read_barcode, read_sample_index_sequence = located
+                anchored = True
+            else:
+                read_barcode = read_sequence[:30]
+                read_sample_index_sequence = read_sequence[95:105]
+                anchored = False
+
+            # Errors in the sample index region must be <= 1 in order to be assigned; sequences within 1 Hamming
+            # distance of more than one sample index are not in the lookup table, and sequences with other characters
+            # than ACGTN are compared with every sample index instead (see Constants.py)
+            read_sample_index = sample_index_lookup.get(read_sample_index_sequence) or \
+                Constants.scan_sample_index(read_sample_index_sequence)
+            if read_sample_index is None:
+                bad_sample_index_reads += read_count
+                continue
+
+            good_read_ids.append(((read_barcode, read_sample_index), read_count))
+            good_reads += read_count
+            if anchored:
+                anchored_reads += read_count
+
+        collapsing = time.perf_counter()
+        for read_id, read_count in good_read_ids:
+            all_barcode_list.add_read(read_id, read_count)
+        if telemetry is not None:
+            telemetry.add_time('quality_control', collapsing - checking)
+            telemetry.add_time('collapse', time.perf_counter() - collapsing)
+
+        return good_reads, bad_constant_reads, bad_sample_index_reads, anchored_reads
+
+    @staticmethod
+    def collapse_fastq(filename, fastq_parser='native', batch_size=None, packed=False, start=0, end=None,
+                       collapse='greedy', whitelist=None, discover=False, anchor=False, checkpoint=None,
+                       telemetry=None, membership=False):
+        """
+        This function checks the quality of reads in a fastq file (or a part of it) and collapses reads that pass all
+        quality metrics described in Functions.reading_fastq into an AllBarcode object.
+
+        :param filename: the name of fastq file containing reads we want to analyze
+        :param fastq_parser: 'native' to read the fastq file with FastqReader.iterate_fastq, 'biopython' to use
+        Bio.SeqIO (slower, kept to validate the native parser) or 'mmap' to map an uncompressed file (see
+        MappedFastq.py)
+        :param batch_size: if given, reads are checked in blocks of batch_size reads with NumPy
+        (see BatchQualityControl.py) and only reads passing all quality metrics are collapsed one by one
+        :param packed: compare barcodes as 2-bit packed codes (see PackedBarcode.py), faster with many barcodes
+        :param start: byte offset of the first read to analyze (see FastqReader.split_file)
+        :param end: byte offset of the read after the last read to analyze (None to analyze until the end of the file)
+        :param collapse: 'greedy', 'abundance' or 'graph' (see AllBarcode); with 'abundance' and 'graph' the returned
+        AllBarcode object only holds exact counts until its finish_collapse is called
+        :param whitelist: a list of known barcodes that reads are assigned to (see AllBarcode)
+        :param discover: with a whitelist, collapse reads that are not near any whitelist barcode into new barcodes
+        :param anchor: search reads failing the constant region check for their constant regions at other positions
+        (see AnchorSearch.py); the whole read is then kept instead of its first 129 bases
+        :param checkpoint: a Checkpoint object (see Checkpoint.py) that the state is saved to every
+        checkpoint.read_interval reads (native parser only); if its log already exists, the run is resumed from it
+        :param telemetry: a Telemetry object (see Telemetry.py) that a record is appended to after every batch, or
+        every telemetry.read_interval reads without batch_size
+        :param membership: record which barcodes of the reads are collapsed into which barcode (see
+        ClusterMembership.py); the membership is not saved in checkpoints
+        :return: a tuple (AllBarcode object, read_counts); read_counts is a dictionary containing
+        1.total number of reads analyzed (all_reads)
+        2.total number of reads that pass all quality metrics (good_reads)
+        3.total number of reads whose Phred scores of the barcode region are too low (bad_barcode_reads)
+        4.total number of reads whose constant regions differ more than the threshold (bad_constant_reads)
+        5.total number of reads whose sample index differ more than the threshold (bad_sample_index_reads)
+        6.total number of good reads found by the anchor search (anchored_reads, only with anchor=True)
+        """
+        all_barcode_list = AllBarcode(packed, collapse, whitelist, discover, membership)
+
+        all_reads = 0
+        good_reads = 0
+        bad_barcode_reads = 0
+        bad_constant_reads = 0
+        bad_sample_index_reads = 0
+        anchored_reads = 0
+
+        def current_read_counts():
+            read_counts = {'all_reads': all_reads, 'good_reads': good_reads, 'bad_barcode_reads': bad_barcode_reads,
+                           'bad_constant_reads': bad_constant_reads, 'bad_sample_index_reads': bad_sample_index_reads}
+            if anchor:
+                read_counts['anchored_reads'] = anchored_reads
+            return read_counts
+
+        # lines are counted to know the offset of the next read at every checkpoint
+        lines = None
+        if checkpoint is not None:
+            if fastq_parser != 'native':
+                raise ValueError('Checkpoints only work with the native FASTQ parser')
+            restored = checkpoint.restore(all_barcode_list) if checkpoint.exists() else None
+            if restored is None:
+                checkpoint.start(all_barcode_list)
+                if telemetry is not None:
+                    # records of an earlier run are only continued if the run is resumed from its checkpoint
+                    Telemetry.remove(telemetry.filename)
+            else:
+                read_counts, start = restored
+                all_reads = read_counts['all_reads']
+                good_reads = read_counts['good_reads']
+                bad_barcode_reads = read_counts['bad_barcode_reads']
+                bad_constant_reads = read_counts['bad_constant_reads']
+                bad_sample_index_reads = read_counts['bad_sample_index_reads']
+                anchored_reads = read_counts.get('anchored_reads', 0)
+                print('resuming after ' + str(all_reads) + ' reads at ' + str(datetime.datetime.now()))
+                if telemetry is not None:
+                    telemetry.resume(all_reads)
+            lines = FastqReader.LineCounter(FastqReader.open_lines(filename, start, end), start)
+        checkpointed_reads = all_reads
+        recorded_reads = all_reads
+
+        if batch_size:
+            for sequences, qualities in FastqReader.iterate_blocks(filename, batch_size, start=start, end=end,
+                                                                   lines=lines, parser=fastq_parser):
+                checking = time.perf_counter()
+                barcodes, sample_indexes, bad_barcode, bad_constant, bad_sample_index, anchored = \
+                    BatchQualityControl.quality_control_block(sequences, qualities, anchor)
+                collapsing = time.perf_counter()
+                all_reads += len(sequences)
+                bad_barcode_reads += bad_barcode
+                bad_constant_reads += bad_constant
+                bad_sample_index_reads += bad_sample_index
+                anchored_reads += anchored
+
+                # identical (barcode, sample index) pairs are collapsed once, in the order they are first seen
+                read_id_counter = {}
+                for read_id in zip(barcodes, sample_indexes):
+                    read_id_counter[read_id] = read_id_counter.get(read_id, 0) + 1
+                for read_id, read_count in read_id_counter.items():
+                    all_barcode_list.add_read(read_id, read_count)
+                good_reads += len(barcodes)
+                if telemetry is not None:
+                    telemetry.add_time('quality_control', collapsing - checking)
+                    telemetry.add_time('collapse', time.perf_counter() - collapsing)
+                    telemetry.record(current_read_counts(), Telemetry.clusters(all_barcode_list))
+
+                print(str(all_reads) + ' reads have been parsed at ' + str(datetime.datetime.now()))
+                if checkpoint is not None and all_reads - checkpointed_reads >= checkpoint.read_interval:
+                    checkpoint.save(all_barcode_list, current_read_counts(), lines.position)
+                    checkpointed_reads = all_reads
+        else:
+            # Identical reads are counted first, so the rest of the quality control and the barcode collapse only run
+            # once per unique sequence. Unique sequences are kept in the order they are first seen, which gives exactly
+            # the same collapse as processing every read in file order.
+            read_counter = {}
+
+            parsed_generator = FastqReader.iterate_reads(filename, fastq_parser, read_length=None if anchor else 129,
+                                                         start=start, end=end, lines=lines)
+            for read_sequence, barcode_quality in parsed_generator:
+                all_reads += 1
+
+                # Check Phred score
+                if barcode_quality < 0.8 * 40 * 30:
+                    bad_barcode_reads += 1
+                else:
+                    read_counter[read_sequence] = read_counter.get(read_sequence, 0) + 1
+
+                # keep memory bounded by collapsing unique sequences once too many of them have been counted, and
+                # collapse them before a checkpoint or a telemetry record so that it holds all reads before the next
+                # one
+                checkpoint_due = checkpoint is not None and all_reads - checkpointed_reads >= checkpoint.read_interval
+                telemetry_due = telemetry is not None and all_reads - recorded_reads >= telemetry.read_interval
+                if len(read_counter) >= Functions.unique_read_limit or checkpoint_due or telemetry_due:
+                    good, bad_constant, bad_sample_index, anchored = \
+                        Functions.collapse_unique_reads(read_counter, all_barcode_list, anchor, telemetry)
+                    good_reads += good
+                    bad_constant_reads += bad_constant
+                    bad_sample_index_reads += bad_sample_index
+                    anchored_reads += anchored
+                    read_counter = {}
+                if checkpoint_due:
+                    checkpoint.save(all_barcode_list, current_read_counts(), lines.position)
+                    checkpointed_reads = all_reads
+                if telemetry_due:
+                    telemetry.record(current_read_counts(), Telemetry.clusters(all_barcode_list))
+                    recorded_reads = all_reads
+
+                # print update every 1,000,000 reads
+                if all_reads % 1000000 == 0:
+                    print(str(all_reads) + ' reads have been parsed at ' + str(datetime.datetime.now()))
+
+            good, bad_constant, bad_sample_index, anchored = \
+                Functions.collapse_unique_reads(read_counter, all_barcode_list, anchor, telemetry)
+            good_reads += good
+            bad_constant_reads += bad_constant
+            bad_sample_index_reads += bad_sample_index
+            anchored_reads += anchored
+            if telemetry is not None:
+                telemetry.record(current_read_counts(), Telemetry.clusters(all_barcode_list))
+
+        return all_barcode_list, current_read_counts()
+
+    @staticmethod
+    def write_read_summary(output_prefix, read_counts):
+        """
+        This function reports the number of reads that pass or fail each quality metric.
+
+        :param output_prefix: prefix used to name the summary
+        :param read_counts: a dictionary of read counts returned by Functions.collapse_fastq
+        """
+        print('\nSummary of ' + str(output_prefix))
+        print('Total Number of Reads ' + str(read_counts['all_reads']))
+        print('Number of Good Reads ' + str(read_counts['good_reads']))
+        print('Number of Bad Barcode Reads ' + str(read_counts['bad_barcode_reads']))
+        print('Number of Bad Constant Reads ' + str(read_counts['bad_constant_reads']))
+        print('Number of Bad Sample Index Reads ' + str(read_counts['bad_sample_index_reads']))
+        if 'anchored_reads' in read_counts:
+            print('Number of Good Reads Found by Anchor Search ' + str(read_counts['anchored_reads']))
+        if 'unassigned_reads' in read_counts:
+            print('Number of Unassigned Reads ' + str(read_counts['unassigned_reads']))
+
+    @staticmethod
+    def reading_fastq(fastq_parser='native', batch_size=None, packed=False, collapse='greedy', output_prefix=None,
+                      qc_workers=None, queue_size=None, whitelist=None, discover=False, anchor=False,
+                      checkpoint=None, telemetry=None, cluster_processes=None, sample_shards=None,
+                      collapse_workers=None, membership=False):
         """
         This function automatically checks the quality of a particular read by checking similarities
         between its constant regions and a priori constant sequences.
@@ -144,71 +638,201 @@ class Functions:
 
         If a particular read violates at least one of these requirements, it will be disregard.
 
-        :param input_fastq: the name of fastq file containing reads we want to analyze.
-        :param output_csv_name: the name of csv file containing
+        :param fastq_parser: 'native' to read the fastq file with FastqReader.iterate_fastq, 'biopython' to use
+        Bio.SeqIO (slower, kept to validate the native parser) or 'mmap' to map an uncompressed file (see
+        MappedFastq.py)
+        :param batch_size: if given, reads are checked in blocks of batch_size reads with NumPy
+        (see BatchQualityControl.py) and only reads passing all quality metrics are collapsed one by one
+        :param packed: compare barcodes as 2-bit packed codes (see PackedBarcode.py), faster with many barcodes
+        :param collapse: 'greedy' to collapse reads in file order, 'abundance' to cluster exact barcodes in
+        descending abundance or 'graph' to cluster them into connected components (see AllBarcode.finish_collapse)
+        :param output_prefix: prefix used to name the summary (default: the fastq filename)
+        :param qc_workers: if given, reads are checked by this many worker processes while they are being read and
+        collapsed (see Pipeline.py); batch_size is then the number of reads per chunk
+        :param queue_size: maximum number of chunks waiting between two stages of the pipeline
+        :param whitelist: a list of known barcodes; reads are assigned to the nearest one within 5 Hamming distances
+        :param discover: with a whitelist, collapse the other reads into new barcodes instead of leaving them out
+        :param anchor: look for the constant regions of reads failing the fixed-position check elsewhere in the read
+        (see AnchorSearch.py); by default only the fixed positions are checked
+        :param checkpoint: a Checkpoint object that the state of the run is saved to at regular intervals and resumed
+        from if its log exists (see Checkpoint.py)
+        :param telemetry: a Telemetry object that throughput, stage times, rejections, number of barcodes and memory
+        are recorded to while reads are collapsed (see Telemetry.py)
+        :param cluster_processes: number of processes that build the neighbour graph with collapse='graph'
+        :param sample_shards: with qc_workers, 'sample' or 'timepoint' to collapse reads of every sample index or of
+        every timepoint in its own group by collapse worker processes and reconcile the groups at the end (see
+        SampleShards.py)
+        :param collapse_workers: number of collapse worker processes with sample_shards (default: one per group, at
+        most the number of CPUs)
+        :param membership: record which barcodes of the reads are collapsed into which barcode (see
+        ClusterMembership.py)
+        :return: an AllBarcode object containing collapsed reads
+        The summary of the analysis is saved as a csv file containing
         1.total number of reads analyzed
         2.total number of reads whose min(Phred score) < 20
         3.total number of reads whose constant regions differ more than the threshold
         4.total number of reads whose sample index differ more than the threshold
         5.total number of reads that pass all quality metrics
         6.total number of sample indexes present in this population
+        7.total number of good reads that are not assigned to any whitelist barcode (only with a whitelist)
         """
-        parsed_generator = SeqIO.parse(open(file), 'fastq')
-        sample_index_list = list(Constants.sample_index_dict.values())
-        all_barcode_list = AllBarcode()
-
-        all_reads = 0
-        good_reads = 0
-        bad_barcode_reads = 0
-        bad_constant_reads = 0
-        bad_sample_index_reads = 0
-        i = 1
-
-        for seq_record in parsed_generator:
-            all_reads += 1
-            if sum(seq_record.letter_annotations['phred_quality'][:30]) < 0.8 * 40 * 30:
-                bad_barcode_reads += 1
-                continue
-            read_sequence = seq_record.seq[:129]
-            if Functions.hamming_distance(Constants.constant_1, read_sequence[30:95]) > 5 or \
-                    Functions.hamming_distance(Constants.constant_2, read_sequence[105:]) > 2:
-                bad_constant_reads += 1
-                continue
-            read_barcode = str(read_sequence[:30])
-            read_sample_index = str(read_sequence[95:105])
-            sample_index_flag = True
-            for sample_index in sample_index_list:
-                if Functions.hamming_distance(sample_index, read_sample_index) <= 1:
-                    read_sample_index = sample_index
-                    sample_index_flag = False
-            if sample_index_flag:
-                bad_sample_index_reads += 1
-                continue
-            read_id = (read_barcode, read_sample_index)
-            all_barcode_list.add_read(read_id)
-            good_reads += 1
-            if i % 1000000 == 0:
-                print(str(i) + ' reads have been parsed at ' + str(datetime.datetime.now()))
-            i += 1
-
-        print('\nSummary of ' + str(file))
-        print('Total Number of Reads ' + str(all_reads))
-        print('Number of Good Reads ' + str(good_reads))
-        print('Number of Bad Barcode Reads ' + str(bad_barcode_reads))
-        print('Number of Bad Constant Reads ' + str(bad_constant_reads))
-        print('Number of Bad Sample Index Reads ' + str(bad_sample_index_reads))
-
+        if qc_workers:
+            all_barcode_list = AllBarcode(packed, collapse, whitelist, discover, membership)
+            shards = None
+            if sample_shards:
+                shards = SampleShards(sample_shards, collapse_workers, packed, collapse, whitelist, discover,
+                                      membership=membership)
+            read_counts, stage_stats = Pipeline.collapse_fastq(file, all_barcode_list, batch_size, qc_workers,
+                                                               queue_size, anchor, telemetry, shards)
+            Pipeline.report_stage_stats(stage_stats)
+        else:
+            all_barcode_list, read_counts = Functions.collapse_fastq(file, fastq_parser, batch_size, packed,
+                                                                     collapse=collapse, whitelist=whitelist,
+                                                                     discover=discover, anchor=anchor,
+                                                                     checkpoint=checkpoint, telemetry=telemetry,
+                                                                     membership=membership)
+        all_barcode_list.finish_collapse(cluster_processes)
+        if telemetry is not None:
+            telemetry.add_time('finish_collapse', telemetry.interval_elapsed())
+            telemetry.record(read_counts, len(all_barcode_list.counts), 'finish_collapse')
+        if whitelist is not None:
+            read_counts['unassigned_reads'] = all_barcode_list.unassigned_reads
+        Functions.write_read_summary(output_prefix or file, read_counts)
         return all_barcode_list
 
     @staticmethod
-    def operate():
+    def operate(fastq_parser='native', batch_size=None, packed=False, collapse='greedy', raw_read_format='pickle',
+                output_prefix=None, qc_workers=None, queue_size=None, whitelist_file=None, discover=False,
+                anchor=False, checkpoint_reads=None, resume=False, telemetry_reads=None, cluster_processes=None,
+                sample_shards=None, collapse_workers=None, membership_format=None):
+        output_prefix = output_prefix or file
+        whitelist = None
+        if whitelist_file:
+            print('reading whitelist ' + whitelist_file)
+            whitelist = Functions.read_whitelist(whitelist_file)
+        checkpoint = None
+        if checkpoint_reads:
+            # a run can only be resumed with the settings it was started with
+            settings = {'file': file, 'batch_size': batch_size, 'packed': packed, 'collapse': collapse,
+                        'whitelist': whitelist_file, 'discover': discover, 'anchor': anchor}
+            checkpoint = Checkpoint(str(output_prefix) + '_checkpoint.log', settings, checkpoint_reads)
+            if not resume:
+                checkpoint.remove()
+        telemetry = None
+        if telemetry_reads:
+            telemetry = Telemetry.Telemetry(str(output_prefix) + '_telemetry.jsonl', read_interval=telemetry_reads)
+            # a resumed run continues the records of the interrupted run (see Telemetry.resume)
+            if not resume:
+                Telemetry.remove(telemetry.filename)
         print('parsing fastq and collapsing barcodes')
-        all_barcode_list = Functions.reading_fastq()
+        all_barcode_list = Functions.reading_fastq(fastq_parser, batch_size, packed, collapse, output_prefix,
+                                                   qc_workers, queue_size, whitelist, discover, anchor, checkpoint,
+                                                   telemetry, cluster_processes, sample_shards, collapse_workers,
+                                                   membership_format is not None)
         print('printing barcodes')
-        all_barcode_list.print_raw_read()
-        print('dumping pickles')
-        all_barcode_list.save_pickle()
+        all_barcode_list.print_raw_read(output_prefix)
+        if raw_read_format == 'npz':
+            print('dumping npz')
+            all_barcode_list.save_npz(output_prefix)
+        else:
+            print('dumping pickles')
+            all_barcode_list.save_pickle(output_prefix)
+        if membership_format is not None:
+            print('dumping membership')
+            all_barcode_list.save_membership(output_prefix, membership_format)
+        if checkpoint is not None:
+            checkpoint.remove()
+        if telemetry is not None:
+            report = Telemetry.write_run_report(telemetry.filename, str(output_prefix) + '_run_report.json')
+            print('run report: ' + str(report['reads_per_second']) + ' reads/s, peak memory ' +
+                  str(report['peak_rss_mb']) + ' MB')
 
 if __name__ == '__main__':
-    file = sys.argv[1]
-    Functions.operate()
+    # This program will operate on filename that is the second argument when run a python3 function on terminal
+    # i.e. python3 SequenceDecomplexationOptimized.py test.fastq
+    # in this case test.fastq will be analyzed by this file
+    # reads can also be streamed from standard input, with an explicit prefix of output files
+    # i.e. fasterq-dump --stdout SRR123 | python3 SequenceDecomplexationOptimized.py - --output SRR123
+    argument_parser = argparse.ArgumentParser(description='Decomplex reads in a fastq file.')
+    argument_parser.add_argument('file', help="name of the fastq file to be analyzed ('-' for standard input)")
+    argument_parser.add_argument('-o', '--output',
+                                 help='prefix of output files (default: the fastq filename), required for standard '
+                                      'input')
+    argument_parser.add_argument('--fastq-parser', choices=FastqReader.parser_choices, default='native',
+                                 help='read the fastq file natively (default), with Bio.SeqIO or through a memory '
+                                      'map (uncompressed files only, see MappedFastq.py)')
+    argument_parser.add_argument('--batch-size', type=int,
+                                 help='check reads in blocks of this many reads with NumPy, e.g. 1000000')
+    argument_parser.add_argument('--packed-barcodes', action='store_true',
+                                 help='compare barcodes as 2-bit packed codes, faster when there are many barcodes')
+    argument_parser.add_argument('--collapse', choices=AllBarcode.collapse_choices, default='greedy',
+                                 help='collapse reads in file order (default), cluster exact barcodes in descending '
+                                      'abundance, or cluster them into connected components of barcodes within 5 '
+                                      'Hamming distances with several processes (graph); the last two do not depend on '
+                                      'the order of reads')
+    argument_parser.add_argument('--cluster-processes', type=int,
+                                 help='number of processes that compare barcodes with --collapse graph (default: '
+                                      'number of CPUs)')
+    argument_parser.add_argument('--raw-read-format', choices=AllBarcode.raw_read_formats, default='pickle',
+                                 help='save raw read counts as a pickle (default) or as a compressed NumPy .npz file')
+    argument_parser.add_argument('--membership', nargs='?', choices=ClusterMembership.membership_formats, const='npz',
+                                 help='save which barcodes of the reads were collapsed into every barcode to '
+                                      'output_membership.npz (default) or .parquet (see ClusterMembership.py)')
+    argument_parser.add_argument('--qc-workers', type=int,
+                                 help='read, check and collapse reads at the same time with this many quality control '
+                                      'worker processes, e.g. the number of CPUs (see Pipeline.py)')
+    argument_parser.add_argument('--queue-size', type=int,
+                                 help='maximum number of read batches waiting between two stages with --qc-workers '
+                                      '(default: 2 per worker)')
+    argument_parser.add_argument('--sample-shards', choices=SampleShards.shard_choices,
+                                 help='with --qc-workers, collapse reads of every sample index (sample) or of every '
+                                      'timepoint (4 sample indexes) in its own group by collapse worker processes and '
+                                      'reconcile the barcodes of all groups at the end (see SampleShards.py)')
+    argument_parser.add_argument('--collapse-workers', type=int,
+                                 help='number of collapse worker processes with --sample-shards (default: one per '
+                                      'group, at most the number of CPUs)')
+    argument_parser.add_argument('--whitelist',
+                                 help='assign reads to the nearest known barcode within 5 Hamming distances, e.g. the '
+                                      'barcodes of an earlier finished table (191012_finished_table.pickle) or a .txt '
+                                      'file with one barcode per line')
+    argument_parser.add_argument('--discover', action='store_true',
+                                 help='with --whitelist, collapse reads that are not near any known barcode into new '
+                                      'barcodes instead of leaving them out')
+    argument_parser.add_argument('--anchor', action='store_true',
+                                 help='search reads whose constant regions are not at the expected positions (e.g. '
+                                      'shifted reads) for them at other positions instead of discarding them')
+    argument_parser.add_argument('--checkpoint-reads', type=int,
+                                 help='save the state of the run every this many reads, e.g. 1000000, to '
+                                      'output_checkpoint.log (see Checkpoint.py)')
+    argument_parser.add_argument('--resume', action='store_true',
+                                 help='resume a killed run from its last checkpoint (every 1000000 reads unless '
+                                      '--checkpoint-reads is given)')
+    argument_parser.add_argument('--telemetry', nargs='?', type=int, const=1000000, metavar='READS',
+                                 help='record throughput, time per stage, rejected reads, number of barcodes and peak '
+                                      'memory to output_telemetry.jsonl (every batch, or every READS reads, default '
+                                      '1000000) and merge them into output_run_report.json (see Telemetry.py)')
+    arguments = argument_parser.parse_args()
+    if arguments.file == '-' and not arguments.output:
+        argument_parser.error('an output prefix (--output) is required to read from standard input')
+    if arguments.qc_workers and arguments.fastq_parser != 'native':
+        argument_parser.error('--qc-workers only works with the native FASTQ parser')
+    if arguments.fastq_parser == 'mmap' and (FastqReader.is_stream(arguments.file) or
+                                             GzipInput.compression(arguments.file)):
+        argument_parser.error('--fastq-parser mmap only reads uncompressed fastq files')
+    if arguments.discover and not arguments.whitelist:
+        argument_parser.error('--discover requires --whitelist')
+    if arguments.sample_shards and not arguments.qc_workers:
+        argument_parser.error('--sample-shards requires --qc-workers')
+    if arguments.resume and not arguments.checkpoint_reads:
+        arguments.checkpoint_reads = 1000000
+    if arguments.checkpoint_reads and (FastqReader.is_stream(arguments.file) or arguments.qc_workers or
+                                       arguments.fastq_parser != 'native'):
+        argument_parser.error('checkpoints need a fastq file (not a stream), the native parser and no --qc-workers')
+    if arguments.checkpoint_reads and arguments.membership:
+        argument_parser.error('--membership cannot be resumed from checkpoints')
+    file = arguments.file
+    Functions.operate(arguments.fastq_parser, arguments.batch_size, arguments.packed_barcodes, arguments.collapse,
+                      arguments.raw_read_format, arguments.output, arguments.qc_workers, arguments.queue_size,
+                      arguments.whitelist, arguments.discover, arguments.anchor, arguments.checkpoint_reads,
+                      arguments.resume, arguments.telemetry, arguments.cluster_processes, arguments.sample_shards,
+                      arguments.collapse_workers, arguments.membership)
@@ -0,0 +1,234 @@
+"""
+SequenceDecomplexationParallel.py decomplexes a whole FASTQ file with one command and several processes. It replaces the
+three steps of splitting the file with SequenceSplit.py, running SequenceDecomplexationOptimized.py on every part with
+GNU parallel and merging the parts with SequenceDecomplexationTable.py.
+
+1.The FASTQ file is divided into byte ranges that start at record boundaries (FastqReader.split_file), so the file is
+neither parsed nor rewritten to be split.
+
+2.Reads in each range are checked and collapsed by Functions.collapse_fastq in a process pool.
+
+3.Collapsed barcodes of all ranges are merged in memory in the order of the ranges. Each barcode is collapsed into the
+earliest barcode within 5 Hamming distances, in the same way as reads are collapsed within one range.
+
+With --collapse abundance (or graph), each range only counts exact barcodes. The counts of all ranges are summed up and
+clustered once in descending abundance (or into connected components by --processes processes, see BarcodeGraph.py),
+so the result is identical to decomplexing the whole file in one process.
+
+With --whitelist, every worker indexes the known barcodes once and assigns reads to the nearest one (see AllBarcode).
+
+With --fastq-parser mmap, the file is divided into ranges of its memory map and every worker maps the file itself and
+only reads its own range (see MappedFastq.py).
+
+With --membership, every worker records which barcodes of its reads were collapsed into which barcode and the records
+are carried over to the merged barcodes (see ClusterMembership.py).
+
+With --telemetry, every worker appends its records to the same JSON lines file as one shard, the main process appends
+one record per merged part (shard 'merge'), and all records are merged into one run report (see Telemetry.py).
+
+The output files are the same as the ones of SequenceDecomplexationOptimized.py (raw read pickle, CSV and read summary)
+together with a finished table (barcodes x sample indexes) like the one produced by SequenceDecomplexationTable.py.
+
+Example:
+
+    python3 SequenceDecomplexationParallel.py 190812Gar.fastq --processes 8
+"""
+import argparse
+import datetime
+import ClusterMembership
+import multiprocessing
+import time
+import FastqReader
+import GzipInput
+import MappedFastq
+import TableIO
+import Telemetry
+from SequenceDecomplexationOptimized import AllBarcode, Functions
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+
+def collapse_shard(shard_arguments):
+    """
+    This function collapses reads in one byte range of a FASTQ file. It runs in a worker process.
+
+    :param shard_arguments: a tuple (filename, batch size, packed, start, end, collapse, whitelist, discover, anchor,
+    shard number, telemetry, FASTQ parser, membership); telemetry is the Telemetry object of the run or None
+    :return: a tuple (CountMatrix object, read counts, MembershipLog object or None); barcodes are exact barcodes with
+    collapse='abundance' or collapse='graph' and collapsed barcodes otherwise
+    """
+    filename, batch_size, packed, start, end, collapse, whitelist, discover, anchor, shard, telemetry, fastq_parser, \
+        membership = shard_arguments
+    if telemetry is not None:
+        telemetry = Telemetry.Telemetry(telemetry.filename, shard, telemetry.read_interval)
+    all_barcode_list, read_counts = Functions.collapse_fastq(filename, fastq_parser, batch_size, packed, start, end,
+                                                             collapse, whitelist, discover, anchor,
+                                                             telemetry=telemetry, membership=membership)
+    if whitelist is not None:
+        read_counts['unassigned_reads'] = all_barcode_list.unassigned_reads
+    if collapse in AllBarcode.exact_collapse_choices:
+        return all_barcode_list.exact_counts, read_counts, all_barcode_list.membership
+    return all_barcode_list.counts, read_counts, all_barcode_list.membership
+
+
+def decomplex_parallel(filename, processes, shard_number=None, batch_size=None, packed=False, collapse='greedy',
+                       whitelist=None, discover=False, anchor=False, telemetry=None, fastq_parser='native',
+                       membership=False):
+    """
+    This function decomplexes a FASTQ file in a pool of processes and merges the results.
+
+    :param filename: the name of a FASTQ file
+    :param processes: number of worker processes
+    :param shard_number: number of byte ranges the file is divided into (default: one per process)
+    :param batch_size: if given, reads are checked in blocks of batch_size reads with NumPy
+    :param packed: compare barcodes as 2-bit packed codes
+    :param collapse: 'greedy', 'abundance' or 'graph' (see AllBarcode.finish_collapse)
+    :param whitelist: a list of known barcodes that reads are assigned to (see AllBarcode)
+    :param discover: with a whitelist, collapse reads that are not near any whitelist barcode into new barcodes
+    :param anchor: search reads failing the constant region check for their constant regions (see AnchorSearch.py)
+    :param telemetry: a Telemetry object whose file every worker appends its records to (see Telemetry.py)
+    :param fastq_parser: 'native' or 'mmap' to divide the memory map of an uncompressed file (see MappedFastq.py)
+    :param membership: record which barcodes of the reads are collapsed into which barcode (see ClusterMembership.py)
+    :return: a tuple (merged AllBarcode object, read counts of the whole file)
+    """
+    if FastqReader.is_stream(filename):
+        raise ValueError('A stream cannot be divided between processes, use SequenceDecomplexationOptimized.py: ' +
+                         filename)
+    if fastq_parser == 'mmap':
+        shards = MappedFastq.split_file(filename, shard_number or processes)
+    else:
+        shards = FastqReader.split_file(filename, shard_number or processes)
+    shard_arguments = [(filename, batch_size, packed, start, end, collapse, whitelist, discover, anchor, shard,
+                        telemetry, fastq_parser, membership) for shard, (start, end) in enumerate(shards)]
+    if telemetry is not None:
+        telemetry = Telemetry.Telemetry(telemetry.filename, 'merge', telemetry.read_interval)
+
+    all_barcode_list = AllBarcode(packed, collapse, whitelist, discover, membership)
+    # an empty file has no parts, so every count starts from 0
+    read_counts = {'all_reads': 0, 'good_reads': 0, 'bad_barcode_reads': 0, 'bad_constant_reads': 0,
+                   'bad_sample_index_reads': 0}
+    if anchor:
+        read_counts['anchored_reads'] = 0
+    with multiprocessing.Pool(processes) as pool:
+        # imap returns the results in the order of the ranges, so the merge does not depend on which worker ends first
+        for shard, (shard_counts, shard_read_counts, shard_membership) in \
+                enumerate(pool.imap(collapse_shard, shard_arguments)):
+            print('merging part ' + str(shard + 1) + ' of ' + str(len(shards)) + ' at ' + str(datetime.datetime.now()))
+            merging = time.perf_counter()
+            rows = [all_barcode_list.add_barcode(barcode, counts)
+                    for barcode, counts in zip(shard_counts.barcodes, shard_counts.counts)]
+            all_barcode_list.merge_membership(shard_membership, rows)
+            for key, value in shard_read_counts.items():
+                read_counts[key] = read_counts.get(key, 0) + value
+            if telemetry is not None:
+                # the time before a part arrives is spent waiting for the workers
+                merge_time = time.perf_counter() - merging
+                telemetry.add_time('merge', merge_time)
+                telemetry.add_time('waiting_for_shards', telemetry.interval_elapsed() - merge_time)
+                telemetry.record(read_counts, Telemetry.clusters(all_barcode_list), 'merge')
+    all_barcode_list.finish_collapse(processes)
+    if telemetry is not None:
+        telemetry.add_time('finish_collapse', telemetry.interval_elapsed())
+        telemetry.record(read_counts, len(all_barcode_list.counts), 'finish_collapse')
+    if whitelist is not None:
+        # with collapse='greedy' reads are left out in the workers, otherwise in finish_collapse
+        read_counts['unassigned_reads'] = read_counts.get('unassigned_reads', 0) + all_barcode_list.unassigned_reads
+    return all_barcode_list, read_counts
+
+
+def finished_table(all_barcode_list):
+    """
+    This function converts collapsed barcodes into a table with one row per barcode and one column per sample index.
+
+    :param all_barcode_list: an AllBarcode object
+    :return: a DataFrame
+    """
+    return all_barcode_list.counts.to_dataframe()
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Decomplex reads in a fastq file with several processes.')
+    argument_parser.add_argument('file', help='name of the fastq file to be analyzed')
+    argument_parser.add_argument('-o', '--output', help='prefix of output files (default: the fastq filename)')
+    argument_parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                                 help='number of worker processes (default: number of CPUs)')
+    argument_parser.add_argument('--shards', type=int,
+                                 help='number of parts the fastq file is divided into (default: one per process)')
+    argument_parser.add_argument('--fastq-parser', choices=['native', 'mmap'], default='native',
+                                 help='read the fastq file natively (default) or through a memory map (uncompressed '
+                                      'files only, see MappedFastq.py)')
+    argument_parser.add_argument('--batch-size', type=int,
+                                 help='check reads in blocks of this many reads with NumPy, e.g. 1000000')
+    argument_parser.add_argument('--packed-barcodes', action='store_true',
+                                 help='compare barcodes as 2-bit packed codes, faster when there are many barcodes')
+    argument_parser.add_argument('--collapse', choices=AllBarcode.collapse_choices, default='greedy',
+                                 help='collapse reads in file order (default), cluster exact barcodes in descending '
+                                      'abundance, or cluster them into connected components of barcodes within 5 '
+                                      'Hamming distances (graph); the last two give the same result however the file '
+                                      'is divided')
+    argument_parser.add_argument('--raw-read-format', choices=AllBarcode.raw_read_formats, default='pickle',
+                                 help='save raw read counts as a pickle (default) or as a compressed NumPy .npz file')
+    argument_parser.add_argument('--table-format', choices=TableIO.table_formats, default='pickle',
+                                 help='format of the finished table (default: pickle)')
+    argument_parser.add_argument('--timepoints',
+                                 help='timepoints of sample groups embedded in Parquet/Arrow files, e.g. d0=1,d6=2')
+    argument_parser.add_argument('--whitelist',
+                                 help='assign reads to the nearest known barcode within 5 Hamming distances, e.g. the '
+                                      'barcodes of an earlier finished table or a .txt file with one barcode per line')
+    argument_parser.add_argument('--discover', action='store_true',
+                                 help='with --whitelist, collapse reads that are not near any known barcode into new '
+                                      'barcodes instead of leaving them out')
+    argument_parser.add_argument('--anchor', action='store_true',
+                                 help='search reads whose constant regions are not at the expected positions (e.g. '
+                                      'shifted reads) for them at other positions instead of discarding them')
+    argument_parser.add_argument('--membership', nargs='?', choices=ClusterMembership.membership_formats, const='npz',
+                                 help='save which barcodes of the reads were collapsed into every barcode to '
+                                      'output_membership.npz (default) or .parquet (see ClusterMembership.py)')
+    argument_parser.add_argument('--telemetry', nargs='?', type=int, const=1000000, metavar='READS',
+                                 help='record throughput, time per stage, rejected reads, number of barcodes and peak '
+                                      'memory of every worker to output_telemetry.jsonl (every batch, or every READS '
+                                      'reads, default 1000000) and merge them into output_run_report.json')
+    arguments = argument_parser.parse_args()
+    if arguments.fastq_parser == 'mmap' and (FastqReader.is_stream(arguments.file) or
+                                             GzipInput.compression(arguments.file)):
+        argument_parser.error('--fastq-parser mmap only reads uncompressed fastq files')
+    if arguments.discover and not arguments.whitelist:
+        argument_parser.error('--discover requires --whitelist')
+    file = arguments.file
+    output_prefix = arguments.output or file
+    whitelist = Functions.read_whitelist(arguments.whitelist) if arguments.whitelist else None
+    telemetry = None
+    if arguments.telemetry:
+        telemetry = Telemetry.Telemetry(str(output_prefix) + '_telemetry.jsonl', read_interval=arguments.telemetry)
+        Telemetry.remove(telemetry.filename)
+
+    print('parsing fastq and collapsing barcodes')
+    all_barcode_list, read_counts = decomplex_parallel(file, arguments.processes, arguments.shards,
+                                                       arguments.batch_size, arguments.packed_barcodes,
+                                                       arguments.collapse, whitelist, arguments.discover,
+                                                       arguments.anchor, telemetry, arguments.fastq_parser,
+                                                       arguments.membership is not None)
+    Functions.write_read_summary(output_prefix, read_counts)
+
+    print('dumping finished table')
+    TableIO.save_finished_table(finished_table(all_barcode_list), output_prefix, arguments.table_format,
+                                TableIO.parse_timepoints(arguments.timepoints))
+
+    print('printing barcodes')
+    all_barcode_list.print_raw_read(output_prefix)
+    if arguments.raw_read_format == 'npz':
+        print('dumping npz')
+        all_barcode_list.save_npz(output_prefix)
+    else:
+        print('dumping pickles')
+        all_barcode_list.save_pickle(output_prefix)
+    if arguments.membership:
+        print('dumping membership')
+        all_barcode_list.save_membership(output_prefix, arguments.membership)
+    if telemetry is not None:
+        report = Telemetry.write_run_report(telemetry.filename, str(output_prefix) + '_run_report.json')
+        print('run report: ' + str(report['reads_per_second']) + ' reads/s, peak memory ' +
+              str(report['peak_rss_mb']) + ' MB')
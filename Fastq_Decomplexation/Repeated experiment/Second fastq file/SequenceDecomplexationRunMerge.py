@@ -0,0 +1,56 @@
+"""
+SequenceDecomplexationRunMerge.py combines finished tables of several NGS runs of the same experiment into one table,
+e.g. a first run and one or more additional runs that improve read qualities in some of the samples.
+
+The first table is the reference table. Barcodes of the additional runs with fewer than --min-reads reads in total are
+removed, and the remaining ones are collapsed into reference barcodes within 5 Hamming distances or added as new rows
+(see TableMerge.merge_runs).
+
+Example:
+
+    python3 SequenceDecomplexationRunMerge.py 190812_finished_table.pickle 191003Gar_finished_table.pickle \
+        --output 191012
+"""
+import argparse
+import datetime
+import TableIO
+import TableMerge
+from CountMatrix import read_table
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Merge finished tables of several NGS runs.')
+    argument_parser.add_argument('tables', nargs='+',
+                                 help='finished tables (or raw read files) of all runs; the first one is the reference')
+    argument_parser.add_argument('--output', required=True, help='prefix of the merged finished table')
+    argument_parser.add_argument('--min-reads', type=int, default=10,
+                                 help='minimum number of reads of a barcode of an additional run (default: 10)')
+    argument_parser.add_argument('--packed-barcodes', action='store_true',
+                                 help='compare barcodes as 2-bit packed codes, faster when there are many barcodes')
+    argument_parser.add_argument('--table-format', choices=TableIO.table_formats, default='pickle',
+                                 help='format of the merged finished table (default: pickle)')
+    argument_parser.add_argument('--timepoints',
+                                 help='timepoints of sample groups embedded in Parquet/Arrow files, e.g. d0=1,d6=2')
+    argument_parser.add_argument('--excel', action='store_true', help='also save the merged table as an Excel file')
+    arguments = argument_parser.parse_args()
+
+    tables = []
+    for filename in arguments.tables:
+        print('reading ' + filename + ' at ' + str(datetime.datetime.now()))
+        tables.append(read_table(filename))
+
+    print('merging ' + str(len(tables)) + ' runs at ' + str(datetime.datetime.now()))
+    merged_table = TableMerge.merge_runs(tables, arguments.min_reads, packed=arguments.packed_barcodes)
+
+    print('dumping ' + arguments.table_format)
+    table_filename = TableIO.save_finished_table(merged_table, arguments.output, arguments.table_format,
+                                                 TableIO.parse_timepoints(arguments.timepoints))
+
+    if arguments.excel:
+        print('saving excel file')
+        TableIO.export_excel(table_filename)
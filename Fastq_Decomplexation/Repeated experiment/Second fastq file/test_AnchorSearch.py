@@ -0,0 +1,72 @@
+"""
+Tests of AnchorSearch.py for reads with indels in constant_1. Run with: python3 -m pytest test_AnchorSearch.py
+"""
+import pytest
+import Constants
+import AnchorSearch
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+barcode = 'TGACCTAGTTCAGGATCCATGTCAAGTCTG'
+sample_index = list(Constants.sample_index_dict.values())[3]
+tail = 'ACGTTGCAACGTTGCAACGTT'
+
+
+def make_read(constant_1):
+    """
+    This function builds a read with barcode, a (modified) constant_1, sample_index and constant_2.
+    """
+    return barcode + constant_1 + sample_index + Constants.constant_2 + tail
+
+
+def delete(position, length):
+    """
+    This function returns constant_1 without length bases from position.
+    """
+    return Constants.constant_1[:position] + Constants.constant_1[position + length:]
+
+
+def insert(position, bases):
+    """
+    This function returns constant_1 with bases inserted before position.
+    """
+    return Constants.constant_1[:position] + bases + Constants.constant_1[position:]
+
+
+def test_split_distance_without_indel():
+    read_sequence = make_read(Constants.constant_1)
+    assert AnchorSearch.split_distance(Constants.constant_1, read_sequence, 30, 30) == 0
+
+
+@pytest.mark.parametrize('position', [0, 13, len(Constants.constant_1) - 3])
+def test_split_distance_counts_deletion_once(position):
+    read_sequence = make_read(delete(position, 3))
+    assert AnchorSearch.split_distance(Constants.constant_1, read_sequence, 30, 27) == 3
+
+
+@pytest.mark.parametrize('position', [0, 6, 13, len(Constants.constant_1)])
+def test_split_distance_counts_insertion_once(position):
+    read_sequence = make_read(insert(position, 'TT'))
+    assert AnchorSearch.split_distance(Constants.constant_1, read_sequence, 30, 32) == 2
+
+
+def test_locate_without_indel():
+    assert AnchorSearch.locate(make_read(Constants.constant_1)) == (barcode, sample_index)
+
+
+@pytest.mark.parametrize('position', [0, 1, 2, 13, len(Constants.constant_1) - 3])
+@pytest.mark.parametrize('length', [1, 2, 3])
+def test_locate_deletion(position, length):
+    assert AnchorSearch.locate(make_read(delete(position, length))) == (barcode, sample_index)
+
+
+@pytest.mark.parametrize('position', [3, 5, 6, 13, len(Constants.constant_1) - 3])
+def test_locate_insertion(position):
+    assert AnchorSearch.locate(make_read(insert(position, 'TT'))) == (barcode, sample_index)
+
+
+def test_locate_without_constant_regions():
+    assert AnchorSearch.locate(barcode * 5) is None
@@ -0,0 +1,35 @@
+"""
+Tests of Pipeline.py. Run with: python3 -m pytest test_Pipeline.py
+"""
+import os
+import subprocess
+import sys
+import SyntheticFastq
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SequenceDecomplexationOptimized.py')
+
+
+def decomplex(arguments, output_prefix, stdin=None):
+    """
+    This function runs SequenceDecomplexationOptimized.py and returns the csv file of raw read counts.
+    """
+    subprocess.run([sys.executable, script] + arguments + ['-o', str(output_prefix)], stdin=stdin,
+                   stdout=subprocess.DEVNULL, check=True, timeout=60, cwd=os.path.dirname(script))
+    with open(str(output_prefix) + '_raw_read_correct.csv') as handle:
+        return handle.read()
+
+
+def test_qc_workers_read_standard_input(tmp_path):
+    # the reader thread is still reading standard input when the QC workers start
+    filename = str(tmp_path / 'synthetic.fastq')
+    SyntheticFastq.generate(filename, 20000, barcode_number=200)
+    expected = decomplex([filename, '--batch-size', '1000', '--qc-workers', '2'], tmp_path / 'file')
+    for run in range(3):
+        with open(filename, 'rb') as handle:
+            assert decomplex(['-', '--batch-size', '1000', '--qc-workers', '2'], tmp_path / ('stdin_' + str(run)),
+                             handle) == expected
@@ -0,0 +1,102 @@
+"""
+Tests of TableMerge.py against a linear merge of tables. Run with: python3 -m pytest test_TableMerge.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import TableMerge
+from SequenceDecomplexationOptimized import Functions
+
+__author__ = 'Tee Udomlumleart'
+__maintainer__ = 'Tee Udomlumleart'
+__email__ = ['teeu@mit.edu', 'salilg@mit.edu']
+__status__ = 'Production'
+
+sample_indexes = ['S1', 'S2', 'S3', 'S4']
+
+
+def random_table(barcode_number, seed, columns=sample_indexes):
+    """
+    This function draws a table of random counts whose barcodes are mutants (0 to 8 mismatches) of a few shared
+    templates, so that tables drawn with different seeds have exact, similar and new barcodes.
+    """
+    template_rng = np.random.default_rng(0)
+    templates = [template_rng.choice(list('ACGT'), 30) for _ in range(40)]
+    rng = np.random.default_rng(seed)
+    barcodes = []
+    while len(barcodes) < barcode_number:
+        bases = templates[rng.integers(len(templates))].copy()
+        positions = rng.choice(30, int(rng.integers(9)), replace=False)
+        bases[positions] = rng.choice(list('ACGTN'), len(positions))
+        if ''.join(bases) not in barcodes:
+            barcodes.append(''.join(bases))
+    counts = rng.integers(0, 20, (barcode_number, len(columns)))
+    return pd.DataFrame(counts, index=pd.Index(barcodes, dtype=object), columns=columns)
+
+
+def linear_merge(tables):
+    """
+    This function merges tables by comparing every barcode with all merged barcodes in order: reference barcodes are
+    kept as they are and every other barcode is collapsed into the earliest merged barcode within 5 Hamming distances.
+    """
+    merged = {}
+    for table_number, table in enumerate(tables):
+        table = table.reindex(columns=tables[0].columns, fill_value=0)
+        for barcode, table_counts in zip(table.index, table.to_numpy(dtype=np.int64)):
+            parsed_barcode = None
+            if table_number > 0:
+                parsed_barcode = next((merged_barcode for merged_barcode in merged
+                                       if Functions.hamming_distance(merged_barcode, barcode) <= 5), None)
+            if parsed_barcode is None:
+                parsed_barcode = barcode
+                merged.setdefault(barcode, np.zeros(len(tables[0].columns), dtype=np.int64))
+            merged[parsed_barcode] += table_counts
+    return pd.DataFrame(list(merged.values()), index=pd.Index(list(merged), dtype=object), columns=tables[0].columns)
+
+
+def merge_tables(tables, packed):
+    """
+    This function merges tables with TableMerge.merge_tables and checks the result against linear_merge.
+    """
+    merged_table = TableMerge.merge_tables(tables, packed=packed)
+    pd.testing.assert_frame_equal(merged_table, linear_merge(tables), check_dtype=False)
+    return merged_table
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_merge_is_the_same_as_a_linear_merge(packed):
+    tables = [random_table(300, 1), random_table(300, 2), random_table(300, 3, columns=['S3', 'S1', 'S5'])]
+    merged_table = merge_tables(tables, packed)
+    # the reference table is kept as it is and reads of all tables are kept
+    assert list(merged_table.index[:300]) == list(tables[0].index)
+    assert merged_table.to_numpy().sum() == sum(table[table.columns.intersection(sample_indexes)].to_numpy().sum()
+                                                for table in tables)
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_shadowed_reference_barcode_is_collapsed_into_the_earlier_barcode(packed):
+    barcode = 'AGTGAATGTGTCTGACAGTCAGTGACTGAC'
+    shadowed_barcode = 'TT' + barcode[2:]
+    reference_table = pd.DataFrame([[1, 0, 0, 0], [0, 1, 0, 0]], index=[barcode, shadowed_barcode],
+                                   columns=sample_indexes)
+    additional_table = pd.DataFrame([[0, 0, 5, 0], [0, 0, 0, 7]], index=[shadowed_barcode, 'GGGGG' + barcode[5:]],
+                                    columns=sample_indexes)
+    table_merger = TableMerge.TableMerger(sample_indexes, packed=packed)
+    assert table_merger.add_table(reference_table, reference=True) == (0, 0, 2)
+    assert table_merger.shadowed_rows == {1}
+    # the shadowed barcode of the additional table goes to the earlier barcode, not to its own reference row
+    assert table_merger.add_table(additional_table) == (0, 2, 0)
+    assert table_merger.to_dataframe().to_dict('index') == {barcode: {'S1': 1, 'S2': 0, 'S3': 5, 'S4': 7},
+                                                            shadowed_barcode: {'S1': 0, 'S2': 1, 'S3': 0, 'S4': 0}}
+    merge_tables([reference_table, additional_table], packed)
+
+
+def test_merge_runs_removes_barcodes_with_few_reads_from_additional_runs():
+    reference_table = random_table(100, 1)
+    additional_table = random_table(300, 4)
+    merged_table = TableMerge.merge_runs([reference_table, additional_table], min_reads=30)
+    kept_table = additional_table[additional_table.sum(axis=1) >= 30]
+    assert 0 < len(kept_table) < len(additional_table)
+    # barcodes of the reference run are kept even if they have few reads
+    assert (reference_table.sum(axis=1) < 30).any()
+    pd.testing.assert_frame_equal(merged_table, linear_merge([reference_table, kept_table]), check_dtype=False)